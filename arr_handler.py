@@ -2,16 +2,35 @@ import json
 import time
 from bs4 import BeautifulSoup
 import email_handler
+import http_client
 import web_requests
 from logger import get_logger
 import re
 import os
 import requests
+import resilience
+
+
+def request_with_retries(method: str, url: str, **kwargs) -> requests.Response:
+    # Only connection problems and server errors are retried, a rejected request would just be rejected again.
+    # A POST adds media, so it is only retried when it couldn't connect: one that timed out or got a server
+    # error may still have been processed, and sending it again could add the media twice
+    idempotent: bool = method.upper() in ('GET', 'HEAD')
+
+    def send(attempt: int) -> requests.Response:
+        response: requests.Response = http_client.request(method, url, **kwargs)
+        if idempotent and (response.status_code == 429 or response.status_code >= 500):
+            response.raise_for_status()
+        return response
+
+    retry_on: tuple[type[Exception], ...] = ((requests.exceptions.RequestException,) if idempotent
+                                             else (requests.exceptions.ConnectionError,))
+    return resilience.call_with_retries(url, send, retry_on=retry_on)
 
 
 def get_tvdb_series_id(url: str) -> str:
     try:
-        response: requests.Response = requests.get(url)
+        response: requests.Response = request_with_retries('GET', url)
         html_content: str = response.text
 
         # Parse the HTML content
@@ -94,7 +113,11 @@ def add_to_service(service: str, media_id: str, id_site: str):
         ]
 
     # Perform the request to add the series
-    response: requests.Response = requests.post(request_url, json=media_to_add)
+    try:
+        response: requests.Response = request_with_retries('POST', request_url, json=media_to_add)
+    except requests.exceptions.RequestException as req_err:
+        get_logger().error(f'Error adding {media_id} from {id_site} to {service}: {req_err}')
+        return
     added_media_response: list | dict = response.json()
 
     if isinstance(added_media_response, list):
@@ -105,7 +128,7 @@ def add_to_service(service: str, media_id: str, id_site: str):
 
 def get_json_response(url: str, media_id: str, id_site: str) -> dict:
     try:
-        response = requests.get(url)
+        response = request_with_retries('GET', url)
         if response.status_code == 200:
             response_json = response.json()
             if isinstance(response_json, list):
@@ -118,21 +141,32 @@ def get_json_response(url: str, media_id: str, id_site: str) -> dict:
         get_logger().error(f'Error retrieving data for {media_id} from {id_site}: {req_err}')
 
 
-def process_media_request_emails(email_bodies: list[str]) -> None:
+def process_media_request_emails(email_bodies: list[str]) -> list[float]:
+    # Returns how long each url took, for the load test
     urls: list[str] = email_handler.get_urls(email_bodies)
     get_logger().info(f'Media request url queue size: {len(urls)}')
 
     service: str
     media_id: str
     id_site: str
+    latencies: list[float] = []
     for url in urls:
-        service, media_id, id_site = get_media_components(url)
-
-        if not service or not media_id or not id_site:
-            get_logger().warning(f'No match found for {url}')
+        start_time: float = time.monotonic()
+        try:
+            service, media_id, id_site = get_media_components(url)
+
+            if not service or not media_id or not id_site:
+                get_logger().warning(f'No match found for {url}')
+                continue
+
+            add_to_service(service, media_id, id_site)
+        except resilience.CircuitOpenError as e:
+            # Radarr, Sonarr or thetvdb is down, so hold on to the url until it is back
+            get_logger().warning(f'Deferring {url}: {e}')
+            resilience.defer(url, 'Media Requests', f'https://{e.domain}')
             continue
+        latencies.append(time.monotonic() - start_time)
 
-        add_to_service(service, media_id, id_site)
-
-        time.sleep(1)  # Wait for 1 second before processing the next URL
+        time.sleep(float(os.getenv('MEDIA_REQUEST_DELAY', '1')))  # Wait before processing the next URL
+    return latencies
 
@@ -0,0 +1,105 @@
+import argparse
+import json
+import os
+import random
+import re
+import sys
+import time
+from pathlib import Path
+
+from bs4 import BeautifulSoup
+
+
+# Per-page cost of reading a page without recipe JSON-LD. The old path built the soup, found no recipe and
+# wrote a compressed dump of the page. The heuristic extractor reads the article text in one html.parser pass.
+# Pages are synthetic newspaper columns (a few recipes each, written out in <p> and <h2> tags) or, with
+# --recordings, the pages in a page cache directory.
+
+REPO_ROOT: str = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+INGREDIENTS: list[str] = ['200g plain flour', '2 large eggs', '1 tbsp olive oil', '½ tsp sea salt',
+                          '400g tin chickpeas', '3 garlic cloves, peeled and crushed', '1 ½ tsp ground cumin',
+                          '150ml double cream', 'A small bunch of parsley, chopped', '2 red onions, finely sliced',
+                          '50g butter']
+METHOD: list[str] = ['Heat the oven to 200C (180C fan)/390F/gas 6. Line a baking tray with greaseproof paper.',
+                     'Warm the oil in a large frying pan on a medium heat, then add the onions and fry, stirring '
+                     'every now and then, for 10 minutes, until soft and golden.',
+                     'Tip everything into a bowl, season and leave to cool a little before serving.']
+FILLER: str = ('<div class="related"><ul>' + ''.join(f'<li><a href="/food/{index}">Related article {index}</a></li>'
+                                                     for index in range(40)) + '</ul></div>')
+
+
+def make_column_page(index: int, rng: random.Random) -> str:
+    recipes: list[str] = []
+    for number in range(rng.randint(1, 3)):
+        ingredients: list[str] = rng.sample(INGREDIENTS, rng.randint(4, 8))
+        recipes.append(f'<h2>Recipe {index}-{number}</h2>'
+                       f'<p>Prep {rng.randint(5, 30)} min<br>Cook {rng.randint(10, 90)} min<br>'
+                       f'Serves {rng.randint(2, 8)}</p><p>{"<br>".join(ingredients)}</p>'
+                       + ''.join(f'<p>{step}</p>' for step in METHOD))
+    return (f'<html><head><title>Column {index} | Food | The Guardian</title>'
+            f'<meta property="og:title" content="Column {index}">'
+            '<meta property="og:site_name" content="the Guardian">'
+            f'<meta property="og:image" content="https://i.guim.co.uk/img/{index}.jpg?width=1200">'
+            '<script>window.guardian = {"config": {"page": {}}};</script></head>'
+            f'<body><nav>{FILLER}</nav><h1>Column {index}</h1>'
+            '<div class="article-body-commercial-selector article-body-viewer-selector">'
+            '<p>An introduction to this week\'s recipes, with a few words about the season.</p>'
+            f'{"".join(recipes)}</div>{FILLER}<footer>{FILLER}</footer></body></html>')
+
+
+def get_pages(count: int, recordings_dir: str | None) -> list[tuple[str, str]]:
+    if recordings_dir:
+        from recipes import page_cache
+        pages: list[dict] = [page_cache.load_page(path) for path in Path(recordings_dir).rglob('*.json.gz')]
+        return [(page['url'], page['page_source']) for page in pages[:count]]
+    rng: random.Random = random.Random(1701)
+    return [(f'https://www.theguardian.com/food/column-{index}', make_column_page(index, rng))
+            for index in range(count)]
+
+
+def time_soup_and_dump(pages: list[tuple[str, str]]) -> float:
+    from recipes import page_dumps, site_registry
+    start_time: float = time.perf_counter()
+    for url, page_source in pages:
+        soup: BeautifulSoup = BeautifulSoup(page_source, 'html.parser')
+        script_jsons: list = [tag.string for tag in soup.find_all('script', type='application/ld+json')]
+        parser_name: str = site_registry.get_parser_class(url).__name__
+        dump: dict = page_dumps.build_dump(url, url, parser_name, page_source, script_jsons)
+        page_dumps.compress(json.dumps(dump).encode('utf-8'), page_dumps.get_dump_suffix())
+    return time.perf_counter() - start_time
+
+
+def time_heuristic(pages: list[tuple[str, str]]) -> tuple[float, int]:
+    from recipes import heuristic_extractor, site_registry
+    found: int = 0
+    start_time: float = time.perf_counter()
+    for url, page_source in pages:
+        pattern: re.Pattern | None = site_registry.get_parser_class(url).article_body_pattern
+        found += len(heuristic_extractor.extract_recipes(page_source, pattern)[0])
+    return time.perf_counter() - start_time, found
+
+
+def main() -> int:
+    arg_parser = argparse.ArgumentParser(description='Per-page cost of the heuristic extractor against soup and dump')
+    arg_parser.add_argument('--pages', type=int, default=200)
+    arg_parser.add_argument('--recordings', help='A page cache directory to read pages from')
+    args = arg_parser.parse_args()
+
+    pages: list[tuple[str, str]] = get_pages(args.pages, args.recordings)
+    if not pages:
+        print('No pages to time')
+        return 1
+
+    dump_seconds: float = time_soup_and_dump(pages)
+    heuristic_seconds, found = time_heuristic(pages)
+    print(f'pages: {len(pages)}, average {sum(len(page) for _, page in pages) / len(pages) / 1024:.0f} KB')
+    print(f'soup + dump: {dump_seconds / len(pages) * 1000:.2f} ms/page')
+    print(f'heuristic extractor: {heuristic_seconds / len(pages) * 1000:.2f} ms/page, {found} recipes found '
+          f'({dump_seconds / heuristic_seconds:.1f}x faster)')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
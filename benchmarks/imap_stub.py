@@ -0,0 +1,150 @@
+import argparse
+import re
+import socketserver
+import threading
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from email.message import Message
+
+
+# A plain-text IMAP server holding synthetic emails, with just enough of the protocol for email_handler
+# (LOGIN, SELECT, SEARCH, FETCH of BODYSTRUCTURE, header fields, whole and partial body sections).
+# Search criteria are ignored: every unseen message matches. Connect with IMAP_SSL=false and IMAP_PORT.
+
+FETCH_SECTION_PATTERN: re.Pattern = re.compile(r'BODY(\.PEEK)?\[([^\]]*)\](?:<(\d+)\.(\d+)>)?')
+
+
+def make_email(subject: str, sender: str, urls: list[str]) -> Message:
+    message: MIMEMultipart = MIMEMultipart('alternative')
+    message['Subject'] = subject
+    message['From'] = sender
+    message.attach(MIMEText('\n'.join(urls) + '\n', 'plain', 'utf-8'))
+    message.attach(MIMEText(''.join(f'<p><a href="{url}">{url}</a></p>' for url in urls), 'html', 'utf-8'))
+    return message
+
+
+def get_part_structure(part: Message) -> bytes:
+    payload: bytes = part.get_payload().encode('ascii')
+    return (f'("TEXT" "{part.get_content_subtype().upper()}" ("CHARSET" "{part.get_content_charset()}") NIL NIL '
+            f'"{part["Content-Transfer-Encoding"].upper()}" {len(payload)} {payload.count(b"\n")} NIL NIL NIL NIL)'
+            ).encode('ascii')
+
+
+def get_body_structure(message: Message) -> bytes:
+    if not message.is_multipart():
+        return get_part_structure(message)
+    return (b'(' + b''.join(get_part_structure(part) for part in message.get_payload())
+            + f' "{message.get_content_subtype().upper()}" ("BOUNDARY" "{message.get_boundary()}") NIL NIL NIL)'
+            .encode('ascii'))
+
+
+def get_section(message: Message, section: str) -> bytes:
+    if section == '':
+        return message.as_bytes()
+    if section.startswith('HEADER.FIELDS'):
+        names: list[str] = re.findall(r'[\w-]+', section.removeprefix('HEADER.FIELDS'))
+        return ''.join(f'{name}: {message[name]}\r\n' for name in names if message[name]).encode('utf-8') + b'\r\n'
+
+    part: Message = message
+    for index in section.split('.'):
+        if part.is_multipart():
+            part = part.get_payload()[int(index) - 1]
+    return part.get_payload().encode('ascii')
+
+
+class Mailbox:
+    def __init__(self):
+        self.messages: list[Message] = []
+        self.seen: set[int] = set()
+        self.lock: threading.Lock = threading.Lock()
+
+    def add(self, message: Message) -> None:
+        with self.lock:
+            self.messages.append(message)
+
+    def seed(self, subject: str, sender: str, urls: list[str], urls_per_email: int) -> None:
+        for index in range(0, len(urls), urls_per_email):
+            self.add(make_email(subject, sender, urls[index:index + urls_per_email]))
+
+    def get_unseen_ids(self) -> list[int]:
+        with self.lock:
+            return [number for number in range(1, len(self.messages) + 1) if number not in self.seen]
+
+
+class ImapHandler(socketserver.StreamRequestHandler):
+    server: 'ImapStubServer'
+
+    def handle(self) -> None:
+        self.wfile.write(b'* OK replay IMAP ready\r\n')
+        while line := self.rfile.readline():
+            tag, command, arguments = (line.decode('utf-8').rstrip('\r\n').split(' ', 2) + ['', ''])[:3]
+            command = command.upper()
+            # Each reply is written at once, separate small writes get held up by delayed acks
+            response: bytes = b''
+            if command == 'CAPABILITY':
+                response = b'* CAPABILITY IMAP4rev1\r\n'
+            elif command == 'SELECT':
+                response = f'* {len(self.server.mailbox.messages)} EXISTS\r\n'.encode('ascii')
+            elif command == 'SEARCH':
+                ids: str = ' '.join(str(number) for number in self.server.mailbox.get_unseen_ids())
+                response = f'* SEARCH {ids}\r\n'.encode('ascii')
+            elif command == 'FETCH':
+                response = self.fetch(*arguments.split(' ', 1))
+            elif command == 'LOGOUT':
+                self.wfile.write(f'* BYE\r\n{tag} OK LOGOUT completed\r\n'.encode('ascii'))
+                return
+            elif command not in ('LOGIN', 'CLOSE', 'NOOP'):
+                self.wfile.write(f'{tag} BAD unsupported command\r\n'.encode('ascii'))
+                continue
+            self.wfile.write(response + f'{tag} OK {command} completed\r\n'.encode('ascii'))
+
+    def fetch(self, message_set: str, items: str) -> bytes:
+        mailbox: Mailbox = self.server.mailbox
+        responses: list[bytes] = []
+        for number in (int(number) for number in message_set.split(',')):
+            message: Message = mailbox.messages[number - 1]
+            response: list[bytes] = []
+            if 'BODYSTRUCTURE' in items.upper():
+                response.append(b'BODYSTRUCTURE ' + get_body_structure(message))
+            for peek, section, offset, length in FETCH_SECTION_PATTERN.findall(items):
+                data: bytes = get_section(message, section)
+                name: str = f'BODY[{section}]'
+                if offset:
+                    data = data[int(offset):int(offset) + int(length)]
+                    name += f'<{offset}>'
+                response.append(f'{name} {{{len(data)}}}\r\n'.encode('ascii') + data)
+                if not peek:
+                    with mailbox.lock:
+                        mailbox.seen.add(number)
+            responses.append(f'* {number} FETCH ('.encode('ascii') + b' '.join(response) + b')\r\n')
+        return b''.join(responses)
+
+
+class ImapStubServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, port: int = 0, mailbox: Mailbox | None = None):
+        super().__init__(('127.0.0.1', port), ImapHandler)
+        self.mailbox: Mailbox = mailbox or Mailbox()
+
+
+def main() -> None:
+    arg_parser = argparse.ArgumentParser(description='Serve synthetic recipe and media request emails over IMAP')
+    arg_parser.add_argument('--port', type=int, default=8143)
+    arg_parser.add_argument('--recipe-emails', type=int, default=100)
+    arg_parser.add_argument('--media-emails', type=int, default=20)
+    args = arg_parser.parse_args()
+
+    mailbox: Mailbox = Mailbox()
+    mailbox.seed('Recipes', 'replay@example.com',
+                 [f'http://www.bbcgoodfood.com/recipes/replay-{index}' for index in range(args.recipe_emails)], 1)
+    mailbox.seed('Media Requests', 'replay@example.com',
+                 [f'http://www.themoviedb.org/movie/{index}-replay' for index in range(args.media_emails)], 1)
+    server: ImapStubServer = ImapStubServer(args.port, mailbox)
+    print(f'Serving {len(mailbox.messages)} emails on 127.0.0.1:{server.server_address[1]}')
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
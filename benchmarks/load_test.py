@@ -0,0 +1,235 @@
+import argparse
+import json
+import math
+import multiprocessing
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+from multiprocessing.connection import Connection
+from pathlib import Path
+
+import imap_stub
+import replay_server
+
+
+# End to end load test without real sites, mailbox or *arr services. Synthetic emails are served by the IMAP
+# stand-in, pages and APIs by the replay server (both in their own processes), and the urls are pushed through
+# process_recipe_emails and process_media_request_emails with the politeness delays turned off.
+# Everything is written to a scratch directory, so the real output, database and caches are not touched.
+
+REPO_ROOT: str = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+MEDIA_URL_TEMPLATES: list[str] = ['http://www.themoviedb.org/movie/{index}-replay',
+                                  'http://www.themoviedb.org/tv/{index}-replay',
+                                  'http://www.imdb.com/title/tt{index:07d}/',
+                                  'http://thetvdb.com/series/replay-{index}']
+
+
+def serve_replay(connection: Connection, recordings_dir: str | None, latency: float) -> None:
+    server: replay_server.ReplayServer = replay_server.ReplayServer(
+        0, replay_server.load_recordings(recordings_dir), latency)
+    connection.send(server.server_port)
+    server.serve_forever()
+
+
+def serve_imap(connection: Connection, recipe_urls: list[str], media_urls: list[str], urls_per_email: int) -> None:
+    mailbox: imap_stub.Mailbox = imap_stub.Mailbox()
+    mailbox.seed('Recipes', 'replay@example.com', recipe_urls, urls_per_email)
+    mailbox.seed('Media Requests', 'replay@example.com', media_urls, urls_per_email)
+    server: imap_stub.ImapStubServer = imap_stub.ImapStubServer(0, mailbox)
+    connection.send(server.server_address[1])
+    server.serve_forever()
+
+
+def start_server(target, *args) -> tuple[multiprocessing.Process, int]:
+    receiver, sender = multiprocessing.Pipe(duplex=False)
+    process: multiprocessing.Process = multiprocessing.Process(target=target, args=(sender, *args), daemon=True)
+    process.start()
+    return process, receiver.recv()
+
+
+def get_recipe_urls(count: int, archive_ratio: float, recordings_dir: str | None) -> list[str]:
+    from recipes import site_registry
+
+    # Recorded pages are replayed over plain http, as the replay server can't intercept https
+    urls: list[str] = ['http://' + url.split('://', 1)[-1]
+                       for url in _get_recorded_urls(recordings_dir)][:count]
+    rng: random.Random = random.Random(1701)
+    for index in range(len(urls), count):
+        sites: list[str] = site_registry.get_domains(archived=rng.random() < archive_ratio)
+        urls.append(f'http://www.{rng.choice(sites)}/recipes/replay-{index}')
+    return urls
+
+
+def _get_recorded_urls(recordings_dir: str | None) -> list[str]:
+    if not recordings_dir:
+        return []
+    from recipes import page_cache
+    return [page_cache.load_page(path)['url'] for path in Path(recordings_dir).rglob('*.json.gz')]
+
+
+def get_media_urls(count: int) -> list[str]:
+    return [MEDIA_URL_TEMPLATES[index % len(MEDIA_URL_TEMPLATES)].format(index=index) for index in range(count)]
+
+
+def configure_environment(work_dir: Path, replay_port: int, imap_port: int) -> None:
+    replay_url: str = f'http://127.0.0.1:{replay_port}'
+    os.environ.update({
+        'OUTPUT_FILE': str(work_dir / 'recipes.json'),
+        'IMAGES_DIR': str(work_dir / 'images'),
+        'RECIPES_DB': str(work_dir / 'recipes.db'),
+        'PAGE_CACHE_DIR': str(work_dir / 'page_cache'),
+        'DUMPS_DIR': str(work_dir / 'unprocessed'),
+        'EXPORT_DIR': str(work_dir / 'export'),
+        'RECIPE_KEYS_BLOOM_FILE': str(work_dir / 'recipe_keys.bloom'),
+        'LOG_FILE': str(work_dir / 'load_test.log'),
+        'RESILIENCE_STATE_FILE': str(work_dir / 'resilience_state.json'),
+        'CONSOLE_LOGGING_LEVEL': 'ERROR',
+        'PAGE_FETCH_BACKEND': 'http',
+        'HTTP_PROXY': replay_url,
+        'http_proxy': replay_url,
+        'NO_PROXY': '127.0.0.1,localhost',
+        'no_proxy': '127.0.0.1,localhost',
+        'ARCHIVE_BACKENDS': 'archive_today',
+        'ARCHIVE_TODAY_URL': replay_url,
+        'RECIPE_FETCH_DELAY': '0',
+        'MEDIA_REQUEST_DELAY': '0',
+        'IMAP_SERVER': '127.0.0.1',
+        'IMAP_PORT': str(imap_port),
+        'IMAP_SSL': 'false',
+        'EMAIL_USER': 'loadtest@example.com',
+        'EMAIL_APP_PASSWORD': 'loadtest',
+        'EMAILS_WHITELIST': 'replay@example.com',
+        'EMAIL_SUBJECTS': 'Recipes,Media Requests'
+    })
+    for service in ('RADARR', 'SONARR'):
+        os.environ.update({
+            f'{service}_ADDRESS': replay_url,
+            f'{service}_API_KEY': 'loadtest',
+            f'{service}_FILES': str(work_dir / service.lower()),
+            f'{service}_PROFILE_ID': '1'
+        })
+
+
+def get_percentile(values: list[float], percentile: float) -> float:
+    if not values:
+        return 0.0
+    ordered: list[float] = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(percentile / 100 * len(ordered)) - 1))]
+
+
+def get_stage_report(urls: int, latencies: list[float], duration: float) -> dict:
+    return {
+        'urls': urls,
+        'completed': len(latencies),
+        'seconds': round(duration, 3),
+        'urls_per_second': round(len(latencies) / duration, 2) if duration else 0.0,
+        'p50_seconds': round(get_percentile(latencies, 50), 4),
+        'p99_seconds': round(get_percentile(latencies, 99), 4)
+    }
+
+
+def run_recipe_jobs(email_bodies: list[str], workers_count: int) -> list[float]:
+    # The coordinator/worker mode: queue the urls as jobs, let the workers drain them, then publish once
+    from recipes import recipe_handler, recipe_jobs
+
+    os.environ.update({'JOB_HOST_INTERVAL': '0', 'JOB_POLL_INTERVAL': '0.05'})
+    recipe_handler.prepare_recipe_stores()
+    recipe_jobs.enqueue_recipe_emails(email_bodies)
+    for process in recipe_jobs.start_workers(workers_count, exit_when_idle=True):
+        process.join()
+    while recipe_jobs.publish():
+        pass
+    recipe_handler.release_loaded_recipes()
+    return [row['finished_at'] - row['enqueued_at'] for row in recipe_jobs.get_connection().execute(
+        "SELECT enqueued_at, finished_at FROM recipe_jobs WHERE status = 'done'"
+    )]
+
+
+def run_load_test(args: argparse.Namespace) -> dict:
+    import arr_handler
+    import email_handler
+    from recipes import recipe_handler
+
+    recipe_urls: list[str] = get_recipe_urls(args.recipe_urls, args.archive_ratio, args.recordings)
+    media_urls: list[str] = get_media_urls(args.media_urls)
+
+    work_dir: Path = Path(args.work_dir or tempfile.mkdtemp(prefix='recipes_load_test_'))
+    work_dir.mkdir(parents=True, exist_ok=True)
+    replay_process, replay_port = start_server(serve_replay, args.recordings, args.latency_ms / 1000)
+    imap_process, imap_port = start_server(serve_imap, recipe_urls, media_urls, args.urls_per_email)
+    configure_environment(work_dir, replay_port, imap_port)
+
+    try:
+        start_time: float = time.monotonic()
+        queues: dict[str, list[str]] = email_handler.get_emails_by_subject()
+        read_duration: float = time.monotonic() - start_time
+        email_handler.close_mail_connection()
+
+        start_time = time.monotonic()
+        if args.job_workers:
+            recipe_latencies: list[float] = run_recipe_jobs(queues['Recipes'], args.job_workers)
+        else:
+            recipe_latencies = recipe_handler.process_recipe_emails(queues['Recipes'])
+        recipe_duration: float = time.monotonic() - start_time
+
+        start_time = time.monotonic()
+        media_latencies: list[float] = arr_handler.process_media_request_emails(queues['Media Requests'])
+        media_duration: float = time.monotonic() - start_time
+
+        # Parser workers have exited by now, the servers are still running so aren't counted
+        children_rss_kb: int = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    finally:
+        replay_process.terminate()
+        imap_process.terminate()
+
+    return {
+        'work_dir': str(work_dir),
+        'emails': {'count': sum(len(bodies) for bodies in queues.values()), 'seconds': round(read_duration, 3)},
+        'recipes': get_stage_report(len(recipe_urls), recipe_latencies, recipe_duration),
+        'media_requests': get_stage_report(len(media_urls), media_latencies, media_duration),
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        'peak_worker_rss_mb': round(children_rss_kb / 1024, 1)
+    }
+
+
+def print_report(report: dict) -> None:
+    print(f'emails: {report["emails"]["count"]} read in {report["emails"]["seconds"]:.2f}s')
+    for name in ('recipes', 'media_requests'):
+        stage: dict = report[name]
+        print(f'{name}: {stage["completed"]}/{stage["urls"]} urls in {stage["seconds"]:.2f}s '
+              f'({stage["urls_per_second"]:.1f}/s), p50 {stage["p50_seconds"] * 1000:.1f} ms, '
+              f'p99 {stage["p99_seconds"] * 1000:.1f} ms')
+    print(f'peak RSS: {report["peak_rss_mb"]:.1f} MB (parser workers {report["peak_worker_rss_mb"]:.1f} MB)')
+    print(f'output in {report["work_dir"]}')
+
+
+def main() -> int:
+    arg_parser = argparse.ArgumentParser(description='Offline end to end load test of the email handlers')
+    arg_parser.add_argument('--recipe-urls', type=int, default=1000)
+    arg_parser.add_argument('--media-urls', type=int, default=200)
+    arg_parser.add_argument('--urls-per-email', type=int, default=5)
+    arg_parser.add_argument('--archive-ratio', type=float, default=0.1,
+                            help='Share of recipe urls on sites read through the archive')
+    arg_parser.add_argument('--latency-ms', type=float, default=0.0, help='Delay added to every replayed response')
+    arg_parser.add_argument('--recordings', help='A page cache directory to replay recorded pages from')
+    arg_parser.add_argument('--job-workers', type=int, default=0,
+                            help='Process recipe urls as jobs with this many worker processes')
+    arg_parser.add_argument('--work-dir', help='Where output is written, a new temporary directory by default')
+    arg_parser.add_argument('--json', action='store_true', help='Print the report as JSON')
+    args = arg_parser.parse_args()
+
+    report: dict = run_load_test(args)
+    if args.json:
+        print(json.dumps(report, indent=4))
+    else:
+        print_report(report)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,115 @@
+import argparse
+import gc
+import json
+import os
+import random
+import sys
+import time
+import tracemalloc
+from typing import Callable
+
+# Memory held by the loaded recipe list as plain dicts (json.load) and as Recipe records (shared page data,
+# slots, interned strings), plus the time to load and save each, over a synthetic OUTPUT_FILE.
+
+REPO_ROOT: str = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+SOURCES: list[str] = ['BBC Good Food', 'the Guardian', 'RecipeTin Eats', 'Love and Lemons', 'Waitrose',
+                      'Jamie Oliver', 'King Arthur Baking', 'Pinch of Yum', 'EatingWell', 'Tesco Real Food']
+AUTHORS: list[str] = ['Yotam Ottolenghi', 'Nigel Slater', 'Meera Sodha', 'Felicity Cloake', 'Nagi Maehashi',
+                      'Jeanine Donofrio', 'Anna Jones', 'Thomasina Miers']
+INGREDIENTS: list[str] = ['200g plain flour', '2 large eggs', '1 tbsp olive oil', '½ tsp sea salt',
+                          '400g tin chickpeas', '3 garlic cloves, crushed', '1 ½ tsp ground cumin',
+                          '150ml double cream', 'A small bunch of parsley, chopped', '2 red onions, sliced',
+                          '50g butter', '1 lemon, zested and juiced', '300g basmati rice', '1 tsp chilli flakes']
+STEPS: list[str] = ['Heat the oven to 200C (180C fan)/390F/gas 6.',
+                    'Warm the oil in a large frying pan and fry the onions for 10 minutes, until soft.',
+                    'Stir in the spices and garlic, cook for a minute more, then add the chickpeas.',
+                    'Season, scatter over the parsley and serve with the lemon on the side.']
+
+
+def make_recipes(count: int) -> list[dict]:
+    rng: random.Random = random.Random(1701)
+    recipes: list[dict] = []
+    page: int = 0
+    while len(recipes) < count:
+        page += 1
+        source: str = rng.choice(SOURCES)
+        page_author: str = rng.choice(AUTHORS)
+        base_data: dict = {
+            'source': source,
+            'url': f'https://www.{source.lower().replace(" ", "")}.com/recipes/page-{page}',
+            'author': page_author,
+            'published_date': f'2024-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}T06:00:00+00:00',
+            'article_title': f'Recipes for week {page}',
+            'image': f'https://images.example.com/{page}.jpg?width=1200'
+        }
+        for number in range(rng.randint(1, 3)):
+            image_path: str = f'{source}/Recipe {page}-{number}-1200.webp'
+            recipes.append({
+                **base_data,
+                'author': page_author,
+                'image': image_path,
+                'recipe_name': f'Recipe {page}-{number}',
+                'description': f'A quick supper for week {page}, ready in under an hour.',
+                'ingredients': rng.sample(INGREDIENTS, rng.randint(6, 12)),
+                'instructions': [{'@type': 'HowToStep', 'text': step} for step in STEPS],
+                'recipe_yield': str(rng.randint(2, 6)),
+                'prep_time': f'PT{rng.choice((10, 15, 20))}M',
+                'cook_time': f'PT{rng.choice((20, 30, 45))}M',
+                'total_time': f'PT{rng.choice((30, 45, 60))}M',
+                'image_url': f'https://images.example.com/{page}-{number}.jpg?width=1200',
+                'image_variants': [{'path': image_path, 'width': 1200, 'height': 800, 'bytes': 80000,
+                                    'format': 'webp'}]
+            })
+            # Not every recipe on a page has every field, which the round trip has to keep
+            for name in ('author', 'image', 'image_url', 'image_variants', 'description'):
+                if rng.random() < 0.1:
+                    del recipes[-1][name]
+    return recipes[:count]
+
+
+def measure(load: Callable[[], list]) -> tuple[list, int, float]:
+    gc.collect()
+    tracemalloc.start()
+    start_time: float = time.perf_counter()
+    recipes: list = load()
+    duration: float = time.perf_counter() - start_time
+    gc.collect()
+    current_bytes, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return recipes, current_bytes, duration
+
+
+def main() -> int:
+    from recipes import recipe_record
+
+    arg_parser = argparse.ArgumentParser(description='Memory of recipe dicts against Recipe records')
+    arg_parser.add_argument('--recipes', type=int, default=20000)
+    args = arg_parser.parse_args()
+
+    text: str = json.dumps(make_recipes(args.recipes), indent=4)
+
+    dicts, dict_bytes, dict_load = measure(lambda: json.loads(text))
+    start_time: float = time.perf_counter()
+    json.dumps(dicts, indent=4)
+    dict_save: float = time.perf_counter() - start_time
+    del dicts
+
+    records, record_bytes, record_load = measure(lambda: recipe_record.load_recipes(json.loads(text)))
+    start_time = time.perf_counter()
+    saved: str = json.dumps(records, indent=4, default=recipe_record.to_json)
+    record_save: float = time.perf_counter() - start_time
+
+    print(f'recipes: {len(records)}, OUTPUT_FILE {len(text) / 1024 / 1024:.1f} MB')
+    print(f'dicts: {dict_bytes / 1024 / 1024:.1f} MB ({dict_bytes / len(records):.0f} bytes/recipe), '
+          f'load {dict_load * 1000:.0f} ms, save {dict_save * 1000:.0f} ms')
+    print(f'records: {record_bytes / 1024 / 1024:.1f} MB ({record_bytes / len(records):.0f} bytes/recipe), '
+          f'load {record_load * 1000:.0f} ms, save {record_save * 1000:.0f} ms')
+    print(f'saving: {1 - record_bytes / dict_bytes:.0%}, round trip '
+          f'{"identical" if json.loads(saved) == json.loads(text) else "DIFFERS"}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
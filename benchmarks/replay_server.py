@@ -0,0 +1,173 @@
+import argparse
+import gzip
+import hashlib
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, unquote, urlsplit
+
+
+# Stands in for the recipe sites, archive.ph, thetvdb and Radarr/Sonarr during the load test. Recipe sites and
+# thetvdb are reached through the server as an HTTP proxy (HTTP_PROXY), while the archive and *arr APIs are
+# pointed at it directly with ARCHIVE_TODAY_URL, RADARR_ADDRESS and SONARR_ADDRESS. Recorded pages from the
+# page cache are replayed when given, otherwise a recipe page is generated from the url.
+
+INGREDIENTS: list[str] = ['onion', 'garlic', 'carrot', 'celery', 'tomato', 'chickpeas', 'lentils', 'spinach',
+                          'potato', 'leek', 'mushroom', 'pepper', 'courgette', 'aubergine', 'rice', 'pasta',
+                          'chicken thigh', 'salmon', 'tofu', 'feta', 'lemon', 'ginger', 'chilli', 'coriander',
+                          'parsley', 'cumin', 'paprika', 'butter', 'olive oil', 'stock', 'cream', 'yoghurt']
+METHOD_WORDS: list[str] = ['stir', 'fry', 'simmer', 'roast', 'chop', 'season', 'boil', 'drain', 'whisk', 'fold',
+                           'the', 'until', 'golden', 'soft', 'pan', 'oven', 'minutes', 'gently', 'heat', 'serve']
+IMAGE_BYTES: bytes = bytes.fromhex('89504e470d0a1a0a0000000d49484452000000100000000c0802000000e485aad6000000174944415478'
+                                   'da63dc5261c3400a606220118c6a18291a0056910180d2c80a1d0000000049454e44ae426082')
+
+
+def load_recordings(recordings_dir: str | None) -> dict[str, str]:
+    # Page cache snapshots, keyed by host and path so http and https urls replay the same page
+    recordings: dict[str, str] = {}
+    if not recordings_dir:
+        return recordings
+    for path in Path(recordings_dir).rglob('*.json.gz'):
+        with gzip.open(path, 'rt', encoding='utf-8') as file:
+            snapshot: dict = json.load(file)
+        recordings[get_page_key(snapshot['url'])] = snapshot['page_source']
+    return recordings
+
+
+def get_page_key(url: str) -> str:
+    parts = urlsplit(url)
+    return f'{parts.netloc.lower().removeprefix("www.")}{parts.path.rstrip("/")}'
+
+
+def get_seed(text: str) -> int:
+    return int.from_bytes(hashlib.sha1(text.encode('utf-8')).digest()[:8], 'little')
+
+
+def make_recipe_page(url: str) -> str:
+    rng: random.Random = random.Random(get_seed(url))
+    host: str = urlsplit(url).netloc
+    name: str = f'Replay recipe {get_seed(url) % 1000000}'
+    recipe: dict = {
+        '@type': 'Recipe',
+        'name': name,
+        'author': {'@type': 'Person', 'name': 'Replay Author'},
+        'description': f'A generated recipe for {url}',
+        'image': f'http://{host}/images/{get_seed(url) % 1000000}.jpg',
+        'recipeIngredient': [f'{rng.randint(1, 500)}g {ingredient}'
+                             for ingredient in rng.sample(INGREDIENTS, rng.randint(5, 12))],
+        'recipeInstructions': [{'@type': 'HowToStep', 'text': ' '.join(rng.choices(METHOD_WORDS, k=25))}
+                               for _ in range(rng.randint(3, 8))],
+        'recipeYield': str(rng.randint(2, 8)),
+        'prepTime': f'PT{rng.randint(5, 40)}M',
+        'cookTime': f'PT{rng.randint(10, 120)}M',
+        'datePublished': '2024-01-01'
+    }
+    page_data: list[dict] = [{'@type': 'Organization', 'name': host}, recipe]
+    filler: str = ''.join(f'<p>{" ".join(rng.choices(METHOD_WORDS, k=40))}</p>' for _ in range(40))
+    return (f'<html><head><title>{name}</title><script type="application/ld+json">{json.dumps(page_data)}'
+            f'</script></head><body><h1>{name}</h1>{filler}</body></html>')
+
+
+class ReplayHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately, so without this a kept-alive connection waits on delayed ACKs
+    disable_nagle_algorithm = True
+    server: 'ReplayServer'
+
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+    def send_body(self, body: bytes, content_type: str, status: int = 200) -> None:
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_json(self, data: dict | list, status: int = 200) -> None:
+        self.send_body(json.dumps(data).encode('utf-8'), 'application/json', status)
+
+    def send_page(self, url: str) -> None:
+        page_source: str = self.server.recordings.get(get_page_key(url)) or make_recipe_page(url)
+        self.send_body(page_source.encode('utf-8'), 'text/html; charset=utf-8')
+
+    def do_GET(self) -> None:
+        self.server.count_request()
+        parts = urlsplit(self.path)
+        host: str = parts.netloc.lower().removeprefix('www.')
+        if host in self.server.local_hosts:
+            host = ''
+        path: str = parts.path
+        query: dict[str, list[str]] = parse_qs(parts.query)
+
+        if path.endswith(('.jpg', '.jpeg', '.png', '.webp')):
+            self.send_body(IMAGE_BYTES, 'image/png')
+        elif host == 'thetvdb.com':
+            self.send_body(f'<a class="btn btn-success favorite_button" data-id="{get_seed(path) % 100000}">'
+                           f'</a>'.encode('utf-8'), 'text/html')
+        elif host:
+            self.send_page(self.path)
+        elif path.startswith('/timemap/'):
+            url: str = unquote(path.removeprefix('/timemap/'))
+            timemap: str = (f'<{url}>; rel="original",\n'
+                            f'<http://{self.headers["Host"]}/snapshot/{url}>; rel="last memento"; '
+                            f'datetime="Mon, 01 Jan 2024 00:00:00 GMT"\n')
+            self.send_body(timemap.encode('utf-8'), 'application/link-format')
+        elif path.startswith('/snapshot/'):
+            self.send_page(unquote(path.removeprefix('/snapshot/')))
+        elif path.startswith('/api/v3/movie/lookup/'):
+            media_id: str = next(iter(value[0] for key, value in query.items() if key.endswith('id')), '0')
+            self.send_json({'title': f'Replay movie {media_id}', 'titleSlug': f'replay-movie-{media_id}',
+                            'images': [], 'tmdbId': get_seed(media_id) % 1000000, 'year': 2024})
+        elif path == '/api/v3/series/lookup':
+            term: str = query.get('term', ['tvdb:0'])[0]
+            self.send_json([{'title': f'Replay series {term}', 'titleSlug': f'replay-series-{get_seed(term)}',
+                             'images': [], 'tvdbId': get_seed(term) % 1000000, 'year': 2024,
+                             'seasons': [{'seasonNumber': number} for number in range(1, 4)]}])
+        else:
+            self.send_json({'message': 'Not found'}, 404)
+
+    def do_POST(self) -> None:
+        self.server.count_request()
+        body: dict = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        if urlsplit(self.path).path in ('/api/v3/movie', '/api/v3/series'):
+            self.send_json({'id': get_seed(body.get('titleSlug', '')) % 100000, 'title': body.get('title')}, 201)
+        else:
+            self.send_json({'message': 'Not found'}, 404)
+
+
+class ReplayServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port: int = 0, recordings: dict[str, str] | None = None, latency: float = 0.0):
+        super().__init__(('127.0.0.1', port), ReplayHandler)
+        self.recordings: dict[str, str] = recordings or {}
+        self.latency: float = latency
+        self.local_hosts: set[str] = {f'127.0.0.1:{self.server_port}', f'localhost:{self.server_port}'}
+        self.requests: int = 0
+        self.lock: threading.Lock = threading.Lock()
+
+    def count_request(self) -> None:
+        with self.lock:
+            self.requests += 1
+
+
+def main() -> None:
+    arg_parser = argparse.ArgumentParser(description='Replay recipe sites, archive.ph and *arr APIs locally')
+    arg_parser.add_argument('--port', type=int, default=8750)
+    arg_parser.add_argument('--recordings', help='A page cache directory to replay pages from')
+    arg_parser.add_argument('--latency-ms', type=float, default=0.0, help='Delay added to every response')
+    args = arg_parser.parse_args()
+
+    server: ReplayServer = ReplayServer(args.port, load_recordings(args.recordings), args.latency_ms / 1000)
+    print(f'Replaying on http://127.0.0.1:{server.server_port}')
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+import argparse
+import os
+import subprocess
+import sys
+
+
+# Guards the cold start of the email poller: importing main must stay cheap and must not pull in the
+# browser stack, parsers or *arr client, which are only loaded once a queue has mail for them.
+
+REPO_ROOT: str = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY_MODULES: list[str] = ['selenium', 'bs4', 'requests', 'waybackpy', 'arr_handler', 'web_requests',
+                            'recipes.recipe_handler', 'recipes.recipe_parsers']
+
+RSS_SCRIPT: str = '''
+import resource
+import main
+print(f'max_rss_kb={resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}')
+'''
+
+
+def run_python(*args: str) -> subprocess.CompletedProcess:
+    return subprocess.run([sys.executable, *args], cwd=REPO_ROOT, capture_output=True, text=True, check=True)
+
+
+def parse_import_times(importtime_output: str) -> dict[str, tuple[int, int]]:
+    # Lines look like: "import time:       157 |        157 |   _io"
+    import_times: dict[str, tuple[int, int]] = {}
+    for line in importtime_output.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, module = line.removeprefix('import time:').split('|')
+        import_times[module.strip()] = (int(self_us), int(cumulative_us))
+    return import_times
+
+
+def get_import_time_ms(repeats: int) -> tuple[float, set[str]]:
+    best_ms: float | None = None
+    loaded_modules: set[str] = set()
+    for _ in range(repeats):
+        result: subprocess.CompletedProcess = run_python('-X', 'importtime', '-c', 'import main')
+        import_times: dict[str, tuple[int, int]] = parse_import_times(result.stderr)
+        total_ms: float = import_times.get('main', (0, 0))[1] / 1000
+        best_ms = total_ms if best_ms is None else min(best_ms, total_ms)
+        loaded_modules = set(import_times)
+    return best_ms or 0.0, loaded_modules
+
+
+def get_idle_rss_mb() -> float:
+    result: subprocess.CompletedProcess = run_python('-c', RSS_SCRIPT)
+    # The atexit handlers also print, so pick out our own line
+    rss_line: str = next(line for line in result.stdout.splitlines() if line.startswith('max_rss_kb='))
+    max_rss_kb: int = int(rss_line.removeprefix('max_rss_kb='))
+    return max_rss_kb / 1024
+
+
+def main() -> int:
+    arg_parser = argparse.ArgumentParser(description='Cold start import time and idle memory of the poller')
+    arg_parser.add_argument('--max-import-ms', type=float, default=float(os.getenv('MAX_IMPORT_MS', '150')))
+    arg_parser.add_argument('--max-rss-mb', type=float, default=float(os.getenv('MAX_IDLE_RSS_MB', '30')))
+    arg_parser.add_argument('--repeats', type=int, default=5)
+    args = arg_parser.parse_args()
+
+    import_ms, loaded_modules = get_import_time_ms(args.repeats)
+    rss_mb: float = get_idle_rss_mb()
+    eager_modules: list[str] = [module for module in HEAVY_MODULES if module in loaded_modules]
+
+    print(f'import main: {import_ms:.1f} ms (limit {args.max_import_ms:.0f} ms)')
+    print(f'idle RSS: {rss_mb:.1f} MB (limit {args.max_rss_mb:.0f} MB)')
+    if eager_modules:
+        print(f'heavy modules imported at startup: {", ".join(eager_modules)}')
+
+    failed: bool = import_ms > args.max_import_ms or rss_mb > args.max_rss_mb or bool(eager_modules)
+    print('FAIL' if failed else 'OK')
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,183 @@
+import importlib
+import json
+import os
+import queue
+import re
+import threading
+import time
+from typing import Callable
+
+from logger import get_logger
+
+
+# Each subject gets its own bounded queue and worker threads, so a slow batch for one subject (archive saves
+# for recipes) never delays another (a Radarr add). Handlers are given as 'module:function' paths and only
+# imported by the worker when the first batch for that subject arrives.
+
+class SubjectWorker:
+    def __init__(self, subject: str, handler: str | Callable[[list[str]], None], workers: int = 1,
+                 timeout: float = 3600, queue_size: int = 4):
+        self.subject: str = subject
+        self.handler: str | Callable[[list[str]], None] = handler
+        self.timeout: float = timeout
+        self.batches: queue.Queue = queue.Queue(maxsize=queue_size)
+        self.lock: threading.Lock = threading.Lock()
+        self.running: dict[int, float] = {}
+        self.timed_out: set[int] = set()
+        self.processed: int = 0
+        self.failed: int = 0
+        self.last_duration: float = 0.0
+        self.threads: list[threading.Thread] = [
+            threading.Thread(target=self._run, name=f'{subject} worker {index + 1}', daemon=True)
+            for index in range(workers)
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def get_handler(self) -> Callable[[list[str]], None]:
+        with self.lock:
+            if isinstance(self.handler, str):
+                module_name, function_name = self.handler.split(':')
+                self.handler = getattr(importlib.import_module(module_name), function_name)
+            return self.handler
+
+    def submit(self, emails: list[str]) -> bool:
+        try:
+            self.batches.put_nowait(emails)
+            return True
+        except queue.Full:
+            return False
+
+    def _run(self) -> None:
+        while True:
+            emails: list[str] | None = self.batches.get()
+            if emails is None:
+                return
+
+            start_time: float = time.monotonic()
+            with self.lock:
+                self.running[threading.get_ident()] = start_time
+            succeeded: bool = False
+            try:
+                self.get_handler()(emails)
+                succeeded = True
+            except Exception as e:
+                get_logger().error(f'Unexpected error processing "{self.subject}" emails: {e}')
+            finally:
+                with self.lock:
+                    self.processed += succeeded
+                    self.failed += not succeeded
+                    self.last_duration = time.monotonic() - start_time
+                    self.running.pop(threading.get_ident(), None)
+                    self.timed_out.discard(threading.get_ident())
+                self.batches.task_done()
+                for hook in batch_hooks:
+                    hook(self.subject, len(emails), self.last_duration)
+
+    def check_timeouts(self) -> None:
+        # Threads can't be cancelled, so an overrunning batch is reported once and keeps its worker busy
+        now: float = time.monotonic()
+        with self.lock:
+            for thread_id, start_time in self.running.items():
+                if now - start_time > self.timeout and thread_id not in self.timed_out:
+                    self.timed_out.add(thread_id)
+                    get_logger().error(f'"{self.subject}" batch has been running for {now - start_time:.0f}s, '
+                                       f'over its {self.timeout:.0f}s timeout')
+
+    def is_idle(self) -> bool:
+        with self.lock:
+            return self.batches.unfinished_tasks == 0 and not self.running
+
+    def get_status(self) -> dict:
+        with self.lock:
+            return {
+                'queued': self.batches.qsize(),
+                'running': len(self.running),
+                'timed_out': len(self.timed_out),
+                'processed': self.processed,
+                'failed': self.failed,
+                'last_duration': round(self.last_duration, 3)
+            }
+
+    def stop(self) -> None:
+        for _ in self.threads:
+            self.batches.put(None)
+
+
+workers: dict[str, SubjectWorker] = {}
+dispatch_lock: threading.Lock = threading.Lock()
+batch_hooks: list[Callable[[str, int, float], None]] = []
+
+
+def get_subject_key(subject: str) -> str:
+    return re.sub(r'\W+', '_', subject).strip('_').upper()
+
+
+def register_handler(subject: str, handler: str | Callable[[list[str]], None], workers_count: int = 1,
+                     timeout: float = 3600, queue_size: int = 4, max_workers: int | None = None) -> None:
+    # Limits can be overridden per subject, e.g. MEDIA_REQUESTS_WORKERS=2 or RECIPES_TIMEOUT=7200.
+    # Handlers that aren't thread safe are registered with max_workers=1, which the override can't raise
+    subject_key: str = get_subject_key(subject)
+    workers_count = int(os.getenv(f'{subject_key}_WORKERS', workers_count))
+    if max_workers is not None and workers_count > max_workers:
+        get_logger().warning(f'{subject_key}_WORKERS={workers_count} ignored, "{subject}" is limited to {max_workers}')
+        workers_count = max_workers
+    if subject in workers:
+        workers[subject].stop()
+    workers[subject] = SubjectWorker(
+        subject,
+        handler,
+        workers_count,
+        float(os.getenv(f'{subject_key}_TIMEOUT', timeout)),
+        int(os.getenv(f'{subject_key}_QUEUE_SIZE', queue_size))
+    )
+
+
+def register_handlers_from_env() -> None:
+    # EMAIL_SUBJECT_HANDLERS="Subject=module:function;Other subject=module:function"
+    handlers_config: str = os.getenv('EMAIL_SUBJECT_HANDLERS', '')
+    for entry in handlers_config.split(';'):
+        if '=' in entry:
+            subject, handler = entry.split('=', 1)
+            register_handler(subject.strip(), handler.strip())
+
+
+def dispatch(queues: dict[str, list[str]]) -> None:
+    with dispatch_lock:
+        _dispatch(queues)
+    check_timeouts()
+
+
+def _dispatch(queues: dict[str, list[str]]) -> None:
+    for subject, emails in queues.items():
+        if not emails:
+            continue
+
+        worker: SubjectWorker | None = workers.get(subject)
+        if worker is None:
+            get_logger().warning(f'No processing logic for emails with subject: {subject}' +
+                                 f'\nEmails: {json.dumps(emails, indent=4)}')
+            emails.clear()
+        elif worker.submit(list(emails)):
+            emails.clear()
+        else:
+            get_logger().warning(f'"{subject}" queue is full, keeping {len(emails)} emails for the next check')
+
+
+def check_timeouts() -> None:
+    for worker in workers.values():
+        worker.check_timeouts()
+
+
+def is_idle() -> bool:
+    return all(worker.is_idle() for worker in workers.values())
+
+
+def wait_until_idle(poll_interval: float = 1) -> None:
+    while not is_idle():
+        check_timeouts()
+        time.sleep(poll_interval)
+
+
+def get_status() -> dict[str, dict]:
+    return {subject: worker.get_status() for subject, worker in workers.items()}
@@ -1,14 +1,17 @@
 import atexit
+import base64
+import codecs
 from email import message, message_from_bytes
 from email.header import decode_header
 import imaplib
 import os
+import quopri
 import re
 
 from logger import get_logger
 
 
-mail: imaplib.IMAP4_SSL | None = None
+mail: imaplib.IMAP4 | None = None
 
 
 @atexit.register
@@ -33,10 +36,15 @@ def assign_mail_instance() -> None:
     mail = connect_to_imap_server()
 
 
-def connect_to_imap_server() -> imaplib.IMAP4_SSL:
+def connect_to_imap_server() -> imaplib.IMAP4:
     imap_url: str = os.getenv('IMAP_SERVER')
     try:
-        mail_instance: imaplib.IMAP4_SSL = imaplib.IMAP4_SSL(imap_url)
+        mail_instance: imaplib.IMAP4
+        if os.getenv('IMAP_SSL', 'true') == 'true':
+            mail_instance = imaplib.IMAP4_SSL(imap_url, int(os.getenv('IMAP_PORT', imaplib.IMAP4_SSL_PORT)))
+        else:
+            # Only for local servers, such as the load test stand-in
+            mail_instance = imaplib.IMAP4(imap_url, int(os.getenv('IMAP_PORT', imaplib.IMAP4_PORT)))
         mail_instance.login(os.getenv('EMAIL_USER'), os.getenv('EMAIL_APP_PASSWORD'))
         mail_instance.select('inbox')  # Connect to the inbox.
         return mail_instance
@@ -63,10 +71,189 @@ def get_body(email_data: message.Message) -> str:
     return ''
 
 
+def _read_imap_atom(data: bytes, index: int) -> tuple[bytes, int]:
+    # Atoms such as BODY[HEADER.FIELDS (SUBJECT)] may contain spaces and brackets within [...]
+    start: int = index
+    depth: int = 0
+    while index < len(data):
+        char: bytes = data[index:index + 1]
+        if char == b'[':
+            depth += 1
+        elif char == b']':
+            depth -= 1
+        elif depth == 0 and char in b' ()':
+            break
+        index += 1
+    return data[start:index], index
+
+
+def parse_imap_list(data: bytes) -> list:
+    stack: list[list] = [[]]
+    index: int = 0
+    while index < len(data):
+        char: bytes = data[index:index + 1]
+        if char in b' \r\n':
+            index += 1
+        elif char == b'(':
+            stack.append([])
+            index += 1
+        elif char == b')':
+            items: list = stack.pop()
+            stack[-1].append(items)
+            index += 1
+        elif char == b'"':
+            end: int = index + 1
+            value: bytearray = bytearray()
+            while end < len(data) and data[end:end + 1] != b'"':
+                if data[end:end + 1] == b'\\':
+                    end += 1
+                value += data[end:end + 1]
+                end += 1
+            stack[-1].append(bytes(value))
+            index = end + 1
+        elif char == b'{':
+            end = data.index(b'}', index)
+            size: int = int(data[index + 1:end])
+            stack[-1].append(data[end + 1:end + 1 + size])
+            index = end + 1 + size
+        else:
+            atom, index = _read_imap_atom(data, index)
+            stack[-1].append(None if atom.upper() == b'NIL' else atom)
+    return stack[0]
+
+
+def get_fetch_response_bytes(msg_data: list) -> bytes:
+    # imaplib splits literals out into (line, literal) tuples, join them back into one stream
+    response: bytes = b''
+    for item in msg_data:
+        if isinstance(item, tuple):
+            response += item[0] + item[1]
+        elif isinstance(item, bytes):
+            response += item
+    return response
+
+
+def get_fetch_items(msg_data: list) -> dict[bytes, object]:
+    parsed: list = parse_imap_list(get_fetch_response_bytes(msg_data))
+    fetch_items: list = next((item for item in parsed if isinstance(item, list)), [])
+    return {fetch_items[index].upper(): fetch_items[index + 1] for index in range(0, len(fetch_items) - 1, 2)}
+
+
+def _get_param(params: list | None, name: str) -> str:
+    if not params:
+        return ''
+    values: dict[str, str] = {params[index].decode().lower(): (params[index + 1] or b'').decode()
+                              for index in range(0, len(params) - 1, 2)}
+    return values.get(name, '')
+
+
+def find_text_parts(structure: list, section: str = '') -> list[tuple[str, str, str]]:
+    # Returns (section, transfer encoding, charset) for every non-attachment text/plain part
+    if structure and isinstance(structure[0], list):
+        children: list[list] = [part for part in structure if isinstance(part, list)]
+        return [text_part for index, child in enumerate(children, start=1)
+                for text_part in find_text_parts(child, f'{section}.{index}' if section else str(index))]
+
+    content_type: str = f'{(structure[0] or b"").decode()}/{(structure[1] or b"").decode()}'.lower()
+    part_section: str = section or '1'
+    if content_type == 'message/rfc822' and len(structure) > 8 and isinstance(structure[8], list):
+        # A multipart body's parts number on from this section, a single part body is section .1
+        body: list = structure[8]
+        return find_text_parts(body, part_section if body and isinstance(body[0], list) else f'{part_section}.1')
+    if content_type != 'text/plain':
+        return []
+
+    disposition: list | None = structure[9] if len(structure) > 9 and isinstance(structure[9], list) else None
+    if disposition and (disposition[0] or b'').lower() == b'attachment':
+        return []
+
+    encoding: str = (structure[5] or b'7bit').decode().lower()
+    charset: str = _get_param(structure[2], 'charset') or 'utf-8'
+    return [(part_section, encoding, charset)]
+
+
+def _decode_transfer_chunk(chunk: bytes, encoding: str, final: bool) -> tuple[bytes, bytes]:
+    # Returns the decoded bytes and the undecodable remainder to carry over to the next chunk
+    if encoding == 'base64':
+        compact: bytes = b''.join(chunk.split())
+        usable: int = len(compact) if final else len(compact) - len(compact) % 4
+        return base64.b64decode(compact[:usable]), compact[usable:]
+    if encoding == 'quoted-printable':
+        usable = len(chunk) if final else chunk.rfind(b'\n') + 1
+        return quopri.decodestring(chunk[:usable]), chunk[usable:]
+    return chunk, b''
+
+
+def get_body_item() -> str:
+    # A BODY fetch marks the message as read, BODY.PEEK leaves it unread
+    return 'BODY' if os.getenv('MARK_AS_READ') == 'true' else 'BODY.PEEK'
+
+
+def fetch_part_text(email_id: str, section: str, encoding: str, charset: str) -> str:
+    chunk_size: int = int(os.getenv('EMAIL_FETCH_CHUNK_SIZE', '65536'))
+    body_item: str = get_body_item()
+    try:
+        decoder: codecs.IncrementalDecoder = codecs.getincrementaldecoder(charset)(errors='replace')
+    except LookupError:
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+
+    text: list[str] = []
+    remainder: bytes = b''
+    offset: int = 0
+    while True:
+        status, msg_data = mail.fetch(email_id, f'({body_item}[{section}]<{offset}.{chunk_size}>)')
+        if status != 'OK':
+            raise imaplib.IMAP4.error(f'Failed to fetch part {section} of email ID: {email_id}')
+
+        chunk: bytes = next((value for key, value in get_fetch_items(msg_data).items()
+                             if key.startswith(b'BODY[')), None) or b''
+        final: bool = len(chunk) < chunk_size
+        decoded, remainder = _decode_transfer_chunk(remainder + chunk, encoding, final)
+        text.append(decoder.decode(decoded, final=final))
+        if final:
+            return ''.join(text)
+        offset += chunk_size
+
+
+def get_email_details_by_parts(email_id: bytes) -> tuple[str, str] | None:
+    # Fetch only the subject and the text/plain parts, so attachments and html parts are never downloaded
+    email_id_str: str = email_id.decode('utf-8')
+    # The header fetch marks the message as read too, as one without a text/plain part has no other fetch
+    status, msg_data = mail.fetch(email_id_str, f'(BODYSTRUCTURE {get_body_item()}[HEADER.FIELDS (SUBJECT)])')
+    if status != 'OK':
+        return None
+
+    fetch_items: dict[bytes, object] = get_fetch_items(msg_data)
+    structure: list | None = fetch_items.get(b'BODYSTRUCTURE')
+    header: bytes | None = next((value for key, value in fetch_items.items() if key.startswith(b'BODY[')), None)
+    if not isinstance(structure, list) or header is None:
+        return None
+
+    subject_header: str = message_from_bytes(header).get('Subject', '')
+    subject, encoding = decode_header(subject_header)[0] if subject_header else ('', None)
+    if isinstance(subject, bytes):
+        subject = subject.decode(encoding if encoding else "utf-8")
+
+    body: str = ''.join(fetch_part_text(email_id_str, section, transfer_encoding, charset)
+                        for section, transfer_encoding, charset in find_text_parts(structure))
+    return subject, body
+
+
 def get_email_details(email_ids: list[bytes]) -> list[tuple[bytes, str, str]]:
     emails: list[tuple[bytes, str, str]] = []
     for email_id in email_ids:
-        read_style: str = '(BODY[])' if os.getenv('MARK_AS_READ') == 'true' else '(BODY.PEEK[])'
+        try:
+            details: tuple[str, str] | None = get_email_details_by_parts(email_id)
+        except (imaplib.IMAP4.error, ValueError, IndexError, AttributeError, UnicodeDecodeError) as e:
+            get_logger().warning(f'Could not fetch email ID {email_id} by parts, fetching whole message: {e}')
+            details = None
+
+        if details is not None:
+            subject, body = details
+            emails.append((email_id, subject, body))
+            continue
+
+        read_style: str = f'({get_body_item()}[])'
         status: str
         msg_data: list[tuple[bytes, bytes]]
         subject: str
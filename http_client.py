@@ -0,0 +1,301 @@
+import os
+import socket
+import threading
+import time
+from typing import Callable
+
+import requests
+import urllib3
+import urllib3.util.connection
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.exceptions import ConnectTimeoutError, NewConnectionError
+from requests.structures import CaseInsensitiveDict
+
+from logger import get_logger
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+try:
+    import brotli
+except ImportError:
+    try:
+        import brotlicffi as brotli
+    except ImportError:
+        brotli = None
+
+
+# The one client for every non-browser request (pages over http, archive lookups, images, feeds, refresh
+# checks and the *arr APIs). A session per process keeps a pool of connections per host (HTTP_POOL_HOSTS
+# hosts, HTTP_POOL_SIZE connections each) alive between requests, so repeated hosts skip the TCP and TLS
+# setup, and the session's host lookups are cached for HTTP_DNS_CACHE_SECONDS. Responses are gzip or deflate compressed,
+# or brotli when brotli is installed. Requests without a timeout get (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT).
+# With HTTP2=true and httpx (with h2) installed, requests go over HTTP/2 where the server offers it, converted
+# back to requests responses and exceptions so callers don't change. Streamed downloads stay on the session.
+# Every request is timed into get_metrics() per host and passed to the timing_hooks.
+
+user_agent: str = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/83.0.4103.53 Safari/537.36'
+
+
+class HostStats:
+    def __init__(self):
+        self.requests: int = 0
+        self.errors: int = 0
+        self.seconds: float = 0.0
+        self.max_seconds: float = 0.0
+
+    def get_metrics(self) -> dict:
+        return {
+            'requests': self.requests,
+            'errors': self.errors,
+            'average_ms': round(self.seconds / self.requests * 1000, 1) if self.requests else 0.0,
+            'max_ms': round(self.max_seconds * 1000, 1)
+        }
+
+
+# Called after every request with the method, url, status code (None when it failed) and seconds taken
+timing_hooks: list[Callable[[str, str, int | None, float], None]] = []
+
+session: requests.Session | None = None
+http2_client: 'httpx.Client | None' = None
+client_pid: int | None = None
+client_lock: threading.Lock = threading.Lock()
+host_stats: dict[str, HostStats] = {}
+stats_lock: threading.Lock = threading.Lock()
+dns_cache: dict[tuple[str, int], tuple[float, list[tuple]]] = {}
+dns_lock: threading.Lock = threading.Lock()
+create_connection: Callable = urllib3.util.connection.create_connection
+
+
+def get_pool_hosts() -> int:
+    return int(os.getenv('HTTP_POOL_HOSTS', '32'))
+
+
+def get_pool_size() -> int:
+    return int(os.getenv('HTTP_POOL_SIZE', '8'))
+
+
+def get_timeout() -> tuple[float, float]:
+    return float(os.getenv('HTTP_CONNECT_TIMEOUT', '10')), float(os.getenv('HTTP_READ_TIMEOUT', '30'))
+
+
+def get_dns_cache_seconds() -> float:
+    return float(os.getenv('HTTP_DNS_CACHE_SECONDS', '300'))
+
+
+def uses_http2() -> bool:
+    return os.getenv('HTTP2', 'false') == 'true' and httpx is not None
+
+
+def get_accept_encoding() -> str:
+    # urllib3 only decodes brotli when a brotli package is installed, so it is only asked for then
+    return 'gzip, deflate, br' if brotli is not None else 'gzip, deflate'
+
+
+def get_host_addresses(host: str, port: int) -> list[tuple]:
+    key: tuple[str, int] = (host, port)
+    now: float = time.monotonic()
+    with dns_lock:
+        cached: tuple[float, list[tuple]] | None = dns_cache.get(key)
+    if cached is not None and cached[0] > now:
+        return cached[1]
+
+    addresses: list[tuple] = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+    with dns_lock:
+        dns_cache[key] = (now + get_dns_cache_seconds(), addresses)
+    return addresses
+
+
+def create_cached_connection(address: tuple[str, int], *args, **kwargs) -> socket.socket:
+    # urllib3 resolves the host for every new connection, this connects to the cached addresses instead.
+    # TLS still checks the certificate against the host name, which urllib3 passes separately
+    host, port = address
+    error: OSError | None = None
+    for _, _, _, _, socket_address in get_host_addresses(host, port):
+        try:
+            return create_connection((socket_address[0], port), *args, **kwargs)
+        except OSError as e:
+            error = e
+    # The addresses may have moved, so look them up again next time
+    with dns_lock:
+        dns_cache.pop((host, port), None)
+    raise error or OSError(f'No addresses found for {host}')
+
+
+class CachedDnsConnectionMixin:
+    # Connects through create_cached_connection, with socket errors converted as urllib3 does
+    def _new_conn(self) -> socket.socket:
+        try:
+            return create_cached_connection((self._dns_host, self.port), self.timeout,
+                                            source_address=self.source_address, socket_options=self.socket_options)
+        except socket.timeout as e:
+            raise ConnectTimeoutError(
+                self, f'Connection to {self.host} timed out. (connect timeout={self.timeout})'
+            ) from e
+        except OSError as e:
+            raise NewConnectionError(self, f'Failed to establish a new connection: {e}') from e
+
+
+class CachedDnsHTTPConnection(CachedDnsConnectionMixin, HTTPConnection):
+    pass
+
+
+class CachedDnsHTTPSConnection(CachedDnsConnectionMixin, HTTPSConnection):
+    pass
+
+
+class CachedDnsHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = CachedDnsHTTPConnection
+
+
+class CachedDnsHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = CachedDnsHTTPSConnection
+
+
+class CachedDnsAdapter(HTTPAdapter):
+    # Only the session's own pools use the DNS cache, urllib3 is left as it is for everything else (selenium)
+    pool_classes_by_scheme: dict[str, type[HTTPConnectionPool]] = {
+        'http': CachedDnsHTTPConnectionPool, 'https': CachedDnsHTTPSConnectionPool
+    }
+
+    def init_poolmanager(self, *args, **kwargs) -> None:
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = self.pool_classes_by_scheme
+
+    def proxy_manager_for(self, proxy: str, **proxy_kwargs) -> urllib3.PoolManager:
+        manager: urllib3.PoolManager = super().proxy_manager_for(proxy, **proxy_kwargs)
+        # SOCKS proxies bring their own connections
+        if isinstance(manager, urllib3.ProxyManager):
+            manager.pool_classes_by_scheme = self.pool_classes_by_scheme
+        return manager
+
+
+def create_session() -> requests.Session:
+    new_session: requests.Session = requests.Session()
+    adapter_class: type[HTTPAdapter] = CachedDnsAdapter if get_dns_cache_seconds() > 0 else HTTPAdapter
+    adapter: HTTPAdapter = adapter_class(pool_connections=get_pool_hosts(), pool_maxsize=get_pool_size())
+    new_session.mount('https://', adapter)
+    new_session.mount('http://', adapter)
+    new_session.headers.update({'User-Agent': user_agent, 'Accept-Encoding': get_accept_encoding()})
+    return new_session
+
+
+def create_http2_client() -> 'httpx.Client | None':
+    connect_timeout, read_timeout = get_timeout()
+    try:
+        return httpx.Client(
+            http2=True,
+            headers={'User-Agent': user_agent, 'Accept-Encoding': get_accept_encoding()},
+            timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+            limits=httpx.Limits(max_connections=get_pool_hosts() * get_pool_size(),
+                                max_keepalive_connections=get_pool_hosts()),
+            follow_redirects=True
+        )
+    except ImportError as e:
+        # httpx is installed without h2, so stay on the session rather than failing every request
+        get_logger().warning(f'HTTP/2 is not available, using HTTP/1.1: {e}')
+        return None
+
+
+def _check_process() -> None:
+    # Sockets can't be shared with a forked child, so each process opens its own connections
+    global session, http2_client, client_pid
+    if client_pid != os.getpid():
+        with client_lock:
+            if client_pid != os.getpid():
+                session = create_session()
+                http2_client = create_http2_client() if uses_http2() else None
+                client_pid = os.getpid()
+
+
+def get_session() -> requests.Session:
+    _check_process()
+    return session
+
+
+def close() -> None:
+    global session, http2_client, client_pid
+    with client_lock:
+        if session is not None:
+            session.close()
+        if http2_client is not None:
+            http2_client.close()
+        session = None
+        http2_client = None
+        client_pid = None
+
+
+def _to_requests_response(response: 'httpx.Response') -> requests.Response:
+    converted: requests.Response = requests.Response()
+    converted.status_code = response.status_code
+    converted.headers = CaseInsensitiveDict(response.headers)
+    converted.url = str(response.url)
+    converted.reason = response.reason_phrase
+    converted.encoding = response.encoding
+    converted.elapsed = response.elapsed
+    converted._content = response.content
+    return converted
+
+
+def _send_http2(method: str, url: str, timeout: float | tuple[float, float], **kwargs) -> requests.Response:
+    connect_timeout, read_timeout = timeout if isinstance(timeout, tuple) else (timeout, timeout)
+    try:
+        return _to_requests_response(http2_client.request(
+            method, url, timeout=httpx.Timeout(read_timeout, connect=connect_timeout), **kwargs
+        ))
+    except httpx.TimeoutException as e:
+        raise requests.Timeout(str(e)) from e
+    except httpx.TransportError as e:
+        raise requests.ConnectionError(str(e)) from e
+    except httpx.HTTPError as e:
+        raise requests.RequestException(str(e)) from e
+
+
+def _record(method: str, url: str, status_code: int | None, seconds: float) -> None:
+    host: str = url.split('://', 1)[-1].split('/', 1)[0]
+    with stats_lock:
+        stats: HostStats = host_stats.setdefault(host, HostStats())
+        stats.requests += 1
+        stats.errors += status_code is None or status_code >= 400
+        stats.seconds += seconds
+        stats.max_seconds = max(stats.max_seconds, seconds)
+    for hook in timing_hooks:
+        try:
+            hook(method, url, status_code, seconds)
+        except Exception as e:
+            get_logger().error(f'HTTP timing hook failed: {e}')
+
+
+def request(method: str, url: str, timeout: float | tuple[float, float] | None = None, stream: bool = False,
+            **kwargs) -> requests.Response:
+    _check_process()
+    timeout = timeout or get_timeout()
+    status_code: int | None = None
+    start_time: float = time.monotonic()
+    try:
+        response: requests.Response
+        if http2_client is not None and not stream:
+            response = _send_http2(method, url, timeout, **kwargs)
+        else:
+            response = session.request(method, url, timeout=timeout, stream=stream, **kwargs)
+        status_code = response.status_code
+        return response
+    finally:
+        _record(method, url, status_code, time.monotonic() - start_time)
+
+
+def get(url: str, **kwargs) -> requests.Response:
+    return request('GET', url, **kwargs)
+
+
+def post(url: str, **kwargs) -> requests.Response:
+    return request('POST', url, **kwargs)
+
+
+def get_metrics() -> dict[str, dict]:
+    with stats_lock:
+        return {host: stats.get_metrics() for host, stats in host_stats.items()}
@@ -1,18 +1,19 @@
 import time
 import os
-import json
+import sys
 from datetime import datetime, timedelta
 
 from dotenv import load_dotenv
 
-import arr_handler
+import dispatcher
 import email_handler
-import web_requests
-from recipes import recipe_handler
+import resilience
+import scheduler
 from logger import init_logger, get_logger
+from recipes import archive_jobs, recipe_jobs
 
 
-def check_for_new_emails(queues: dict) -> bool:
+def check_for_new_emails(queues: dict) -> int:
     get_logger().info('Checking for new emails')
     emails_by_subject: dict[str, list[str]] = email_handler.get_emails_by_subject()
     total: int = 0
@@ -20,55 +21,85 @@ def check_for_new_emails(queues: dict) -> bool:
         emails: list[str] = emails_by_subject[subject]
         total += len(emails)
         if emails:
-            queues.get(subject, []).extend(emails)
+            # The archive poller can be dispatching the same queues from its thread
+            with dispatcher.dispatch_lock:
+                queues.get(subject, []).extend(emails)
             get_logger().info(f'Loaded {len(emails)} emails for "{subject}"')
         else:
             get_logger().info(f'No emails found for "{subject}"')
-    return total > 0
+    return total
+
+
+def register_handlers() -> None:
+    # Handlers are imported on first use so the browser stack, parsers and *arr client
+    # are only loaded once there is mail for them
+    if recipe_jobs.is_enabled():
+        # Urls become jobs for the recipe workers, so queueing them is quick
+        dispatcher.register_handler('Recipes', 'recipes.recipe_jobs:enqueue_recipe_emails', timeout=60)
+    else:
+        # process_recipe_emails shares the loaded recipes and the browser, so it runs one batch at a time
+        dispatcher.register_handler('Recipes', 'recipes.recipe_handler:process_recipe_emails', timeout=3600,
+                                    max_workers=1)
+    dispatcher.register_handler('Media Requests', 'arr_handler:process_media_request_emails',
+                                workers_count=2, timeout=120)
+    dispatcher.register_handlers_from_env()
 
 
 def process_emails(queues: dict[str, list[str]]) -> None:
-    subject: str
-    for subject in queues:
-        emails: list[str] = queues[subject]
-        if not emails:
-            continue
-
-        match subject:
-            case 'Recipes':
-                recipe_handler.process_recipe_emails(emails)
-            case 'Media Requests':
-                arr_handler.process_media_request_emails(emails)
-            case _:
-                get_logger().warning(f'No processing logic for emails with subject: {subject}' +
-                               f'\nEmails: {json.dumps(emails, indent=4)}')
+    dispatcher.dispatch(queues)
+
+
+def requeue_archived_urls(queues: dict[str, list[str]], urls: list[str]) -> None:
+    requeue_urls(queues, {'Recipes': urls})
+
+
+def requeue_urls(queues: dict[str, list[str]], urls_by_subject: dict[str, list[str]]) -> None:
+    with dispatcher.dispatch_lock:
+        for subject, urls in urls_by_subject.items():
+            get_logger().info(f'Requeueing {len(urls)} urls for "{subject}"')
+            queues.setdefault(subject, []).append('\n'.join(urls))
+    process_emails(queues)
 
 
 def main():
     queues = email_handler.create_subject_queues()
 
-    wait_time = int(os.getenv('EMAIL_CHECK_INTERVAL'))
-    min_wait_time = int(os.getenv('MIN_EMAIL_INTERVAL'))
-    max_wait_time = int(os.getenv('MAX_EMAIL_INTERVAL'))
+    poll_scheduler = scheduler.PollScheduler(
+        int(os.getenv('MIN_EMAIL_INTERVAL')),
+        int(os.getenv('MAX_EMAIL_INTERVAL')),
+        int(os.getenv('EMAIL_CHECK_INTERVAL'))
+    )
+    dispatcher.batch_hooks.append(poll_scheduler.record_processing)
+    archive_jobs.start_poller(lambda urls: requeue_archived_urls(queues, urls))
+    if recipe_jobs.is_enabled():
+        recipe_jobs.start_coordinator()
 
     while True:
         # emails_found = check_for_new_urls(url_queue)
         emails_found = check_for_new_emails(queues)
-        if emails_found:
-            # process_urls(url_queue, all_recipes, unique_recipe_identifiers)
-            process_emails(queues)
-            wait_time = max(wait_time // 2, min_wait_time)
-        else:
-            wait_time = min(wait_time * 2, max_wait_time)
-
+        poll_scheduler.record_check(emails_found)
+        # Urls skipped while their site was failing
+        deferred_urls: dict[str, list[str]] = resilience.take_ready_urls()
+        if deferred_urls:
+            requeue_urls(queues, deferred_urls)
+        # Dispatch every cycle, as emails held back by a full subject queue are still waiting
+        process_emails(queues)
+
+        wait_time = poll_scheduler.next_wait(busy=not dispatcher.is_idle())
         next_check_time = datetime.now() + timedelta(seconds=wait_time)
         get_logger().info(f'Sleeping for {wait_time} seconds. Next scheduled check: {next_check_time:%Y-%m-%d %H:%M}')
+        get_logger().debug(f'Scheduler metrics: {poll_scheduler.get_metrics()}')
+        get_logger().debug(f'Domain failures: {resilience.get_metrics()}')
+        # http_client pulls in requests, so it is only imported once a handler has used it
+        if 'http_client' in sys.modules:
+            get_logger().debug(f'HTTP requests by host: {sys.modules["http_client"].get_metrics()}')
         time.sleep(wait_time)
 
 
 def setup() -> None:
     load_dotenv()
     init_logger()
+    register_handlers()
 
 
 
@@ -119,6 +150,7 @@ https://www.loveandlemons.com/french-onion-soup/'''
 
     queues = {'Recipes': urls}
     process_emails(queues)
+    dispatcher.wait_until_idle()
     # url = 'https://github.com/akamhy/waybackpy/issues/97'
     # arch_url = web_requests.get_archive_url('https://www.elliottpaterson.com')
     # arch_url = web_requests.save_archive(url)
@@ -0,0 +1,159 @@
+import os
+import sqlite3
+import threading
+import time
+from typing import Callable
+
+from logger import get_logger
+from recipes import recipe_db
+
+
+# Saving a page to archive.ph can take minutes, so instead of waiting on the shared browser the save is
+# submitted, the work-in-progress url recorded here, and a poller thread checks for the finished snapshot
+# over plain HTTP. Once it is ready the page is handed back to the recipe queue.
+
+SCHEMA: str = '''
+    CREATE TABLE IF NOT EXISTS archive_jobs (
+        url TEXT PRIMARY KEY,
+        wip_url TEXT,
+        archive_url TEXT,
+        status TEXT NOT NULL,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        submitted_at REAL,
+        checked_at REAL
+    );
+    CREATE INDEX IF NOT EXISTS archive_jobs_status ON archive_jobs (status);
+'''
+
+MAX_ATTEMPTS: int = 3
+
+poller_thread: threading.Thread | None = None
+
+
+def get_connection() -> sqlite3.Connection:
+    return recipe_db.get_connection(SCHEMA)
+
+
+def get_poll_interval() -> float:
+    return float(os.getenv('ARCHIVE_POLL_INTERVAL', '60'))
+
+
+def get_job_timeout() -> float:
+    return float(os.getenv('ARCHIVE_JOB_TIMEOUT', '3600'))
+
+
+def get_ready_archive_url(url: str) -> str | None:
+    row = get_connection().execute(
+        "SELECT archive_url FROM archive_jobs WHERE url = ? AND status IN ('ready', 'requeued')", (url,)
+    ).fetchone()
+    return row['archive_url'] if row else None
+
+
+def is_pending(url: str) -> bool:
+    return get_connection().execute("SELECT 1 FROM archive_jobs WHERE url = ? AND status = 'pending'",
+                                    (url,)).fetchone() is not None
+
+
+def submit(url: str) -> None:
+    import web_requests
+
+    if is_pending(url):
+        get_logger().info(f'Archive already pending for {url}')
+        return
+
+    row = get_connection().execute('SELECT attempts FROM archive_jobs WHERE url = ?', (url,)).fetchone()
+    attempts: int = row['attempts'] if row else 0
+    if attempts >= MAX_ATTEMPTS:
+        get_logger().warning(f'Giving up archiving {url} after {attempts} attempts')
+        return
+
+    wip_url: str = web_requests.submit_archive(url)
+    ready: bool = web_requests.is_archive_snapshot_url(wip_url)
+    connection: sqlite3.Connection = get_connection()
+    with connection:
+        connection.execute(
+            '''INSERT OR REPLACE INTO archive_jobs (url, wip_url, archive_url, status, attempts, submitted_at, checked_at)
+               VALUES (?, ?, ?, ?, ?, ?, ?)''',
+            (url, wip_url, wip_url if ready else None, 'ready' if ready else 'pending', attempts + 1, time.time(),
+             time.time())
+        )
+    get_logger().info(f'Submitted {url} for archiving: {wip_url}')
+
+
+def check_snapshot(wip_url: str) -> str | None:
+    import requests
+    import http_client
+    import web_requests
+
+    snapshot_url: str = wip_url.replace('/wip/', '/')
+    try:
+        response: requests.Response = http_client.get(snapshot_url)
+    except requests.exceptions.RequestException as e:
+        get_logger().warning(f'Error checking archive snapshot {snapshot_url}: {e}')
+        return None
+
+    if response.status_code == 200 and web_requests.is_archive_snapshot_url(response.url):
+        return response.url
+    return None
+
+
+def poll_pending() -> None:
+    now: float = time.time()
+    connection: sqlite3.Connection = get_connection()
+    rows: list[sqlite3.Row] = connection.execute(
+        "SELECT * FROM archive_jobs WHERE status = 'pending' AND checked_at <= ?", (now - get_poll_interval(),)
+    ).fetchall()
+
+    for row in rows:
+        archive_url: str | None = check_snapshot(row['wip_url'])
+        with connection:
+            if archive_url:
+                connection.execute("UPDATE archive_jobs SET status = 'ready', archive_url = ?, checked_at = ? "
+                                   "WHERE url = ?", (archive_url, now, row['url']))
+                get_logger().info(f'Archive ready for {row["url"]}: {archive_url}')
+            elif now - row['submitted_at'] > get_job_timeout():
+                # Resubmitted by the recipe pipeline when the url is requeued
+                connection.execute("UPDATE archive_jobs SET status = 'timed_out', checked_at = ? WHERE url = ?",
+                                   (now, row['url']))
+                get_logger().warning(f'Archiving timed out for {row["url"]}, attempt {row["attempts"]}')
+            else:
+                connection.execute('UPDATE archive_jobs SET checked_at = ? WHERE url = ?', (now, row['url']))
+
+
+def take_requeue_urls() -> list[str]:
+    connection: sqlite3.Connection = get_connection()
+    with connection:
+        rows: list[sqlite3.Row] = connection.execute(
+            "UPDATE archive_jobs SET status = 'requeued' WHERE status = 'ready' "
+            "OR (status = 'timed_out' AND attempts < ?) RETURNING url", (MAX_ATTEMPTS,)
+        ).fetchall()
+    return [row['url'] for row in rows]
+
+
+def has_pending_jobs() -> bool:
+    # Timed out jobs that have used up their attempts are never requeued, so they aren't waited on
+    return get_connection().execute(
+        "SELECT 1 FROM archive_jobs WHERE status IN ('pending', 'ready') "
+        "OR (status = 'timed_out' AND attempts < ?) LIMIT 1", (MAX_ATTEMPTS,)
+    ).fetchone() is not None
+
+
+def _poll(requeue: Callable[[list[str]], None]) -> None:
+    while True:
+        try:
+            if has_pending_jobs():
+                poll_pending()
+                urls: list[str] = take_requeue_urls()
+                if urls:
+                    get_logger().info(f'Requeueing {len(urls)} archived urls')
+                    requeue(urls)
+        except Exception as e:
+            get_logger().error(f'Unexpected error polling archive jobs: {e}')
+        time.sleep(get_poll_interval())
+
+
+def start_poller(requeue: Callable[[list[str]], None]) -> None:
+    global poller_thread
+    if poller_thread is None or not poller_thread.is_alive():
+        poller_thread = threading.Thread(target=_poll, args=(requeue,), name='archive poller', daemon=True)
+        poller_thread.start()
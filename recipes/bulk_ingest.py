@@ -0,0 +1,298 @@
+import argparse
+import os
+import re
+import sqlite3
+import time
+import zlib
+from collections import deque
+from pathlib import Path
+from typing import Iterator
+from urllib.parse import urljoin
+from urllib.robotparser import RobotFileParser
+from xml.etree.ElementTree import ParseError, XMLPullParser
+
+import requests
+from dotenv import load_dotenv
+
+import http_client
+import resilience
+from logger import get_logger, init_logger
+from recipes import recipe_db, recipe_handler, recipe_keys, recipe_pipeline
+from recipes.recipe_record import Recipe
+
+
+# Backfills from a site's sitemap or RSS/Atom feed instead of emailed links. The feed is streamed through an
+# XML pull parser (sitemap indexes are followed), urls not matching --pattern, disallowed by robots.txt,
+# already stored or already done are dropped, and the rest go through the recipe pipeline. Each host gets
+# one request per BULK_HOST_INTERVAL seconds (or its robots.txt Crawl-delay), and the next url is always taken
+# from the host that is free soonest, so a single slow host doesn't hold up the others.
+# OUTPUT_FILE is saved once per BULK_SAVE_BATCH urls rather than per url, and urls are only recorded as
+# finished in RECIPES_DB once saved, so an interrupted backfill picks up where it stopped.
+
+SCHEMA: str = '''
+    CREATE TABLE IF NOT EXISTS bulk_ingest (
+        url TEXT PRIMARY KEY,
+        feed TEXT,
+        recipes INTEGER NOT NULL,
+        finished_at REAL NOT NULL
+    );
+'''
+
+FEED_CHUNK_SIZE: int = 64 * 1024
+ENTRY_TAGS: set[str] = {'url', 'sitemap', 'item', 'entry'}
+
+
+def get_connection() -> sqlite3.Connection:
+    return recipe_db.get_connection(SCHEMA)
+
+
+def get_host_interval() -> float:
+    return float(os.getenv('BULK_HOST_INTERVAL', '2'))
+
+
+def get_schedule_window() -> int:
+    return int(os.getenv('BULK_SCHEDULE_WINDOW', '256'))
+
+
+def get_save_batch_size() -> int:
+    return int(os.getenv('BULK_SAVE_BATCH', '100'))
+
+
+def is_done(url: str) -> bool:
+    return get_connection().execute('SELECT 1 FROM bulk_ingest WHERE url = ?', (url,)).fetchone() is not None
+
+
+def mark_done(url: str, feed: str, recipes: int) -> None:
+    connection: sqlite3.Connection = get_connection()
+    with connection:
+        connection.execute('INSERT OR REPLACE INTO bulk_ingest (url, feed, recipes, finished_at) VALUES (?, ?, ?, ?)',
+                           (url, feed, recipes, time.time()))
+
+
+class HostRateLimiter:
+    def __init__(self, interval: float):
+        self.interval: float = interval
+        self.next_times: dict[str, float] = {}
+        self.robots: dict[str, RobotFileParser | None] = {}
+
+    def get_robots(self, url: str) -> RobotFileParser | None:
+        host: str = resilience.get_domain(url)
+        if host not in self.robots:
+            robots: RobotFileParser | None = RobotFileParser()
+            try:
+                response = http_client.get(urljoin(url, '/robots.txt'), timeout=15)
+                if response.ok:
+                    robots.parse(response.text.splitlines())
+                else:
+                    robots = None
+            except requests.RequestException as e:
+                get_logger().warning(f'Could not read robots.txt for {host}: {e}')
+                robots = None
+            self.robots[host] = robots
+        return self.robots[host]
+
+    def can_fetch(self, url: str) -> bool:
+        robots: RobotFileParser | None = self.get_robots(url)
+        return robots is None or robots.can_fetch(http_client.user_agent, url)
+
+    def get_interval(self, host: str) -> float:
+        robots: RobotFileParser | None = self.robots.get(host)
+        crawl_delay: str | float | None = robots.crawl_delay(http_client.user_agent) if robots else None
+        return max(self.interval, float(crawl_delay or 0))
+
+    def get_next_time(self, host: str) -> float:
+        return self.next_times.get(host, 0.0)
+
+    def wait(self, host: str) -> None:
+        now: float = time.monotonic()
+        next_time: float = self.get_next_time(host)
+        if next_time > now:
+            time.sleep(next_time - now)
+        self.next_times[host] = max(next_time, now) + self.get_interval(host)
+
+
+def _iter_feed_chunks(feed: str) -> Iterator[bytes]:
+    if Path(feed).exists():
+        with open(feed, 'rb') as file:
+            while chunk := file.read(FEED_CHUNK_SIZE):
+                yield chunk
+        return
+
+    with http_client.get(feed, timeout=60, stream=True) as response:
+        response.raise_for_status()
+        yield from response.iter_content(FEED_CHUNK_SIZE)
+
+
+def _local_name(tag: str) -> str:
+    return tag.rsplit('}', 1)[-1]
+
+
+def _get_entry_url(entry) -> str | None:
+    for child in entry:
+        name: str = _local_name(child.tag)
+        # Atom has <link href="..."/>, with rel="alternate" (or no rel) for the page itself
+        if name == 'link' and child.get('href') and child.get('rel', 'alternate') == 'alternate':
+            return child.get('href').strip()
+        if name in ('loc', 'link') and child.text and child.text.strip():
+            return child.text.strip()
+    return None
+
+
+def iter_feed_entries(feed: str) -> Iterator[tuple[str, str]]:
+    # Yields (kind, url): 'page' for sitemap urls and feed items, 'sitemap' for the sitemaps of a sitemap index
+    parser: XMLPullParser = XMLPullParser(events=('end',))
+    decompressor = None
+    for index, chunk in enumerate(_iter_feed_chunks(feed)):
+        # Sitemaps are often served as .xml.gz without a Content-Encoding
+        if index == 0 and chunk[:2] == b'\x1f\x8b':
+            decompressor = zlib.decompressobj(wbits=zlib.MAX_WBITS | 16)
+        parser.feed(decompressor.decompress(chunk) if decompressor else chunk)
+        for _, element in parser.read_events():
+            name: str = _local_name(element.tag)
+            if name not in ENTRY_TAGS:
+                continue
+            url: str | None = _get_entry_url(element)
+            if url:
+                yield ('sitemap' if name == 'sitemap' else 'page'), url
+            # Entries are finished with, so don't keep them in the tree
+            element.clear()
+    parser.close()
+
+
+def iter_feed_urls(feeds: list[str], sitemap_pattern: re.Pattern | None = None) -> Iterator[tuple[str, str]]:
+    # Yields (feed, url) for every page, following sitemap indexes
+    pending: deque[str] = deque(feeds)
+    seen_feeds: set[str] = set()
+    while pending:
+        feed: str = pending.popleft()
+        if feed in seen_feeds:
+            continue
+        seen_feeds.add(feed)
+        get_logger().info(f'Reading {feed}')
+        try:
+            for kind, url in iter_feed_entries(feed):
+                if kind == 'page':
+                    yield feed, url
+                elif sitemap_pattern is None or sitemap_pattern.search(url):
+                    pending.append(url)
+        except (OSError, ParseError, zlib.error) as e:
+            # requests errors are OSErrors too
+            get_logger().error(f'Could not read {feed}: {e}')
+
+
+def filter_urls(feed_urls: Iterator[tuple[str, str]], pattern: re.Pattern | None, limiter: HostRateLimiter,
+                counts: dict[str, int]) -> Iterator[tuple[str, str]]:
+    seen: set[str] = set()
+    for feed, url in feed_urls:
+        counts['entries'] += 1
+        if url in seen or (pattern is not None and not pattern.search(url)):
+            continue
+        seen.add(url)
+        counts['matched'] += 1
+        if recipe_keys.has_url(url) or is_done(url):
+            counts['skipped'] += 1
+            continue
+        if not limiter.can_fetch(url):
+            get_logger().info(f'Disallowed by robots.txt: {url}')
+            counts['disallowed'] += 1
+            continue
+        yield feed, url
+
+
+def schedule_by_host(feed_urls: Iterator[tuple[str, str]], limiter: HostRateLimiter,
+                     window: int) -> Iterator[tuple[str, str]]:
+    # Holds up to window urls, spread over their hosts, and hands them out as each host's slot comes round
+    pending: dict[str, deque[tuple[str, str]]] = {}
+    buffered: int = 0
+    exhausted: bool = False
+    while True:
+        while not exhausted and buffered < window:
+            feed_url: tuple[str, str] | None = next(feed_urls, None)
+            if feed_url is None:
+                exhausted = True
+                break
+            pending.setdefault(resilience.get_domain(feed_url[1]), deque()).append(feed_url)
+            buffered += 1
+        if not pending:
+            return
+
+        host: str = min(pending, key=limiter.get_next_time)
+        limiter.wait(host)
+        feed_url = pending[host].popleft()
+        buffered -= 1
+        if not pending[host]:
+            del pending[host]
+        yield feed_url
+
+
+def ingest(feeds: list[str], pattern: re.Pattern | None = None, sitemap_pattern: re.Pattern | None = None,
+           limit: int | None = None) -> dict[str, int]:
+    counts: dict[str, int] = {'entries': 0, 'matched': 0, 'skipped': 0, 'disallowed': 0, 'processed': 0,
+                              'recipes': 0}
+    limiter: HostRateLimiter = HostRateLimiter(get_host_interval())
+    feed_urls: Iterator[tuple[str, str]] = filter_urls(iter_feed_urls(feeds, sitemap_pattern), pattern, limiter,
+                                                       counts)
+    if limit:
+        feed_urls = (feed_url for _, feed_url in zip(range(limit), feed_urls))
+    feeds_by_url: dict[str, str] = {}
+    # Written since the last save: (url, feed, recipe count), and the new recipes with their unique ids
+    unsaved_urls: list[tuple[str, str, int]] = []
+    unsaved_ids: list[str] = []
+    unsaved_recipes: list[Recipe] = []
+
+    def get_urls() -> Iterator[str]:
+        for feed, url in schedule_by_host(feed_urls, limiter, get_schedule_window()):
+            feeds_by_url[url] = feed
+            yield url
+
+    def save() -> None:
+        if not unsaved_urls:
+            return
+        recipe_handler.save_recipes(recipe_handler.get_loaded_recipes())
+        recipe_handler.store_new_recipes([url for url, _, _ in unsaved_urls], unsaved_ids, unsaved_recipes)
+        for url, feed, recipes_count in unsaved_urls:
+            mark_done(url, feed, recipes_count)
+        unsaved_urls.clear()
+        unsaved_ids.clear()
+        unsaved_recipes.clear()
+
+    def write(url: str, parse_result: tuple[list[Recipe], list[tuple[str, str, dict]]]) -> None:
+        recipes, dumps = parse_result
+        recipe_handler.submit_dumps(dumps)
+        unique_ids, new_recipes = recipe_handler.add_new_recipes(url, recipes, save=False)
+        # Urls that failed to download are not marked, so they are tried again on the next run
+        unsaved_urls.append((url, feeds_by_url.pop(url, ''), len(recipes)))
+        unsaved_ids.extend(unique_ids)
+        unsaved_recipes.extend(new_recipes)
+        if len(unsaved_urls) >= get_save_batch_size():
+            save()
+        counts['processed'] += 1
+        counts['recipes'] += len(recipes)
+        if counts['processed'] % 100 == 0:
+            get_logger().info(f'Bulk ingest progress: {counts}')
+
+    recipe_handler.prepare_recipe_stores()
+    try:
+        # Failing urls are left for the next run rather than deferred. fetch runs in a thread, so a lambda is fine
+        recipe_pipeline.run_pipeline(get_urls(), lambda url: recipe_handler.fetch_page(url, defer_failing=False),
+                                     recipe_handler.parse_page, write)
+    finally:
+        save()
+        recipe_handler.release_loaded_recipes()
+    get_logger().info(f'Bulk ingest finished: {counts}')
+    return counts
+
+
+if __name__ == '__main__':
+    load_dotenv()
+    init_logger()
+
+    arg_parser = argparse.ArgumentParser(description='Backfill recipes from sitemaps and RSS/Atom feeds')
+    arg_parser.add_argument('feeds', nargs='+', help='sitemap, sitemap index or feed urls (or local files)')
+    arg_parser.add_argument('--pattern', help='only urls matching this regex, e.g. /food/.*ottolenghi')
+    arg_parser.add_argument('--sitemap-pattern', help='only follow sitemaps of an index matching this regex')
+    arg_parser.add_argument('--limit', type=int, help='stop after this many new urls')
+    args = arg_parser.parse_args()
+
+    ingest(args.feeds, re.compile(args.pattern) if args.pattern else None,
+           re.compile(args.sitemap_pattern) if args.sitemap_pattern else None, args.limit)
@@ -0,0 +1,247 @@
+import re
+from html.parser import HTMLParser
+
+from recipes import recipe_fields
+
+
+# Recipes from pages without recipe JSON-LD (older newspaper columns mostly), read from the article text.
+# The page goes through html.parser once, keeping only the text of block elements, split on <br>. The
+# blocks are then read in order: a heading names a recipe, a block of short lines mostly starting with a
+# quantity is an ingredient list, "Serves 4" / "Prep 15 min" lines fill in the yield and times, and prose
+# after the ingredients is the method. Only recipes with a few ingredients and a method are returned.
+# Most of the cost is tokenizing tags, so the contents of skipped elements (navigation, asides, footers, svg)
+# are passed over unparsed like a <script>, and reading stops at the end of the article body.
+
+BLOCK_TAGS: set[str] = {'p', 'li', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'div', 'section', 'article', 'ul', 'ol',
+                        'table', 'tr', 'td', 'dt', 'dd', 'blockquote', 'main'}
+HEADING_TAGS: set[str] = {'h1', 'h2', 'h3', 'h4', 'h5', 'h6'}
+SKIP_TAGS: set[str] = {'script', 'style', 'noscript', 'template', 'svg', 'nav', 'header', 'footer', 'aside',
+                       'figure', 'form', 'button', 'select', 'title'}
+BOLD_TAGS: set[str] = {'strong', 'b'}
+META_NAMES: set[str] = {'og:title', 'og:site_name', 'og:image', 'article:published_time', 'author'}
+
+MIN_INGREDIENTS: int = 2
+MAX_INGREDIENT_LENGTH: int = 100
+MAX_HEADING_LENGTH: int = 100
+
+QUANTITY_PATTERN: re.Pattern = re.compile(rf'^(?:{recipe_fields.NUMBER}|an?\s|\d)', re.IGNORECASE)
+SECTION_PATTERN: re.Pattern = re.compile(r'^(?:ingredients|method|directions|instructions|for (?:the|a|an)\b)',
+                                         re.IGNORECASE)
+YIELD_LINE_PATTERN: re.Pattern = re.compile(r'^(?:serves|makes|feeds|yields?)\b\s*:?\s*(?:about\s+)?\d',
+                                            re.IGNORECASE)
+TIME_LINE_PATTERN: re.Pattern = re.compile(
+    r'^(?P<label>prep(?:aration)?|cook(?:ing)?|total|ready in)(?: time)?\s*:?\s*(?P<value>\d.{0,30})$', re.IGNORECASE
+)
+TIME_FIELDS: dict[str, str] = {'prep': 'prep_time', 'cook': 'cook_time', 'tota': 'total_time', 'read': 'total_time'}
+
+
+class ArticleEnd(Exception):
+    pass
+
+
+class ArticleTextParser(HTMLParser):
+    def __init__(self, body_class_pattern: re.Pattern | None = None):
+        super().__init__(convert_charrefs=True)
+        self.body_class_pattern: re.Pattern | None = body_class_pattern
+        # (kind, lines, in the article body)
+        self.blocks: list[tuple[str, list[str], bool]] = []
+        self.meta: dict[str, str] = {}
+        self.title: str = ''
+
+        self.lines: list[str] = []
+        self.line: list[str] = []
+        self.kind: str = 'text'
+        self.bold_depth: int = 0
+        self.has_plain_text: bool = False
+
+        # The outermost skipped and article body elements, with how deep in nested tags of that name we are
+        self.skip_tag: str | None = None
+        self.skip_depth: int = 0
+        self.body_tag: str | None = None
+        self.body_depth: int = 0
+        self.in_title: bool = False
+
+    def _is_body(self, tag: str, attrs: dict[str, str | None]) -> bool:
+        if self.body_class_pattern is not None:
+            return any(self.body_class_pattern.search(name) for name in (attrs.get('class') or '').split())
+        return tag == 'article' or attrs.get('itemprop') == 'articleBody'
+
+    def handle_starttag(self, tag: str, attr_list: list[tuple[str, str | None]]) -> None:
+        if self.skip_tag is not None:
+            self.skip_depth += tag == self.skip_tag
+            return
+
+        attrs: dict[str, str | None] = dict(attr_list)
+        if tag == 'meta':
+            name: str = (attrs.get('property') or attrs.get('name') or '').lower()
+            if name in META_NAMES and attrs.get('content'):
+                self.meta.setdefault(name, attrs['content'])
+            return
+        if tag == 'br':
+            self._end_line()
+            return
+        if tag in SKIP_TAGS:
+            self.in_title = tag == 'title'
+            self.skip_tag, self.skip_depth = tag, 1
+            if not self.in_title:
+                self.set_cdata_mode(tag)
+            return
+
+        if tag in BLOCK_TAGS:
+            self._end_block()
+            if tag in HEADING_TAGS:
+                self.kind = 'heading'
+        elif tag in BOLD_TAGS:
+            self.bold_depth += 1
+
+        if self.body_tag is None:
+            if self._is_body(tag, attrs):
+                self.body_tag, self.body_depth = tag, 1
+        elif tag == self.body_tag:
+            self.body_depth += 1
+
+    def handle_endtag(self, tag: str) -> None:
+        if self.skip_tag is not None:
+            if tag == self.skip_tag:
+                self.skip_depth -= 1
+                if self.skip_depth == 0:
+                    self.skip_tag = None
+                    self.in_title = False
+            return
+
+        if tag in BLOCK_TAGS:
+            self._end_block()
+        elif tag in BOLD_TAGS:
+            self.bold_depth = max(0, self.bold_depth - 1)
+
+        if tag == self.body_tag:
+            if self.body_depth == 1:
+                # Anything after the article body is related articles and comments
+                self._end_block()
+                raise ArticleEnd()
+            self.body_depth -= 1
+
+    def handle_data(self, data: str) -> None:
+        if self.skip_tag is not None:
+            if self.in_title:
+                self.title += data
+            return
+        if data.strip():
+            self.has_plain_text |= self.bold_depth == 0
+        self.line.append(data)
+
+    def _end_line(self) -> None:
+        text: str = ' '.join(''.join(self.line).split())
+        if text:
+            self.lines.append(text)
+        self.line = []
+
+    def _end_block(self) -> None:
+        self._end_line()
+        if self.lines:
+            kind: str = self.kind
+            # A paragraph that is all bold is used as a heading by older articles
+            if (kind == 'text' and not self.has_plain_text and len(self.lines) == 1
+                    and len(self.lines[0]) <= MAX_HEADING_LENGTH):
+                kind = 'heading'
+            self.blocks.append((kind, self.lines, self.body_depth > 0))
+        self.lines = []
+        self.kind = 'text'
+        self.has_plain_text = False
+
+    def close(self) -> None:
+        super().close()
+        self._end_block()
+
+
+def _is_quantity_line(line: str) -> bool:
+    # Ingredient lines are never full sentences, which keeps out "A few words about..."
+    return len(line) <= MAX_INGREDIENT_LENGTH and not line.endswith('.') and bool(QUANTITY_PATTERN.match(line))
+
+
+def _is_ingredient_block(lines: list[str], in_ingredients: bool) -> bool:
+    if any(len(line) > MAX_INGREDIENT_LENGTH for line in lines):
+        return False
+    quantity_lines: int = sum(_is_quantity_line(line) for line in lines)
+    if len(lines) == 1:
+        # "Salt and pepper" on its own only counts in the middle of an ingredient list
+        return quantity_lines == 1 or (in_ingredients and not lines[0].endswith('.'))
+    return quantity_lines * 2 >= len(lines)
+
+
+def _new_recipe(name: str | None) -> dict:
+    return {'recipe_name': name, 'description': [], 'ingredients': [], 'instructions': [], 'recipe_yield': None,
+            'prep_time': None, 'cook_time': None, 'total_time': None}
+
+
+def _read_detail_line(recipe: dict, line: str) -> bool:
+    if len(line) > 40:
+        return False
+    if YIELD_LINE_PATTERN.match(line):
+        recipe['recipe_yield'] = recipe['recipe_yield'] or line
+        return True
+    if match := TIME_LINE_PATTERN.match(line):
+        if recipe_fields.parse_duration(match['value']) is None:
+            return False
+        field: str = TIME_FIELDS[match['label'][:4].lower()]
+        recipe[field] = recipe[field] or match['value']
+        return True
+    return False
+
+
+def _is_complete(recipe: dict | None) -> bool:
+    return recipe is not None and len(recipe['ingredients']) >= MIN_INGREDIENTS and bool(recipe['instructions'])
+
+
+def segment_recipes(blocks: list[tuple[str, list[str]]]) -> list[dict]:
+    recipes: list[dict] = []
+    recipe: dict | None = None
+    for kind, lines in blocks:
+        if kind == 'heading':
+            text: str = ' '.join(lines)
+            if SECTION_PATTERN.match(text):
+                continue
+            # Headings between the ingredients and the method are ingredient groups, not a new recipe
+            if recipe is not None and recipe['ingredients'] and not recipe['instructions']:
+                continue
+            if _is_complete(recipe):
+                recipes.append(recipe)
+            recipe = _new_recipe(text)
+            continue
+
+        recipe = recipe or _new_recipe(None)
+        lines = [line for line in lines if not _read_detail_line(recipe, line)]
+        if not lines:
+            continue
+        if not recipe['instructions'] and _is_ingredient_block(lines, bool(recipe['ingredients'])):
+            recipe['ingredients'].extend(lines)
+        elif recipe['ingredients']:
+            recipe['instructions'].extend(lines)
+        else:
+            recipe['description'].extend(lines)
+
+    if _is_complete(recipe):
+        recipes.append(recipe)
+    for recipe in recipes:
+        recipe['description'] = ' '.join(recipe['description'])
+    return recipes
+
+
+def extract_recipes(page_source: str, body_class_pattern: re.Pattern | None = None) -> tuple[list[dict], dict]:
+    # Returns the recipes and the page's meta tags (og:title, og:site_name, og:image, author, ...)
+    parser: ArticleTextParser = ArticleTextParser(body_class_pattern)
+    try:
+        parser.feed(page_source)
+        parser.close()
+    except ArticleEnd:
+        pass
+
+    meta: dict[str, str] = parser.meta
+    if parser.title.strip():
+        meta.setdefault('title', ' '.join(parser.title.split()))
+
+    body_blocks: list[tuple[str, list[str]]] = [(kind, lines) for kind, lines, in_body in parser.blocks if in_body]
+    recipes: list[dict] = segment_recipes(body_blocks or [(kind, lines) for kind, lines, _ in parser.blocks])
+    for recipe in recipes:
+        recipe['recipe_name'] = recipe['recipe_name'] or meta.get('og:title') or meta.get('title')
+    return recipes, meta
@@ -0,0 +1,151 @@
+import hashlib
+import os
+import random
+import re
+import sqlite3
+import struct
+from typing import Callable
+
+from logger import get_logger
+from recipes import recipe_db
+
+
+# Syndicated copies of a recipe rarely share a name and URL, but they do share ingredients and method.
+# Each recipe gets a MinHash signature over its normalised ingredients and instruction word 3-grams, and the
+# signature bands are stored in an LSH table so candidates are found with a few indexed lookups per recipe.
+
+SCHEMA: str = '''
+    CREATE TABLE IF NOT EXISTS minhash_signatures (
+        recipe_id TEXT PRIMARY KEY,
+        signature BLOB NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS minhash_bands (
+        band INTEGER NOT NULL,
+        bucket BLOB NOT NULL,
+        recipe_id TEXT NOT NULL,
+        PRIMARY KEY (band, bucket, recipe_id)
+    ) WITHOUT ROWID;
+'''
+
+BANDS: int = 32
+ROWS: int = 4
+PERMUTATIONS: int = BANDS * ROWS
+MERSENNE_PRIME: int = (1 << 61) - 1
+MIN_SHINGLES: int = 3
+
+_random: random.Random = random.Random(1701)
+HASH_PARAMS: list[tuple[int, int]] = [(_random.randrange(1, MERSENNE_PRIME), _random.randrange(0, MERSENNE_PRIME))
+                                      for _ in range(PERMUTATIONS)]
+SIGNATURE_FORMAT: struct.Struct = struct.Struct(f'<{PERMUTATIONS}Q')
+
+QUANTITY_PATTERN: re.Pattern = re.compile(
+    r'\b(\d+([./]\d+)?|[½¼¾⅓⅔]|a|an|of|about|approx|to|or|and|tsp|tbsp|tablespoons?|teaspoons?|cups?|g|kg|ml|l|'
+    r'oz|lb|lbs|pinch|handful|large|small|medium|finely|roughly|chopped|sliced|diced|grated|fresh)\b'
+)
+WORD_PATTERN: re.Pattern = re.compile(r'[a-z]+')
+
+
+def get_connection() -> sqlite3.Connection:
+    return recipe_db.get_connection(SCHEMA)
+
+
+def get_threshold() -> float:
+    return float(os.getenv('NEAR_DUPLICATE_THRESHOLD', '0.7'))
+
+
+def _get_lines(value: list | dict | str | None) -> list[str]:
+    if not value:
+        return []
+    elif isinstance(value, str):
+        return [value]
+    elif isinstance(value, list):
+        return [line for item in value for line in _get_lines(item)]
+    elif isinstance(value, dict):
+        return _get_lines(value.get('text') or value.get('itemListElement'))
+    return []
+
+
+def normalize_ingredient(ingredient: str) -> str:
+    words: list[str] = WORD_PATTERN.findall(QUANTITY_PATTERN.sub(' ', ingredient.lower().split(',')[0]))
+    return ' '.join(words)
+
+
+def get_shingles(recipe: dict) -> set[str]:
+    shingles: set[str] = {f'i:{ingredient}' for line in _get_lines(recipe.get('ingredients'))
+                          if (ingredient := normalize_ingredient(line))}
+
+    words: list[str] = WORD_PATTERN.findall(' '.join(_get_lines(recipe.get('instructions'))).lower())
+    shingles.update(f'm:{" ".join(words[index:index + 3])}' for index in range(len(words) - 2))
+    return shingles
+
+
+def get_signature(shingles: set[str]) -> list[int]:
+    shingle_hashes: list[int] = [int.from_bytes(hashlib.blake2b(shingle.encode('utf-8'), digest_size=8).digest(),
+                                                'little') for shingle in shingles]
+    return [min((a * shingle_hash + b) % MERSENNE_PRIME for shingle_hash in shingle_hashes)
+            for a, b in HASH_PARAMS]
+
+
+def get_buckets(signature: list[int]) -> list[bytes]:
+    packed: bytes = SIGNATURE_FORMAT.pack(*signature)
+    band_size: int = ROWS * 8
+    return [hashlib.blake2b(packed[band * band_size:(band + 1) * band_size], digest_size=8).digest()
+            for band in range(BANDS)]
+
+
+def get_similarity(signature: list[int], other_signature: list[int]) -> float:
+    return sum(value == other_value for value, other_value in zip(signature, other_signature)) / PERMUTATIONS
+
+
+def get_recipe_signature(recipe: dict) -> list[int] | None:
+    shingles: set[str] = get_shingles(recipe)
+    if len(shingles) < MIN_SHINGLES:
+        return None
+    return get_signature(shingles)
+
+
+def find_near_duplicates(signature: list[int], exclude_id: str = '') -> list[tuple[str, float]]:
+    connection: sqlite3.Connection = get_connection()
+    candidates: set[str] = set()
+    for band, bucket in enumerate(get_buckets(signature)):
+        candidates.update(row['recipe_id'] for row in connection.execute(
+            'SELECT recipe_id FROM minhash_bands WHERE band = ? AND bucket = ?', (band, bucket)))
+    candidates.discard(exclude_id)
+
+    matches: list[tuple[str, float]] = []
+    for candidate_id in candidates:
+        row = connection.execute('SELECT signature FROM minhash_signatures WHERE recipe_id = ?',
+                                 (candidate_id,)).fetchone()
+        similarity: float = get_similarity(signature, list(SIGNATURE_FORMAT.unpack(row['signature'])))
+        if similarity >= get_threshold():
+            matches.append((candidate_id, similarity))
+    return sorted(matches, key=lambda match: match[1], reverse=True)
+
+
+def add_signature(recipe_id: str, signature: list[int]) -> None:
+    connection: sqlite3.Connection = get_connection()
+    with connection:
+        connection.execute('INSERT OR REPLACE INTO minhash_signatures (recipe_id, signature) VALUES (?, ?)',
+                           (recipe_id, SIGNATURE_FORMAT.pack(*signature)))
+        connection.executemany('INSERT OR IGNORE INTO minhash_bands (band, bucket, recipe_id) VALUES (?, ?, ?)',
+                               [(band, bucket, recipe_id) for band, bucket in enumerate(get_buckets(signature))])
+
+
+def add_recipes(recipes: list[dict], get_unique_id: Callable[[dict], str]) -> None:
+    for recipe in recipes:
+        signature: list[int] | None = get_recipe_signature(recipe)
+        if signature:
+            add_signature(get_unique_id(recipe), signature)
+
+
+def ensure_signatures(load_recipes: Callable[[], list[dict]], get_unique_id: Callable[[dict], str]) -> None:
+    # Recipes without ingredients or method get no signature, so record the backfill rather than relying on
+    # the table having rows
+    if recipe_db.get_meta('minhash_backfilled'):
+        return
+
+    recipes: list[dict] = load_recipes()
+    add_recipes(recipes, get_unique_id)
+    recipe_db.set_meta('minhash_backfilled', '1')
+    if recipes:
+        get_logger().info(f'Computed near-duplicate signatures for {len(recipes)} existing recipes')
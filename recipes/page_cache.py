@@ -0,0 +1,54 @@
+import gzip
+import hashlib
+import json
+import os
+from datetime import datetime
+from pathlib import Path
+from typing import Iterator
+
+import web_requests
+from logger import get_logger
+
+
+def get_cache_dir() -> Path:
+    return Path(os.getenv('PAGE_CACHE_DIR', 'recipes/output/pages'))
+
+
+def is_enabled() -> bool:
+    return os.getenv('PAGE_CACHE', 'true') == 'true'
+
+
+def get_page_path(url: str) -> Path:
+    url_hash: str = hashlib.sha1(url.encode('utf-8')).hexdigest()
+    return get_cache_dir() / web_requests.get_base_url(url) / f'{url_hash}.json.gz'
+
+
+def store_page(url: str, page_source: str, request_url: str = '') -> None:
+    if not is_enabled() or not page_source:
+        return
+
+    page_path: Path = get_page_path(url)
+    try:
+        page_path.parent.mkdir(parents=True, exist_ok=True)
+        snapshot: dict = {
+            'url': url,
+            'request_url': request_url or url,
+            'fetched_at': datetime.now().isoformat(timespec='seconds'),
+            'page_source': page_source
+        }
+        with gzip.open(page_path, 'wt', encoding='utf-8', compresslevel=5) as file:
+            json.dump(snapshot, file)
+    except OSError as os_error:
+        get_logger().error(f'File system error occurred caching the page at {url}: {os_error}')
+
+
+def load_page(page_path: Path) -> dict:
+    with gzip.open(page_path, 'rt', encoding='utf-8') as file:
+        return json.load(file)
+
+
+def iter_page_paths() -> Iterator[Path]:
+    cache_dir: Path = get_cache_dir()
+    if not cache_dir.exists():
+        return iter(())
+    return cache_dir.glob('*/*.json.gz')
@@ -0,0 +1,165 @@
+import atexit
+import gzip
+import json
+import os
+import queue
+import threading
+from datetime import datetime
+from pathlib import Path
+from typing import Iterator
+
+from logger import get_logger
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+dump_queue: queue.Queue | None = None
+writer_thread: threading.Thread | None = None
+writer_lock: threading.Lock = threading.Lock()
+total_dump_bytes: int | None = None
+
+
+@atexit.register
+def exit_handler() -> None:
+    flush_dumps()
+
+
+def get_dumps_dir() -> Path:
+    return Path(os.getenv('DUMPS_DIR', 'recipes/output/unprocessed'))
+
+
+def get_max_dumps_per_domain() -> int:
+    return int(os.getenv('DUMP_MAX_PER_DOMAIN', '50'))
+
+
+def get_max_total_bytes() -> int:
+    return int(os.getenv('DUMP_MAX_TOTAL_MB', '500')) * 1024 * 1024
+
+
+def get_dump_suffix() -> str:
+    use_zstd: bool = os.getenv('DUMP_COMPRESSION', 'zstd') == 'zstd' and zstandard is not None
+    return '.json.zst' if use_zstd else '.json.gz'
+
+
+def compress(data: bytes, suffix: str) -> bytes:
+    if suffix == '.json.zst':
+        return zstandard.ZstdCompressor(level=6).compress(data)
+    return gzip.compress(data, compresslevel=5)
+
+
+def decompress(data: bytes, suffix: str) -> bytes:
+    if suffix == '.json.zst':
+        return zstandard.ZstdDecompressor().decompress(data)
+    return gzip.decompress(data)
+
+
+def get_suffix(path: Path) -> str:
+    return ''.join(path.suffixes[-2:])
+
+
+def build_dump(url: str, request_url: str, parser_name: str, page_source: str, script_jsons: list[dict],
+               base_data: dict | None = None, recipes_data: list[dict] | None = None,
+               recipes: list[dict] | None = None) -> dict:
+    return {
+        'url': url,
+        'request_url': request_url,
+        'parser': parser_name,
+        'dumped_at': datetime.now().isoformat(timespec='seconds'),
+        'script_jsons': script_jsons,
+        'base_data': base_data,
+        'recipes_data': recipes_data,
+        'recipes': recipes,
+        'page_source': page_source
+    }
+
+
+def get_dump_path(domain: str, name: str) -> Path:
+    return get_dumps_dir() / domain / f'{name}{get_dump_suffix()}'
+
+
+def submit_dump(domain: str, name: str, dump: dict) -> None:
+    global dump_queue, writer_thread
+    with writer_lock:
+        if writer_thread is None or not writer_thread.is_alive():
+            dump_queue = queue.Queue(maxsize=int(os.getenv('DUMP_QUEUE_SIZE', '32')))
+            writer_thread = threading.Thread(target=_write_dumps, args=(dump_queue,), daemon=True)
+            writer_thread.start()
+
+    try:
+        dump_queue.put_nowait((domain, name, dump))
+    except queue.Full:
+        # Dumps are diagnostics only, never hold up the pipeline for them
+        get_logger().warning(f'Dump queue full, dropping dump for {dump.get("url")}')
+
+
+def flush_dumps(timeout: float = 30) -> None:
+    global writer_thread
+    with writer_lock:
+        if writer_thread is None or not writer_thread.is_alive():
+            return
+        dump_queue.put((None, None, None))
+        writer_thread.join(timeout)
+        writer_thread = None
+
+
+def _write_dumps(pending_dumps: queue.Queue) -> None:
+    while True:
+        domain, name, dump = pending_dumps.get()
+        if dump is None:
+            return
+
+        try:
+            write_dump(domain, name, dump)
+        except Exception as e:
+            get_logger().error(f'Unexpected error writing dump for {dump.get("url")}: {e}')
+
+
+def write_dump(domain: str, name: str, dump: dict) -> None:
+    global total_dump_bytes
+    if total_dump_bytes is None:
+        total_dump_bytes = sum(path.stat().st_size for path in iter_dump_paths())
+
+    dump_path: Path = get_dump_path(domain, name)
+    dump_path.parent.mkdir(parents=True, exist_ok=True)
+    data: bytes = compress(json.dumps(dump).encode('utf-8'), get_suffix(dump_path))
+
+    if dump_path.exists():
+        total_dump_bytes -= dump_path.stat().st_size
+    dump_path.write_bytes(data)
+    total_dump_bytes += len(data)
+
+    enforce_retention(domain)
+
+
+def enforce_retention(domain: str) -> None:
+    global total_dump_bytes
+    domain_dumps: list[Path] = sorted(iter_dump_paths(domain), key=lambda path: path.stat().st_mtime)
+    for path in domain_dumps[:max(0, len(domain_dumps) - get_max_dumps_per_domain())]:
+        total_dump_bytes -= path.stat().st_size
+        path.unlink()
+
+    if total_dump_bytes <= get_max_total_bytes():
+        return
+
+    all_dumps: list[Path] = sorted(iter_dump_paths(), key=lambda path: path.stat().st_mtime)
+    for path in all_dumps:
+        if total_dump_bytes <= get_max_total_bytes():
+            break
+        total_dump_bytes -= path.stat().st_size
+        path.unlink()
+    get_logger().warning('Dump disk budget reached, removed the oldest dumps')
+
+
+def iter_dump_paths(domain: str = '*') -> Iterator[Path]:
+    dumps_dir: Path = get_dumps_dir()
+    if not dumps_dir.exists():
+        return iter(())
+    return (path for path in dumps_dir.glob(f'{domain}/*.json.*')
+            if get_suffix(path) in ('.json.gz', '.json.zst'))
+
+
+def load_dump(dump_path: Path) -> dict:
+    return json.loads(decompress(dump_path.read_bytes(), get_suffix(dump_path)))
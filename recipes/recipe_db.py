@@ -0,0 +1,51 @@
+import os
+import sqlite3
+import threading
+from pathlib import Path
+
+
+connections: threading.local = threading.local()
+
+
+def get_db_path() -> str:
+    return os.getenv('RECIPES_DB', 'recipes/output/recipes.db')
+
+
+def get_connection(schema: str = '') -> sqlite3.Connection:
+    # One connection per thread, and never reuse a connection inherited through fork
+    connection: sqlite3.Connection | None = getattr(connections, 'connection', None)
+    if connection is None or getattr(connections, 'pid', None) != os.getpid():
+        db_path: str = get_db_path()
+        Path(db_path).parent.mkdir(parents=True, exist_ok=True)
+        connection = sqlite3.connect(db_path, timeout=30)
+        connection.row_factory = sqlite3.Row
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        connections.connection = connection
+        connections.pid = os.getpid()
+        connections.schemas = set()
+
+    # Each store passes its CREATE ... IF NOT EXISTS script, which only needs running once per connection
+    if schema and schema not in connections.schemas:
+        connection.executescript(schema)
+        connections.schemas.add(schema)
+    return connection
+
+
+META_SCHEMA: str = '''
+    CREATE TABLE IF NOT EXISTS db_meta (
+        name TEXT PRIMARY KEY,
+        value TEXT
+    );
+'''
+
+
+def get_meta(name: str) -> str | None:
+    row = get_connection(META_SCHEMA).execute('SELECT value FROM db_meta WHERE name = ?', (name,)).fetchone()
+    return row['value'] if row else None
+
+
+def set_meta(name: str, value: str) -> None:
+    connection: sqlite3.Connection = get_connection(META_SCHEMA)
+    with connection:
+        connection.execute('INSERT OR REPLACE INTO db_meta (name, value) VALUES (?, ?)', (name, value))
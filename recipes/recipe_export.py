@@ -0,0 +1,326 @@
+import argparse
+import gzip
+import io
+import json
+import os
+import re
+import threading
+import time
+import zlib
+from pathlib import Path
+from typing import Callable, Iterable, Iterator
+
+from dotenv import load_dotenv
+
+from logger import get_logger, init_logger
+from recipes import recipe_record
+
+
+# The collection exported for the web UI and meal planner as gzipped JSON Lines, one recipe per line, sharded by
+# source and/or published month (EXPORT_SHARD_BY), e.g. bbc-good-food/2024-05.1.jsonl.gz. manifest.json lists
+# every shard's file, recipe count, size and CRC-32, and is replaced atomically after the shards are written.
+# New recipes are appended to their shards as another gzip member, and the CRC-32 is carried on from the
+# manifest, so adding recipes costs only what was added. A shard whose recipes were updated is rewritten
+# under a new generation number, leaving the file a reader may have open alone. Shards that have collected
+# EXPORT_MAX_MEMBERS appends are recompressed into one member.
+# Readers only read the size the manifest gives, so a shard being appended to is read as it was at the manifest.
+
+MANIFEST_NAME: str = 'manifest.json'
+MANIFEST_VERSION: int = 1
+SHARD_KEYS: set[str] = {'source', 'month'}
+MONTH_PATTERN: re.Pattern = re.compile(r'^(\d{4})-(\d{2})')
+SLUG_PATTERN: re.Pattern = re.compile(r'[^a-z0-9]+')
+
+export_lock: threading.Lock = threading.Lock()
+
+
+def is_enabled() -> bool:
+    return os.getenv('RECIPE_EXPORT', 'true') == 'true'
+
+
+def get_export_dir() -> Path:
+    return Path(os.getenv('EXPORT_DIR', 'recipes/output/export'))
+
+
+def get_shard_by() -> list[str]:
+    shard_by: list[str] = [key.strip() for key in os.getenv('EXPORT_SHARD_BY', 'source,month').split(',')
+                           if key.strip()]
+    unknown: set[str] = set(shard_by) - SHARD_KEYS
+    if unknown:
+        raise ValueError(f'Unknown EXPORT_SHARD_BY keys: {", ".join(sorted(unknown))}')
+    return shard_by
+
+
+def get_max_members() -> int:
+    return int(os.getenv('EXPORT_MAX_MEMBERS', '64'))
+
+
+def get_source_key(recipe: dict) -> str:
+    return SLUG_PATTERN.sub('-', str(recipe.get('source') or '').lower()).strip('-') or 'unknown'
+
+
+def get_month_key(recipe: dict) -> str:
+    match: re.Match | None = MONTH_PATTERN.match(str(recipe.get('published_date') or ''))
+    return f'{match.group(1)}-{match.group(2)}' if match else 'undated'
+
+
+def get_shard_name(recipe: dict, shard_by: list[str]) -> str:
+    parts: list[str] = [get_source_key(recipe) if key == 'source' else get_month_key(recipe) for key in shard_by]
+    return '/'.join(parts) or 'all'
+
+
+def group_by_shard(recipes: Iterable[dict], shard_by: list[str]) -> dict[str, list[dict]]:
+    shards: dict[str, list[dict]] = {}
+    for recipe in recipes:
+        shards.setdefault(get_shard_name(recipe, shard_by), []).append(recipe)
+    return shards
+
+
+def encode_recipes(recipes: list[dict]) -> bytes:
+    lines: str = ''.join(json.dumps(recipe, ensure_ascii=False, separators=(',', ':'),
+                                    default=recipe_record.to_json) + '\n' for recipe in recipes)
+    # mtime=0 so the same recipes always compress to the same bytes
+    return gzip.compress(lines.encode('utf-8'), compresslevel=6, mtime=0)
+
+
+def load_manifest(export_dir: Path | None = None) -> dict | None:
+    path: Path = (export_dir or get_export_dir()) / MANIFEST_NAME
+    try:
+        with open(path, 'r', encoding='utf-8') as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return None
+
+
+def save_manifest(export_dir: Path, manifest: dict) -> None:
+    manifest['updated_at'] = time.time()
+    manifest['recipes'] = sum(shard['recipes'] for shard in manifest['shards'].values())
+    temp_path: Path = export_dir / f'{MANIFEST_NAME}.tmp'
+    with open(temp_path, 'w', encoding='utf-8') as file:
+        json.dump(manifest, file, indent=2, sort_keys=True)
+    os.replace(temp_path, export_dir / MANIFEST_NAME)
+
+
+def new_manifest(shard_by: list[str], generation: int = 0) -> dict:
+    return {'version': MANIFEST_VERSION, 'shard_by': shard_by, 'generation': generation, 'shards': {}}
+
+
+def _write_shard(export_dir: Path, manifest: dict, name: str, data: bytes, count: int) -> str | None:
+    # Writes a new generation of the shard, returns the file it replaces for removal once the manifest is saved
+    manifest['generation'] += 1
+    file_name: str = f'{name}.{manifest["generation"]}.jsonl.gz'
+    path: Path = export_dir / file_name
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, 'wb') as file:
+        file.write(data)
+    old_shard: dict | None = manifest['shards'].get(name)
+    manifest['shards'][name] = {'file': file_name, 'recipes': count, 'bytes': len(data), 'crc32': zlib.crc32(data),
+                                'members': 1, 'updated_at': time.time()}
+    return old_shard['file'] if old_shard else None
+
+
+def _append_shard(export_dir: Path, manifest: dict, name: str, recipes: list[dict]) -> str | None:
+    shard: dict | None = manifest['shards'].get(name)
+    data: bytes = encode_recipes(recipes)
+    if shard is None:
+        return _write_shard(export_dir, manifest, name, data, len(recipes))
+
+    path: Path = export_dir / shard['file']
+    with open(path, 'r+b') as file:
+        # Anything past the manifest's size is from an append that didn't finish
+        file.truncate(shard['bytes'])
+        file.seek(shard['bytes'])
+        file.write(data)
+    shard['recipes'] += len(recipes)
+    shard['bytes'] += len(data)
+    shard['crc32'] = zlib.crc32(data, shard['crc32'])
+    shard['members'] += 1
+    shard['updated_at'] = time.time()
+    if shard['members'] > get_max_members():
+        return _compact_shard(export_dir, manifest, name)
+    return None
+
+
+def _compact_shard(export_dir: Path, manifest: dict, name: str) -> str | None:
+    shard: dict = manifest['shards'][name]
+    with gzip.open(export_dir / shard['file'], 'rb') as file:
+        data: bytes = gzip.compress(file.read(), compresslevel=6, mtime=0)
+    return _write_shard(export_dir, manifest, name, data, shard['recipes'])
+
+
+def _remove_files(export_dir: Path, file_names: Iterable[str | None]) -> None:
+    for file_name in file_names:
+        if file_name:
+            (export_dir / file_name).unlink(missing_ok=True)
+
+
+def _get_manifest(export_dir: Path) -> dict | None:
+    manifest: dict | None = load_manifest(export_dir)
+    if manifest is None or manifest.get('shard_by') != get_shard_by():
+        # Not exported yet, or sharded differently, ensure_export rebuilds it
+        return None
+    return manifest
+
+
+def add_recipes(recipes: list[dict]) -> None:
+    # New recipes are appended to their shards
+    if not recipes or not is_enabled():
+        return
+
+    export_dir: Path = get_export_dir()
+    with export_lock:
+        manifest: dict | None = _get_manifest(export_dir)
+        if manifest is None:
+            return
+        try:
+            replaced: list[str | None] = [
+                _append_shard(export_dir, manifest, name, shard_recipes)
+                for name, shard_recipes in group_by_shard(recipes, manifest['shard_by']).items()
+            ]
+        except OSError as e:
+            # The shards no longer match the manifest, so drop it and the export is rebuilt on the next start
+            get_logger().error(f'Could not add {len(recipes)} recipes to the export, it will be rebuilt: {e}')
+            (export_dir / MANIFEST_NAME).unlink(missing_ok=True)
+            return
+        save_manifest(export_dir, manifest)
+        _remove_files(export_dir, replaced)
+
+
+def update_recipes(recipes: list[dict], all_recipes: list[dict]) -> None:
+    # The shards of updated (or added) recipes are rewritten from the full collection. A recipe whose source or
+    # month changed has left its old shard, which now holds fewer recipes than the manifest says, so shards whose
+    # count no longer matches are rewritten too, and dropped once empty
+    if not recipes or not is_enabled():
+        return
+
+    export_dir: Path = get_export_dir()
+    with export_lock:
+        manifest: dict | None = _get_manifest(export_dir)
+        if manifest is None:
+            return
+        shard_by: list[str] = manifest['shard_by']
+        names: set[str] = {get_shard_name(recipe, shard_by) for recipe in recipes}
+        shards: dict[str, list[dict]] = group_by_shard(all_recipes, shard_by)
+        names.update(name for name, shard in manifest['shards'].items()
+                     if len(shards.get(name, [])) != shard['recipes'])
+        try:
+            replaced: list[str | None] = [
+                _write_shard(export_dir, manifest, name, encode_recipes(shards[name]), len(shards[name]))
+                for name in names if name in shards
+            ]
+        except OSError as e:
+            get_logger().error(f'Could not update {len(recipes)} recipes in the export, it will be rebuilt: {e}')
+            (export_dir / MANIFEST_NAME).unlink(missing_ok=True)
+            return
+        replaced.extend(manifest['shards'].pop(name)['file'] for name in names
+                        if name not in shards and name in manifest['shards'])
+        save_manifest(export_dir, manifest)
+        _remove_files(export_dir, replaced)
+
+
+def rebuild_export(all_recipes: list[dict]) -> dict:
+    export_dir: Path = get_export_dir()
+    export_dir.mkdir(parents=True, exist_ok=True)
+    with export_lock:
+        old_manifest: dict | None = load_manifest(export_dir)
+        # Generations carry on, so no new file has the name of one a reader of the old manifest may open
+        manifest: dict = new_manifest(get_shard_by(), old_manifest.get('generation', 0) if old_manifest else 0)
+        for name, shard_recipes in group_by_shard(all_recipes, manifest['shard_by']).items():
+            _write_shard(export_dir, manifest, name, encode_recipes(shard_recipes), len(shard_recipes))
+        save_manifest(export_dir, manifest)
+        if old_manifest:
+            _remove_files(export_dir, (shard['file'] for shard in old_manifest['shards'].values()))
+    get_logger().info(f'Exported {manifest["recipes"]} recipes to {len(manifest["shards"])} shards in {export_dir}')
+    return manifest
+
+
+def ensure_export(load_recipes: Callable[[], list[dict]]) -> None:
+    if is_enabled() and _get_manifest(get_export_dir()) is None:
+        rebuild_export(load_recipes())
+
+
+def _read_shard(export_dir: Path, shard: dict, verify: bool) -> bytes:
+    with open(export_dir / shard['file'], 'rb') as file:
+        data: bytes = file.read(shard['bytes'])
+    if len(data) != shard['bytes'] or (verify and zlib.crc32(data) != shard['crc32']):
+        raise ValueError(f'Export shard {shard["file"]} does not match the manifest')
+    return data
+
+
+def iter_shards(export_dir: Path | None = None, sources: list[str] | None = None,
+                months: list[str] | None = None) -> Iterator[tuple[str, dict]]:
+    export_dir = export_dir or get_export_dir()
+    manifest: dict | None = load_manifest(export_dir)
+    if manifest is None:
+        return
+
+    shard_by: list[str] = manifest['shard_by']
+    for name in sorted(manifest['shards']):
+        keys: dict[str, str] = dict(zip(shard_by, name.split('/')))
+        if sources and 'source' in keys and keys['source'] not in sources:
+            continue
+        if months and 'month' in keys and keys['month'] not in months:
+            continue
+        yield name, manifest['shards'][name]
+
+
+def iter_recipes(export_dir: Path | None = None, sources: list[str] | None = None, months: list[str] | None = None,
+                 verify: bool = True) -> Iterator[dict]:
+    # Yields the exported recipes a shard at a time, only the compressed shard being read is held in memory.
+    # sources are source keys (get_source_key), months are YYYY-MM or 'undated'
+    export_dir = export_dir or get_export_dir()
+    for name, shard in iter_shards(export_dir, sources, months):
+        try:
+            data: bytes = _read_shard(export_dir, shard, verify)
+        except FileNotFoundError:
+            # Replaced since the manifest was read, so read the current one
+            current: dict | None = (load_manifest(export_dir) or new_manifest([]))['shards'].get(name)
+            if current is None:
+                continue
+            data = _read_shard(export_dir, current, verify)
+        with gzip.GzipFile(fileobj=io.BytesIO(data)) as file:
+            for line in file:
+                yield json.loads(line)
+
+
+def verify_export(export_dir: Path | None = None) -> list[str]:
+    # Returns the shards that are missing, or whose size, checksum or recipe count don't match the manifest
+    export_dir = export_dir or get_export_dir()
+    problems: list[str] = []
+    for name, shard in iter_shards(export_dir):
+        try:
+            data: bytes = _read_shard(export_dir, shard, verify=True)
+            with gzip.GzipFile(fileobj=io.BytesIO(data)) as file:
+                count: int = sum(1 for _ in file)
+        except (OSError, ValueError, EOFError) as e:
+            problems.append(f'{name}: {e}')
+            continue
+        if count != shard['recipes']:
+            problems.append(f'{name}: {count} recipes, manifest says {shard["recipes"]}')
+    return problems
+
+
+if __name__ == '__main__':
+    load_dotenv()
+    init_logger()
+
+    arg_parser = argparse.ArgumentParser(description='Sharded JSON Lines export of the recipe collection')
+    subparsers = arg_parser.add_subparsers(dest='command', required=True)
+    subparsers.add_parser('rebuild', help='export the whole collection again')
+    subparsers.add_parser('verify', help='check the shards against the manifest')
+    cat_parser = subparsers.add_parser('cat', help='write the exported recipes to stdout as JSON Lines')
+    cat_parser.add_argument('--source', action='append', help='source key, e.g. bbc-good-food')
+    cat_parser.add_argument('--month', action='append', help='YYYY-MM or undated')
+    args = arg_parser.parse_args()
+
+    if args.command == 'rebuild':
+        from recipes import recipe_handler
+        rebuild_export(recipe_handler.load_existing_recipes())
+    elif args.command == 'verify':
+        export_problems: list[str] = verify_export()
+        for problem in export_problems:
+            get_logger().error(problem)
+        get_logger().info(f'Export verified, {len(export_problems)} problems')
+    else:
+        for exported_recipe in iter_recipes(sources=args.source, months=args.month):
+            print(json.dumps(exported_recipe, ensure_ascii=False))
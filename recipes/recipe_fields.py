@@ -0,0 +1,154 @@
+import re
+
+
+# Typed versions of the free-form schema.org fields, worked out once when a recipe is indexed so that
+# time, servings and ingredient filters don't have to re-parse every recipe on every search.
+
+VULGAR_FRACTIONS: dict[str, float] = {'½': 0.5, '¼': 0.25, '¾': 0.75, '⅓': 1 / 3, '⅔': 2 / 3, '⅛': 0.125,
+                                      '⅜': 0.375, '⅝': 0.625, '⅞': 0.875, '⅕': 0.2, '⅙': 1 / 6}
+UNIT_ALIASES: dict[str, str] = {
+    **{alias: 'g' for alias in ('g', 'gr', 'gram', 'grams', 'gramme', 'grammes')},
+    **{alias: 'kg' for alias in ('kg', 'kilo', 'kilos', 'kilogram', 'kilograms')},
+    **{alias: 'ml' for alias in ('ml', 'millilitre', 'millilitres', 'milliliter', 'milliliters')},
+    **{alias: 'l' for alias in ('l', 'litre', 'litres', 'liter', 'liters')},
+    **{alias: 'tsp' for alias in ('tsp', 'tsps', 'teaspoon', 'teaspoons')},
+    **{alias: 'tbsp' for alias in ('tbsp', 'tbsps', 'tbs', 'tablespoon', 'tablespoons')},
+    **{alias: 'cup' for alias in ('cup', 'cups')},
+    **{alias: 'oz' for alias in ('oz', 'ounce', 'ounces')},
+    **{alias: 'lb' for alias in ('lb', 'lbs', 'pound', 'pounds')},
+    **{alias: 'pinch' for alias in ('pinch', 'pinches')},
+    **{alias: 'clove' for alias in ('clove', 'cloves')},
+    **{alias: 'tin' for alias in ('tin', 'tins', 'can', 'cans')},
+    **{alias: 'bunch' for alias in ('bunch', 'bunches')},
+    **{alias: 'handful' for alias in ('handful', 'handfuls')},
+    **{alias: 'slice' for alias in ('slice', 'slices')},
+    **{alias: 'sprig' for alias in ('sprig', 'sprigs')}
+}
+
+FRACTION: str = f'[{"".join(VULGAR_FRACTIONS)}]'
+NUMBER: str = rf'\d+\s+\d+/\d+|\d+/\d+|\d+(?:\.\d+)?(?:\s*{FRACTION})?|{FRACTION}'
+ISO_DURATION_PATTERN: re.Pattern = re.compile(
+    r'^P(?:(?P<days>\d+(?:\.\d+)?)D)?(?:T(?:(?P<hours>\d+(?:\.\d+)?)H)?(?:(?P<minutes>\d+(?:\.\d+)?)M)?'
+    r'(?:(?P<seconds>\d+(?:\.\d+)?)S)?)?$',
+    re.IGNORECASE
+)
+TEXT_DURATION_PATTERN: re.Pattern = re.compile(
+    r'(?<![\d.])(\d+(?:\.\d+)?)\s*(d|days?|h|hrs?|hours?|m|mins?|minutes?|s|secs?|seconds?)\b', re.IGNORECASE
+)
+DURATION_UNIT_SECONDS: dict[str, int] = {'d': 86400, 'h': 3600, 'm': 60, 's': 1}
+BARE_NUMBER_PATTERN: re.Pattern = re.compile(r'^\d+(?:\.\d+)?$')
+YIELD_PATTERN: re.Pattern = re.compile(r'(\d+(?:\.\d+)?)(?:\s*(?:-|–|to)\s*(\d+(?:\.\d+)?))?')
+INGREDIENT_PATTERN: re.Pattern = re.compile(
+    rf'^\s*(?P<quantity>{NUMBER}|an?\b)(?:\s*(?:-|–|to)\s*(?:{NUMBER}))?\s*'
+    rf'(?:(?P<unit>{"|".join(sorted(UNIT_ALIASES, key=len, reverse=True))})\b\.?)?\s*(?:of\s+)?(?P<item>.*)$',
+    re.IGNORECASE
+)
+
+
+def parse_number(text: str) -> float | None:
+    text = text.strip().lower()
+    if text in ('a', 'an'):
+        return 1.0
+    total: float = 0.0
+    for part in text.split():
+        if '/' in part:
+            numerator, denominator = part.split('/', 1)
+            if not float(denominator):
+                return None
+            total += float(numerator) / float(denominator)
+        elif part[-1] in VULGAR_FRACTIONS:
+            total += (float(part[:-1]) if part[:-1] else 0.0) + VULGAR_FRACTIONS[part[-1]]
+        else:
+            total += float(part)
+    return total
+
+
+def parse_duration(value: list | dict | str | int | None) -> int | None:
+    # ISO 8601 durations (PT1H30M) as used by schema.org, falling back to text such as "1 hr 15 mins".
+    # A bare number, 45 or "45", is taken as minutes
+    if isinstance(value, list):
+        return next((seconds for item in value if (seconds := parse_duration(item)) is not None), None)
+    if isinstance(value, dict):
+        return parse_duration(value.get('value') or value.get('name'))
+    if isinstance(value, (int, float)):
+        return int(value * 60)
+    if not value or not isinstance(value, str):
+        return None
+
+    text: str = value.strip()
+    if BARE_NUMBER_PATTERN.match(text):
+        return parse_duration(float(text))
+    if match := ISO_DURATION_PATTERN.match(text):
+        if not any(match.groups()):
+            return None
+        return round(float(match['days'] or 0) * 86400 + float(match['hours'] or 0) * 3600
+                     + float(match['minutes'] or 0) * 60 + float(match['seconds'] or 0))
+
+    parts: list[tuple[str, str]] = TEXT_DURATION_PATTERN.findall(text)
+    if not parts:
+        return None
+    return round(sum(float(amount) * DURATION_UNIT_SECONDS[unit[0].lower()] for amount, unit in parts))
+
+
+def parse_yield(value: list | dict | str | int | None) -> tuple[float | None, float | None]:
+    # "Serves 4-6" gives (4, 6), "12 cookies" gives (12, 12)
+    if isinstance(value, list):
+        return next((servings for item in value if (servings := parse_yield(item))[0] is not None), (None, None))
+    if isinstance(value, dict):
+        return parse_yield(value.get('value') or value.get('name'))
+    if isinstance(value, (int, float)):
+        return float(value), float(value)
+    if not value or not isinstance(value, str):
+        return None, None
+
+    match: re.Match | None = YIELD_PATTERN.search(value)
+    if not match:
+        return None, None
+    low: float = float(match[1])
+    high: float = float(match[2]) if match[2] else low
+    return min(low, high), max(low, high)
+
+
+def parse_ingredient(line: str) -> tuple[float | None, str | None, str]:
+    # "1 ½ tbsp olive oil" gives (1.5, 'tbsp', 'olive oil'), ranges keep the lower quantity
+    text: str = re.sub(r'\s+', ' ', line).strip()
+    match: re.Match | None = INGREDIENT_PATTERN.match(text)
+    if not match or not match['item']:
+        return None, None, text.split(',')[0].strip().lower()
+
+    try:
+        quantity: float | None = parse_number(match['quantity'])
+    except ValueError:
+        quantity = None
+    unit: str | None = UNIT_ALIASES.get(match['unit'].lower()) if match['unit'] else None
+    return quantity, unit, match['item'].split(',')[0].strip().lower()
+
+
+def _get_lines(value: list | dict | str | None) -> list[str]:
+    if not value:
+        return []
+    elif isinstance(value, str):
+        return [value]
+    elif isinstance(value, list):
+        return [line for item in value for line in _get_lines(item)]
+    elif isinstance(value, dict):
+        return _get_lines(value.get('text') or value.get('name'))
+    return []
+
+
+def get_typed_fields(recipe: dict) -> dict:
+    prep_seconds: int | None = parse_duration(recipe.get('prep_time'))
+    cook_seconds: int | None = parse_duration(recipe.get('cook_time'))
+    total_seconds: int | None = parse_duration(recipe.get('total_time'))
+    if not total_seconds and (prep_seconds or cook_seconds):
+        total_seconds = (prep_seconds or 0) + (cook_seconds or 0)
+    yield_min, yield_max = parse_yield(recipe.get('recipe_yield'))
+
+    return {
+        'prep_seconds': prep_seconds,
+        'cook_seconds': cook_seconds,
+        'total_seconds': total_seconds,
+        'yield_min': yield_min,
+        'yield_max': yield_max,
+        'ingredients': [parse_ingredient(line) for line in _get_lines(recipe.get('ingredients'))]
+    }
@@ -2,118 +2,251 @@ import os
 import json
 import time
 
-from typing import Type
+from typing import Iterator, Type
 
 import email_handler
+import resilience
 import web_requests
 from logger import get_logger
 
 import recipes.recipe_parsers as parsers
+from recipes import (archive_jobs, near_duplicates, page_cache, page_dumps, recipe_images, recipe_index, recipe_keys,
+                     recipe_export, recipe_pipeline, recipe_record, site_registry)
+from recipes.recipe_record import Recipe
 
-known_sites: list[str] = [
-    'theguardian.com',
-    'houseandgarden.co.uk',
-    'bbcgoodfood.com',
-    'loveandlemons.com',
-    'realfood.tesco.com',
-    'sainsbury.co.uk',
-    'recipetineats.com',
-    'eatingwell.com'
-]
-
-
-archive_sites: list[str] = [
-    'telegraph.co.uk',
-    'thetimes.co.uk',
-    'thetimes.com'
-    ]
-
-
-parser_classes: dict[str, Type[parsers.BaseParser]] = {
-    **{site: parsers.BaseParser for site in known_sites},
-    'pinchofyum.com': parsers.PinchOfYumParser,
-    'waitrose.com': parsers.WaitroseParser,
-    'jamieoliver.com': parsers.JamieOliverParser,
-    'kingarthurbaking.com': parsers.KingArthurBakingParser,
-    'theguardian.com': parsers.GuardianParser
-
-}
-
-
-def get_recipes_from_url(url: str) -> list[dict]:
-    base_url: str = web_requests.get_base_url(url)
-    parser_class: Type[parsers.BaseParser] = parser_classes.get(base_url, parsers.UnknownParser)
-    parser: parsers.BaseParser = parser_class(url, base_url in archive_sites)
-    if not parser.has_soup_content():
-        return []
-
-    recipes: list[dict] = parser.get_recipes() or []
-    if recipes:
-        get_logger().info(f'Found {len(recipes)} recipes at {url}')
-        if isinstance(parser, parsers.UnknownParser):
-            base_url: str = web_requests.get_base_url(parser.url)
-            best_guess_name = parser.get_best_guess_name()
-            root_path = f'recipes/output/unprocessed/{base_url}'
-            os.makedirs(root_path, exist_ok=True)
-
-            with open(f'{root_path}/{best_guess_name}_recipes.json', 'w', encoding='utf-8') as file:
-                json.dump(recipes, file, indent=4)
+def get_recipes_from_url(url: str) -> list[Recipe]:
+    return list(iter_recipes_from_url(url))
+
+
+def iter_recipes_from_url(url: str) -> Iterator[Recipe]:
+    parser_class: Type[parsers.BaseParser] = site_registry.get_parser_class(url)
+    yield from iter_recipes_from_parser(parser_class(url, parser_class.needs_archive))
+
+
+def get_recipes_from_parser(parser: parsers.BaseParser) -> list[Recipe]:
+    return list(iter_recipes_from_parser(parser))
+
+
+def iter_recipes_from_parser(parser: parsers.BaseParser) -> Iterator[Recipe]:
+    # Recipes are passed on as they are built, the parser has already released the page by the first one
+    url: str = parser.url
+    if not parser.has_page_content():
+        return
+
+    count: int = 0
+    for recipe in parser.iter_recipes():
+        count += 1
+        yield recipe
+    if count:
+        get_logger().info(f'Found {count} recipes at {url}')
     else:
         get_logger().warning(f'No recipes found at {url}')
         if not isinstance(parser, parsers.UnknownParser):
             parser.dump_unprocessed_data()
-    return recipes
 
 
-def load_existing_recipes() -> list[dict]:
+def get_request_url(url: str) -> str | None:
+    if not site_registry.needs_archive(url):
+        return url
+
+    archive_url: str | None = archive_jobs.get_ready_archive_url(url) or web_requests.find_archive_url(url)
+    if archive_url:
+        return archive_url
+
+    # Don't hold up the pipeline while archive.ph saves the page, it is requeued once the snapshot is ready
+    archive_jobs.submit(url)
+    archive_url = archive_jobs.get_ready_archive_url(url)
+    if not archive_url:
+        get_logger().info(f'Waiting for archive of {url}, it will be requeued when ready')
+    return archive_url
+
+
+def fetch_page(url: str, defer_failing: bool = True) -> str | None:
+    request_url: str | None = get_request_url(url)
+    if not request_url:
+        return None
+
+    # The site's rules apply to its archive snapshots too
+    parser_class: Type[parsers.BaseParser] = site_registry.get_parser_class(url)
+    page_source: str | None = None
+    if not resilience.is_open(request_url):
+        page_source = web_requests.get_page_source(request_url, needs_browser=parser_class.needs_browser,
+                                                   ready_selector=parser_class.ready_selector)
+    if page_source:
+        page_cache.store_page(url, page_source, request_url)
+    elif defer_failing and resilience.is_open(request_url):
+        # The site is failing, so try again once its cool-down is over rather than losing the url
+        resilience.defer(url, 'Recipes', request_url)
+    return page_source
+
+
+def parse_page(url: str, page_source: str) -> tuple[list[Recipe], list[tuple[str, str, dict]]]:
+    # Runs in the parser worker processes, so images are downloaded and dumps are written afterwards
+    # by the writer stage
+    parser_class: Type[parsers.BaseParser] = site_registry.get_parser_class(url)
+    parser: parsers.BaseParser = parser_class(url, parser_class.needs_archive, page_source=page_source,
+                                              download_images=False)
+    dumps: list[tuple[str, str, dict]] = []
+    parser.dump_handler = lambda domain, name, dump: dumps.append((domain, name, dump))
+    return get_recipes_from_parser(parser), dumps
+
+
+def submit_dumps(dumps: list[tuple[str, str, dict]]) -> None:
+    for domain, name, dump in dumps:
+        page_dumps.submit_dump(domain, name, dump)
+
+
+def download_recipe_images(recipes: list[Recipe]) -> None:
+    recipe_images.store_recipe_images([recipe for recipe in recipes if recipe.get('image')])
+
+
+loaded_recipes: list[Recipe] | None = None
+# Where each loaded recipe is in loaded_recipes, by unique id
+loaded_recipe_indexes: dict[str, int] = {}
+
+
+def load_existing_recipes() -> list[Recipe]:
     filepath: str = os.getenv('OUTPUT_FILE')
     if os.path.exists(filepath):
         with open(filepath, 'r', encoding='utf-8') as file:
-            return json.load(file)
+            return recipe_record.load_recipes(json.load(file))
     return []
 
 
-def save_recipes(recipes: list[dict]) -> None:
+def get_loaded_recipes() -> list[Recipe]:
+    # The full recipe list is only needed to rewrite OUTPUT_FILE, so it is loaded on the first save
+    global loaded_recipes, loaded_recipe_indexes
+    if loaded_recipes is None:
+        loaded_recipes = load_existing_recipes()
+        loaded_recipe_indexes = {get_recipe_unique_id(recipe): index for index, recipe in enumerate(loaded_recipes)}
+    return loaded_recipes
+
+
+def get_loaded_recipe(unique_id: str) -> Recipe | None:
+    all_recipes: list[Recipe] = get_loaded_recipes()
+    index: int | None = loaded_recipe_indexes.get(unique_id)
+    return all_recipes[index] if index is not None else None
+
+
+def save_recipes(recipes: list[Recipe]) -> None:
     filepath: str = os.getenv('OUTPUT_FILE')
     with open(filepath, 'w', encoding='utf-8') as file:
-        json.dump(recipes, file, indent=4)
+        json.dump(recipes, file, indent=4, default=recipe_record.to_json)
 
 
 def get_recipe_unique_id(recipe: dict) -> str:
     return f'{recipe.get('recipe_name', '').replace(' ', '_')}||{recipe.get('url', '')}'
 
 
-def process_recipe_emails(email_bodies: list[str]) -> None:
-    all_recipes: list[dict] = load_existing_recipes()
-    existing_urls: set[str] = {recipe.get('url', '') for recipe in all_recipes}
-    unique_recipe_identifiers: set[str] = {get_recipe_unique_id(recipe) for recipe in all_recipes}
+def add_new_recipes(url: str, recipes: list[Recipe], save: bool = True) -> tuple[list[str], list[Recipe]]:
+    # Returns the unique ids and recipes that were added, not those merged into a near duplicate. save=False
+    # leaves saving OUTPUT_FILE and then calling store_new_recipes to the caller, for one save after a batch of urls
+    if not recipes:
+        return [], []
+
+    all_recipes: list[Recipe] = get_loaded_recipes()
+    duplicate_recipes: list[Recipe] = []
+    new_recipes: list[Recipe] = []
+    new_recipe_identifiers: set[str] = set()
+    recipe: Recipe
+    for recipe in recipes:
+        unique_id = get_recipe_unique_id(recipe)
+        # Recipes added earlier in an unsaved batch are loaded but don't have their keys yet
+        if (unique_id in new_recipe_identifiers or unique_id in loaded_recipe_indexes
+                or recipe_keys.has_recipe(unique_id)):
+            duplicate_recipes.append(recipe)
+        else:
+            new_recipe_identifiers.add(unique_id)
+            new_recipes.append(recipe)
+
+    if len(duplicate_recipes) > 0:
+        get_logger().warning(f'Found {len(duplicate_recipes)} duplicate recipes at {url}\n'
+                             f'Duplicates are not included in the output.')
+
+    new_recipes = [recipe for recipe in new_recipes if not check_near_duplicates(recipe, all_recipes)]
+
+    download_recipe_images(new_recipes)
+    added_identifiers: list[str] = []
+    for recipe in new_recipes:
+        added_identifiers.append(get_recipe_unique_id(recipe))
+        loaded_recipe_indexes[added_identifiers[-1]] = len(all_recipes)
+        all_recipes.append(recipe)
+    if save:
+        save_recipes(all_recipes)
+        store_new_recipes([url], added_identifiers, new_recipes)
+    return added_identifiers, new_recipes
+
+
+def store_new_recipes(urls: list[str], unique_ids: list[str], recipes: list[Recipe]) -> None:
+    # Only called once OUTPUT_FILE has been saved with the recipes, and the keys go last, so a crash part way
+    # never leaves a recipe counted as stored that isn't in OUTPUT_FILE, or in OUTPUT_FILE but without keys
+    recipe_index.index_recipes(recipes)
+    near_duplicates.add_recipes(recipes, get_recipe_unique_id)
+    recipe_export.add_recipes(recipes)
+    recipe_keys.add_keys(urls, unique_ids)
+
+
+def check_near_duplicates(recipe: Recipe, all_recipes: list[Recipe]) -> bool:
+    # Returns True when the recipe was merged into an existing one and should not be added
+    signature: list[int] | None = near_duplicates.get_recipe_signature(recipe)
+    if not signature:
+        return False
+
+    matches: list[tuple[str, float]] = near_duplicates.find_near_duplicates(signature, get_recipe_unique_id(recipe))
+    if not matches:
+        return False
+
+    match_id, similarity = matches[0]
+    get_logger().info(f'{recipe.get('recipe_name')} at {recipe.get('url')} looks like {match_id} '
+                      f'({similarity:.0%} similar)')
+
+    if os.getenv('NEAR_DUPLICATE_ACTION', 'flag') == 'merge':
+        existing: Recipe | None = get_loaded_recipe(match_id)
+        if existing is not None:
+            alternate_urls: list[str] = existing.setdefault('alternate_urls', [])
+            if recipe.get('url') not in alternate_urls:
+                alternate_urls.append(recipe.get('url'))
+                recipe_export.update_recipes([existing], all_recipes)
+            return True
 
+    recipe['near_duplicate_of'] = [match_id for match_id, _ in matches]
+    return False
+
+
+def prepare_recipe_stores() -> None:
+    release_loaded_recipes()
+    recipe_keys.ensure_keys(get_loaded_recipes, get_recipe_unique_id)
+    recipe_index.ensure_index(get_loaded_recipes)
+    near_duplicates.ensure_signatures(get_loaded_recipes, get_recipe_unique_id)
+    recipe_export.ensure_export(get_loaded_recipes)
+
+
+def release_loaded_recipes() -> None:
+    global loaded_recipes, loaded_recipe_indexes
+    loaded_recipes = None
+    loaded_recipe_indexes = {}
+
+
+def process_recipe_emails(email_bodies: list[str]) -> list[float]:
+    # Returns how long each written url took from fetch to write, for the load test
+    prepare_recipe_stores()
     urls: list[str] = email_handler.get_urls(email_bodies)
     get_logger().info(f'Recipe url queue size: {len(urls)}')
-    for url in urls:
-        if url in existing_urls:
+
+    def fetch(url: str) -> str | None:
+        if recipe_keys.has_url(url):
             get_logger().info(f'URL already in output: {url}')
-            continue
-
-        recipes: list[dict] = get_recipes_from_url(url)
-        if not recipes:
-            continue
-
-        duplicate_recipes: list[dict] = []
-        new_recipes: list[dict] = []
-        recipe: dict
-        for recipe in recipes:
-            unique_id = get_recipe_unique_id(recipe)
-            if unique_id in unique_recipe_identifiers:
-                duplicate_recipes.append(recipe)
-            else:
-                unique_recipe_identifiers.add(unique_id)
-                new_recipes.append(recipe)
-
-        if len(duplicate_recipes) > 0:
-            get_logger().warning(f'Found {len(duplicate_recipes)} duplicate recipes at {url}\n'
-                                 f'Duplicates are not included in the output.')
-
-        all_recipes.extend(new_recipes)
-        save_recipes(all_recipes)
-        time.sleep(1)  # Wait for 1 second before processing the next URL
+            return None
+
+        page_source: str | None = fetch_page(url)
+        time.sleep(float(os.getenv('RECIPE_FETCH_DELAY', '1')))  # Wait before fetching the next URL
+        return page_source
+
+    def write(url: str, parse_result: tuple[list[Recipe], list[tuple[str, str, dict]]]) -> None:
+        recipes, dumps = parse_result
+        submit_dumps(dumps)
+        add_new_recipes(url, recipes)
+
+    latencies: list[float] = recipe_pipeline.run_pipeline(urls, fetch, parse_page, write)
+    release_loaded_recipes()
+    return latencies
@@ -0,0 +1,177 @@
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from pathlib import Path
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+import requests
+
+import http_client
+import resilience
+from logger import get_logger
+
+try:
+    from PIL import Image, ImageOps, UnidentifiedImageError
+except ImportError:
+    Image = None
+
+
+# Recipe images are only shown as cards and thumbnails, so the multi-megabyte originals are not kept.
+# Where the CDN takes a width parameter the right size is requested, and with Pillow installed every image is
+# resized to IMAGE_SIZES and transcoded to IMAGE_FORMAT. Without Pillow the downloaded image is stored as is.
+# The stored variants, with their dimensions and bytes, are recorded on the recipe under image_variants.
+
+WIDTH_PARAMS: tuple[str, ...] = ('width', 'w', 'wid', 'imwidth')
+# Resizing a signed url invalidates the signature
+SIGNATURE_PARAMS: tuple[str, ...] = ('s', 'sig', 'signature')
+
+image_executor: ThreadPoolExecutor | None = None
+executor_lock: threading.Lock = threading.Lock()
+warned_format: bool = False
+
+
+def get_image_sizes() -> list[int]:
+    return sorted({int(size) for size in os.getenv('IMAGE_SIZES', '400,1200').split(',') if size.strip()},
+                  reverse=True)
+
+
+def get_image_format() -> str:
+    global warned_format
+    image_format: str = os.getenv('IMAGE_FORMAT', 'webp').lower()
+    if image_format == 'avif' and '.avif' not in Image.registered_extensions():
+        if not warned_format:
+            get_logger().warning('This Pillow build cannot write AVIF, saving images as WebP')
+            warned_format = True
+        return 'webp'
+    return image_format
+
+
+def get_image_quality() -> int:
+    return int(os.getenv('IMAGE_QUALITY', '80'))
+
+
+def get_image_executor() -> ThreadPoolExecutor:
+    # Downloads wait on the network and Pillow releases the GIL while resizing and encoding, so threads suffice
+    global image_executor
+    with executor_lock:
+        if image_executor is None:
+            image_executor = ThreadPoolExecutor(max_workers=int(os.getenv('IMAGE_WORKERS', '4')),
+                                                thread_name_prefix='recipe images')
+    return image_executor
+
+
+def get_sized_image_url(url: str, width: int) -> str | None:
+    parts = urlsplit(url)
+    query: list[tuple[str, str]] = parse_qsl(parts.query, keep_blank_values=True)
+    keys: set[str] = {key.lower() for key, _ in query}
+    if keys.isdisjoint(WIDTH_PARAMS) or not keys.isdisjoint(SIGNATURE_PARAMS):
+        return None
+    sized_query: list[tuple[str, str]] = [(key, str(width) if key.lower() in WIDTH_PARAMS else value)
+                                          for key, value in query]
+    return urlunsplit(parts._replace(query=urlencode(sized_query)))
+
+
+def fetch_image(url: str) -> bytes | None:
+    # Try the CDN's own resize first, falling back to the original
+    sized_url: str | None = get_sized_image_url(url, get_image_sizes()[0])
+    for request_url in ([sized_url] if sized_url else []) + [url]:
+        try:
+            return resilience.call_with_retries(request_url, lambda attempt: _get_image_bytes(request_url),
+                                                retry_on=(requests.ConnectionError, requests.Timeout))
+        except resilience.CircuitOpenError as circuit_error:
+            get_logger().warning(f'Skipping the image at {request_url}: {circuit_error}')
+            return None
+        except requests.RequestException as req_error:
+            get_logger().warning(f'HTTP error occurred while downloading the image at {request_url}: {req_error}')
+    return None
+
+
+def _get_image_bytes(url: str) -> bytes:
+    response: requests.Response = http_client.get(url)
+    response.raise_for_status()
+    return response.content
+
+
+def get_image_name(url: str, recipe_name: str) -> str:
+    image_name: str
+    if recipe_name:
+        image_name = recipe_name
+    else:
+        image_name = Path(urlsplit(url).path).stem or 'image'
+    return re.sub(r'[?:/\\*"<>|]', '', image_name)
+
+
+def get_image_dir(source: str | None) -> Path:
+    images_dir: Path = Path(os.getenv('IMAGES_DIR', '.'))
+    path: Path = images_dir / source.replace(' ', '_') if source else images_dir
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+def save_original(image_bytes: bytes, url: str, image_dir: Path, image_name: str, source: str | None) -> list[dict]:
+    image_ext: str = Path(urlsplit(url).path).suffix or '.jpg'
+    file_name: str = f'{image_name}{image_ext}'
+    (image_dir / file_name).write_bytes(image_bytes)
+    return [{'path': f'{source}/{file_name}', 'width': None, 'height': None, 'bytes': len(image_bytes),
+             'format': image_ext.lstrip('.').lower()}]
+
+
+def save_variants(image_bytes: bytes, image_dir: Path, image_name: str, source: str | None) -> list[dict]:
+    image_format: str = get_image_format()
+    variants: list[dict] = []
+    with Image.open(BytesIO(image_bytes)) as original:
+        image = ImageOps.exif_transpose(original)
+        if image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGBA' if 'A' in image.getbands() or 'transparency' in image.info else 'RGB')
+
+        # Never upscale, a small original just gives a single variant
+        for width in sorted({min(size, image.width) for size in get_image_sizes()}, reverse=True):
+            height: int = max(1, round(image.height * width / image.width))
+            resized = image if width == image.width else image.resize((width, height), Image.LANCZOS,
+                                                                     reducing_gap=3.0)
+            file_name: str = f'{image_name}-{width}.{image_format}'
+            resized.save(image_dir / file_name, image_format.upper(), quality=get_image_quality())
+            variants.append({'path': f'{source}/{file_name}', 'width': width, 'height': height,
+                             'bytes': (image_dir / file_name).stat().st_size, 'format': image_format})
+    return variants
+
+
+def store_recipe_image(recipe: dict) -> dict:
+    url: str | None = recipe.get('image')
+    if not url or not url.startswith(('http://', 'https://')):
+        return recipe
+
+    recipe['image'] = None
+    image_bytes: bytes | None = fetch_image(url)
+    if image_bytes is None:
+        return recipe
+
+    source: str | None = recipe.get('source')
+    image_name: str = get_image_name(url, recipe.get('recipe_name', ''))
+    try:
+        image_dir: Path = get_image_dir(source)
+        variants: list[dict]
+        if Image is None:
+            variants = save_original(image_bytes, url, image_dir, image_name, source)
+        else:
+            try:
+                variants = save_variants(image_bytes, image_dir, image_name, source)
+            except (UnidentifiedImageError, ValueError) as image_error:
+                get_logger().warning(f'Could not convert the image at {url}, storing it as is: {image_error}')
+                variants = save_original(image_bytes, url, image_dir, image_name, source)
+    except OSError as os_error:
+        get_logger().error(f'File system error occurred storing the image at {url}: {os_error}')
+        return recipe
+
+    recipe.update({'image': variants[0]['path'], 'image_url': url, 'image_variants': variants})
+    return recipe
+
+
+def store_recipe_images(recipes: list[dict]) -> None:
+    for future in [get_image_executor().submit(store_recipe_image, recipe) for recipe in recipes]:
+        try:
+            future.result()
+        except Exception as unexpected_error:
+            get_logger().error(f'An unexpected error occurred storing a recipe image: {unexpected_error}')
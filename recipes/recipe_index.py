@@ -0,0 +1,243 @@
+import argparse
+import json
+import sqlite3
+from typing import Callable
+
+from dotenv import load_dotenv
+
+from logger import get_logger, init_logger
+from recipes import recipe_db, recipe_fields
+
+
+# bm25 weights for recipe_id, recipe_name, ingredients, description, author, source
+SEARCH_WEIGHTS: str = '0.0, 10.0, 5.0, 1.0, 2.0, 1.0'
+# Bumped when recipe_fields parses differently, so the typed fields are worked out again
+RECIPE_FIELDS_VERSION: str = '2'
+
+
+SCHEMA: str = '''
+    CREATE TABLE IF NOT EXISTS search_recipes (
+        id INTEGER PRIMARY KEY,
+        recipe_id TEXT NOT NULL UNIQUE,
+        recipe_name TEXT,
+        url TEXT,
+        source TEXT,
+        published_date TEXT
+    );
+    CREATE INDEX IF NOT EXISTS search_recipes_source ON search_recipes (source);
+    CREATE INDEX IF NOT EXISTS search_recipes_published_date ON search_recipes (published_date);
+    CREATE VIRTUAL TABLE IF NOT EXISTS search_text USING fts5(
+        recipe_id UNINDEXED, recipe_name, ingredients, description, author, source,
+        tokenize = 'porter unicode61'
+    );
+    CREATE TABLE IF NOT EXISTS recipe_fields (
+        recipe_row INTEGER PRIMARY KEY,
+        prep_seconds INTEGER,
+        cook_seconds INTEGER,
+        total_seconds INTEGER,
+        yield_min REAL,
+        yield_max REAL,
+        ingredient_count INTEGER NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS recipe_fields_total_seconds ON recipe_fields (total_seconds);
+    CREATE INDEX IF NOT EXISTS recipe_fields_yield_max ON recipe_fields (yield_max);
+    CREATE TABLE IF NOT EXISTS recipe_ingredients (
+        recipe_row INTEGER NOT NULL,
+        position INTEGER NOT NULL,
+        quantity REAL,
+        unit TEXT,
+        item TEXT NOT NULL,
+        PRIMARY KEY (recipe_row, position)
+    ) WITHOUT ROWID;
+    CREATE INDEX IF NOT EXISTS recipe_ingredients_item ON recipe_ingredients (item);
+'''
+
+
+def get_connection() -> sqlite3.Connection:
+    return recipe_db.get_connection(SCHEMA)
+
+
+def _get_text(value: list | dict | str | None) -> str:
+    if not value:
+        return ''
+    elif isinstance(value, str):
+        return value
+    elif isinstance(value, list):
+        return '\n'.join(_get_text(item) for item in value)
+    elif isinstance(value, dict):
+        return _get_text(value.get('text') or value.get('name'))
+    return str(value)
+
+
+def _index_recipe(connection: sqlite3.Connection, recipe_id: str, recipe: dict) -> None:
+    row = connection.execute(
+        '''INSERT INTO search_recipes (recipe_id, recipe_name, url, source, published_date)
+           VALUES (?, ?, ?, ?, ?)
+           ON CONFLICT (recipe_id) DO UPDATE SET recipe_name = excluded.recipe_name, url = excluded.url,
+               source = excluded.source, published_date = excluded.published_date
+           RETURNING id''',
+        (recipe_id, recipe.get('recipe_name'), recipe.get('url'), recipe.get('source'),
+         recipe.get('published_date'))
+    ).fetchone()
+
+    connection.execute('DELETE FROM search_text WHERE rowid = ?', (row['id'],))
+    connection.execute(
+        '''INSERT INTO search_text (rowid, recipe_id, recipe_name, ingredients, description, author, source)
+           VALUES (?, ?, ?, ?, ?, ?, ?)''',
+        (row['id'], recipe_id, _get_text(recipe.get('recipe_name')), _get_text(recipe.get('ingredients')),
+         _get_text(recipe.get('description')), _get_text(recipe.get('author')), _get_text(recipe.get('source')))
+    )
+    _index_typed_fields(connection, row['id'], recipe)
+
+
+def _index_typed_fields(connection: sqlite3.Connection, recipe_row: int, recipe: dict) -> None:
+    fields: dict = recipe_fields.get_typed_fields(recipe)
+    connection.execute(
+        '''INSERT OR REPLACE INTO recipe_fields (recipe_row, prep_seconds, cook_seconds, total_seconds, yield_min,
+               yield_max, ingredient_count)
+           VALUES (?, ?, ?, ?, ?, ?, ?)''',
+        (recipe_row, fields['prep_seconds'], fields['cook_seconds'], fields['total_seconds'], fields['yield_min'],
+         fields['yield_max'], len(fields['ingredients']))
+    )
+    connection.execute('DELETE FROM recipe_ingredients WHERE recipe_row = ?', (recipe_row,))
+    connection.executemany(
+        'INSERT INTO recipe_ingredients (recipe_row, position, quantity, unit, item) VALUES (?, ?, ?, ?, ?)',
+        [(recipe_row, position, quantity, unit, item)
+         for position, (quantity, unit, item) in enumerate(fields['ingredients'])]
+    )
+
+
+def index_recipes(recipes: list[dict]) -> None:
+    # Imported here as recipe_handler imports this module
+    from recipes.recipe_handler import get_recipe_unique_id
+
+    if not recipes:
+        return
+
+    connection: sqlite3.Connection = get_connection()
+    with connection:
+        for recipe in recipes:
+            _index_recipe(connection, get_recipe_unique_id(recipe), recipe)
+
+
+def get_indexed_count() -> int:
+    return get_connection().execute('SELECT COUNT(*) FROM search_recipes').fetchone()[0]
+
+
+def rebuild_index(all_recipes: list[dict]) -> None:
+    connection: sqlite3.Connection = get_connection()
+    with connection:
+        connection.execute('DELETE FROM search_text')
+        connection.execute('DELETE FROM search_recipes')
+        connection.execute('DELETE FROM recipe_fields')
+        connection.execute('DELETE FROM recipe_ingredients')
+    index_recipes(all_recipes)
+    get_logger().info(f'Indexed {len(all_recipes)} recipes for search')
+
+
+def ensure_index(load_recipes: Callable[[], list[dict]]) -> None:
+    # An index built before the typed fields existed, or with an older parsing of them, is rebuilt once
+    if get_indexed_count() == 0 or recipe_db.get_meta('recipe_fields_indexed') != RECIPE_FIELDS_VERSION:
+        all_recipes: list[dict] = load_recipes()
+        if all_recipes:
+            rebuild_index(all_recipes)
+        recipe_db.set_meta('recipe_fields_indexed', RECIPE_FIELDS_VERSION)
+
+
+def _quote(term: str) -> str:
+    return '"' + term.replace('"', '""') + '"'
+
+
+def _get_match_query(text: str, include: list[str]) -> str:
+    terms: list[str] = [_quote(term) for term in text.split()]
+    terms.extend(f'ingredients : {_quote(ingredient)}' for ingredient in include)
+    return ' AND '.join(terms)
+
+
+def _get_exclude_query(exclude: list[str]) -> str:
+    return ' OR '.join(f'ingredients : {_quote(ingredient)}' for ingredient in exclude)
+
+
+def search(text: str = '', include: list[str] | None = None, exclude: list[str] | None = None,
+           source: str | None = None, since: str | None = None, until: str | None = None,
+           limit: int = 20, max_minutes: int | None = None, min_servings: float | None = None,
+           max_servings: float | None = None, max_ingredients: int | None = None) -> list[dict]:
+    include = include or []
+    exclude = exclude or []
+    match_query: str = _get_match_query(text, include)
+
+    conditions: list[str] = []
+    parameters: list[str | int | float] = []
+    typed_columns: str = 'f.total_seconds, f.yield_min, f.yield_max, f.ingredient_count'
+    if match_query:
+        select: str = (f'SELECT r.*, {typed_columns}, bm25(search_text, {SEARCH_WEIGHTS}) AS score '
+                       'FROM search_text JOIN search_recipes r ON r.id = search_text.rowid '
+                       'LEFT JOIN recipe_fields f ON f.recipe_row = r.id')
+        conditions.append('search_text MATCH ?')
+        parameters.append(match_query)
+        order: str = 'score'
+    else:
+        select = (f'SELECT r.*, {typed_columns}, 0.0 AS score FROM search_recipes r '
+                  'LEFT JOIN recipe_fields f ON f.recipe_row = r.id')
+        order = 'r.published_date DESC'
+
+    if exclude:
+        conditions.append('r.id NOT IN (SELECT rowid FROM search_text WHERE search_text MATCH ?)')
+        parameters.append(_get_exclude_query(exclude))
+    if source:
+        conditions.append('r.source = ? COLLATE NOCASE')
+        parameters.append(source)
+    if since:
+        conditions.append('r.published_date >= ?')
+        parameters.append(since)
+    if until:
+        conditions.append('r.published_date <= ?')
+        parameters.append(until)
+    if max_minutes is not None:
+        conditions.append('f.total_seconds <= ?')
+        parameters.append(max_minutes * 60)
+    if min_servings is not None:
+        conditions.append('f.yield_max >= ?')
+        parameters.append(min_servings)
+    if max_servings is not None:
+        conditions.append('f.yield_min <= ?')
+        parameters.append(max_servings)
+    if max_ingredients is not None:
+        conditions.append('f.ingredient_count <= ?')
+        parameters.append(max_ingredients)
+
+    where: str = f'WHERE {" AND ".join(conditions)}' if conditions else ''
+    parameters.append(limit)
+    rows: list[sqlite3.Row] = get_connection().execute(
+        f'{select} {where} ORDER BY {order} LIMIT ?', parameters
+    ).fetchall()
+    return [dict(row) for row in rows]
+
+
+if __name__ == '__main__':
+    load_dotenv()
+    init_logger()
+
+    arg_parser = argparse.ArgumentParser(description='Search the recipe collection')
+    arg_parser.add_argument('text', nargs='*', help='words to match in any field')
+    arg_parser.add_argument('--with', dest='include', action='append', default=[], help='required ingredient')
+    arg_parser.add_argument('--without', dest='exclude', action='append', default=[], help='excluded ingredient')
+    arg_parser.add_argument('--source')
+    arg_parser.add_argument('--since', help='earliest published date, e.g. 2023-01-01')
+    arg_parser.add_argument('--until', help='latest published date, e.g. 2024-12-31')
+    arg_parser.add_argument('--max-minutes', type=int, help='longest total time, e.g. 30')
+    arg_parser.add_argument('--min-servings', type=float, help='serves at least, e.g. 4')
+    arg_parser.add_argument('--max-servings', type=float, help='serves at most')
+    arg_parser.add_argument('--max-ingredients', type=int)
+    arg_parser.add_argument('--limit', type=int, default=20)
+    arg_parser.add_argument('--rebuild', action='store_true', help='rebuild the index from OUTPUT_FILE')
+    args = arg_parser.parse_args()
+
+    if args.rebuild:
+        from recipes.recipe_handler import load_existing_recipes
+        rebuild_index(load_existing_recipes())
+
+    results: list[dict] = search(' '.join(args.text), args.include, args.exclude, args.source, args.since,
+                                 args.until, args.limit, args.max_minutes, args.min_servings, args.max_servings,
+                                 args.max_ingredients)
+    print(json.dumps(results, indent=4))
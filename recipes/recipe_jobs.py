@@ -0,0 +1,438 @@
+import argparse
+import json
+import multiprocessing
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+from dotenv import load_dotenv
+
+import email_handler
+import resilience
+from logger import get_logger, init_logger
+from recipes import recipe_db
+
+
+# Coordinator/worker mode (RECIPE_JOBS=true). The coordinator (main.py) turns recipe emails, requeued archive
+# and deferred urls into url jobs in RECIPES_DB, and RECIPE_WORKERS worker processes (plus any started with
+# `python -m recipes.recipe_jobs worker` against the same RECIPES_DB, OUTPUT_FILE and IMAGES_DIR) claim them.
+# A claim is a lease of JOB_LEASE_SECONDS: a worker that dies loses its jobs to the next claim once it runs out.
+# Claims also take the url's host for JOB_HOST_INTERVAL, so workers together stay polite to each site.
+# A worker fetches, parses and stores images, then commits its recipes and completes the job in one IMMEDIATE
+# transaction. The duplicate check against stored keys and other workers' commits happens inside that
+# transaction, so two workers can never both add a recipe, and a worker that lost its lease commits nothing.
+# Only the coordinator's publisher writes OUTPUT_FILE, the search index, near-duplicate signatures and export,
+# moving committed recipes over in batches, so those stores keep a single writer.
+# SQLite needs a local file system for its WAL, so workers on other nodes need the store on a shared disk
+# that supports it, not a network mount.
+
+SCHEMA: str = '''
+    CREATE TABLE IF NOT EXISTS recipe_jobs (
+        url TEXT PRIMARY KEY,
+        host TEXT NOT NULL,
+        status TEXT NOT NULL,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        deferrals INTEGER NOT NULL DEFAULT 0,
+        lease_owner TEXT,
+        lease_expires REAL,
+        not_before REAL NOT NULL DEFAULT 0,
+        enqueued_at REAL NOT NULL,
+        finished_at REAL,
+        recipes INTEGER,
+        error TEXT
+    );
+    CREATE INDEX IF NOT EXISTS recipe_jobs_status ON recipe_jobs (status, not_before);
+    CREATE TABLE IF NOT EXISTS recipe_job_hosts (
+        host TEXT PRIMARY KEY,
+        next_at REAL NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS recipe_job_results (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        unique_id TEXT NOT NULL UNIQUE,
+        url TEXT NOT NULL,
+        data TEXT NOT NULL,
+        committed_at REAL NOT NULL
+    );
+'''
+
+publisher_thread: threading.Thread | None = None
+worker_processes: list[multiprocessing.Process] = []
+
+
+def get_connection() -> sqlite3.Connection:
+    return recipe_db.get_connection(SCHEMA)
+
+
+def is_enabled() -> bool:
+    return os.getenv('RECIPE_JOBS', 'false') == 'true'
+
+
+def get_worker_count() -> int:
+    return int(os.getenv('RECIPE_WORKERS', '4'))
+
+
+def get_lease_seconds() -> float:
+    return float(os.getenv('JOB_LEASE_SECONDS', '600'))
+
+
+def get_max_attempts() -> int:
+    return int(os.getenv('JOB_MAX_ATTEMPTS', '3'))
+
+
+def get_max_deferrals() -> int:
+    return int(os.getenv('JOB_MAX_DEFERRALS', '24'))
+
+
+def get_retry_delay() -> float:
+    return float(os.getenv('JOB_RETRY_DELAY', '300'))
+
+
+def get_host_interval() -> float:
+    return float(os.getenv('JOB_HOST_INTERVAL', '1'))
+
+
+def get_poll_interval() -> float:
+    return float(os.getenv('JOB_POLL_INTERVAL', '1'))
+
+
+def get_publish_interval() -> float:
+    return float(os.getenv('JOB_PUBLISH_INTERVAL', '5'))
+
+
+def get_publish_batch_size() -> int:
+    return int(os.getenv('JOB_PUBLISH_BATCH_SIZE', '500'))
+
+
+def get_worker_id() -> str:
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+def _begin(connection: sqlite3.Connection) -> None:
+    # Takes the write lock up front, a deferred transaction that reads and then writes can fail to upgrade
+    connection.execute('BEGIN IMMEDIATE')
+
+
+def enqueue(urls: list[str]) -> int:
+    # New urls are queued, urls waiting on a retry or that failed are queued again, done and leased ones are left
+    now: float = time.time()
+    connection: sqlite3.Connection = get_connection()
+    with connection:
+        cursor: sqlite3.Cursor = connection.executemany(
+            '''INSERT INTO recipe_jobs (url, host, status, enqueued_at) VALUES (?, ?, 'queued', ?)
+               ON CONFLICT (url) DO UPDATE SET status = 'queued', not_before = 0, attempts = 0, deferrals = 0,
+                   error = NULL
+               WHERE status = 'failed' OR (status = 'queued' AND not_before > ?)''',
+            [(url, resilience.get_domain(url), now, now) for url in dict.fromkeys(urls)]
+        )
+    return cursor.rowcount
+
+
+def enqueue_recipe_emails(email_bodies: list[str]) -> None:
+    # The dispatcher's Recipes handler in coordinator mode
+    urls: list[str] = email_handler.get_urls(email_bodies)
+    queued: int = enqueue(urls)
+    get_logger().info(f'Queued {queued} of {len(urls)} recipe urls as jobs')
+
+
+def _reclaim_expired(connection: sqlite3.Connection, now: float) -> None:
+    connection.execute(
+        '''UPDATE recipe_jobs SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'queued' END,
+               lease_owner = NULL, error = 'lease expired'
+           WHERE status = 'leased' AND lease_expires < ?''',
+        (get_max_attempts(), now)
+    )
+
+
+def claim(worker_id: str) -> str | None:
+    now: float = time.time()
+    connection: sqlite3.Connection = get_connection()
+    _begin(connection)
+    try:
+        _reclaim_expired(connection, now)
+        row: sqlite3.Row | None = connection.execute(
+            '''SELECT j.url, j.host FROM recipe_jobs j LEFT JOIN recipe_job_hosts h ON h.host = j.host
+               WHERE j.status = 'queued' AND j.not_before <= ? AND coalesce(h.next_at, 0) <= ?
+               ORDER BY j.not_before, j.enqueued_at LIMIT 1''',
+            (now, now)
+        ).fetchone()
+        if row is not None:
+            connection.execute(
+                '''UPDATE recipe_jobs SET status = 'leased', lease_owner = ?, lease_expires = ?,
+                       attempts = attempts + 1
+                   WHERE url = ?''',
+                (worker_id, now + get_lease_seconds(), row['url'])
+            )
+            connection.execute('INSERT OR REPLACE INTO recipe_job_hosts (host, next_at) VALUES (?, ?)',
+                               (row['host'], now + get_host_interval()))
+        connection.commit()
+    except BaseException:
+        connection.rollback()
+        raise
+    return row['url'] if row is not None else None
+
+
+def _finish(connection: sqlite3.Connection, url: str, worker_id: str, status: str, recipes: int | None = None,
+            error: str | None = None, not_before: float = 0, deferred: bool = False) -> bool:
+    cursor: sqlite3.Cursor = connection.execute(
+        '''UPDATE recipe_jobs SET status = ?, lease_owner = NULL, lease_expires = NULL, not_before = ?,
+               finished_at = ?, recipes = ?, error = ?, deferrals = deferrals + ?,
+               attempts = attempts - ?
+           WHERE url = ? AND status = 'leased' AND lease_owner = ?''',
+        (status, not_before, time.time() if status in ('done', 'failed') else None, recipes, error, int(deferred),
+         int(deferred), url, worker_id)
+    )
+    return cursor.rowcount == 1
+
+
+def commit(url: str, worker_id: str, recipes: list) -> tuple[int, int] | None:
+    # Returns (added, duplicates), or None when the lease was lost and nothing was committed
+    from recipes import recipe_handler, recipe_keys, recipe_record
+
+    connection: sqlite3.Connection = get_connection()
+    _begin(connection)
+    try:
+        added: int = 0
+        now: float = time.time()
+        for recipe in recipes:
+            unique_id: str = recipe_handler.get_recipe_unique_id(recipe)
+            if recipe_keys.has_recipe(unique_id):
+                continue
+            cursor: sqlite3.Cursor = connection.execute(
+                'INSERT OR IGNORE INTO recipe_job_results (unique_id, url, data, committed_at) VALUES (?, ?, ?, ?)',
+                (unique_id, url, json.dumps(recipe, default=recipe_record.to_json), now)
+            )
+            added += cursor.rowcount
+        if not _finish(connection, url, worker_id, 'done', recipes=added):
+            connection.rollback()
+            get_logger().warning(f'Lost the lease on {url}, discarding its recipes')
+            return None
+        connection.commit()
+    except BaseException:
+        connection.rollback()
+        raise
+    return added, len(recipes) - added
+
+
+def defer(url: str, worker_id: str, delay: float, reason: str) -> None:
+    # Not a failure of the job, so it doesn't use up an attempt, but a url can only wait so many times
+    connection: sqlite3.Connection = get_connection()
+    with connection:
+        row: sqlite3.Row | None = connection.execute('SELECT deferrals FROM recipe_jobs WHERE url = ?',
+                                                     (url,)).fetchone()
+        if row is not None and row['deferrals'] + 1 >= get_max_deferrals():
+            _finish(connection, url, worker_id, 'failed', error=f'gave up waiting: {reason}', deferred=True)
+            get_logger().warning(f'Giving up on {url} after {row["deferrals"] + 1} retries: {reason}')
+        else:
+            _finish(connection, url, worker_id, 'queued', error=reason, not_before=time.time() + delay,
+                    deferred=True)
+
+
+def fail(url: str, worker_id: str, error: str) -> None:
+    connection: sqlite3.Connection = get_connection()
+    with connection:
+        row: sqlite3.Row | None = connection.execute('SELECT attempts FROM recipe_jobs WHERE url = ?',
+                                                     (url,)).fetchone()
+        if row is not None and row['attempts'] >= get_max_attempts():
+            _finish(connection, url, worker_id, 'failed', error=error)
+        else:
+            _finish(connection, url, worker_id, 'queued', error=error, not_before=time.time() + get_retry_delay())
+
+
+def process_job(url: str, worker_id: str) -> None:
+    # Imported here so the coordinator doesn't load the parsers and browser stack until it publishes
+    from recipes import archive_jobs, recipe_handler, recipe_keys
+
+    if recipe_keys.has_url(url):
+        get_logger().info(f'URL already in output: {url}')
+        commit(url, worker_id, [])
+        return
+
+    page_source: str | None = recipe_handler.fetch_page(url, defer_failing=False)
+    if page_source is None:
+        # Waiting on an archive snapshot or a failing site isn't the url's fault, so only those are deferred
+        if archive_jobs.is_pending(url):
+            defer(url, worker_id, get_retry_delay(), 'waiting for archive')
+        elif resilience.is_open(url):
+            defer(url, worker_id, resilience.get_cool_down(), 'site failing')
+        else:
+            fail(url, worker_id, 'page not available')
+        return
+
+    recipes, dumps = recipe_handler.parse_page(url, page_source)
+    recipe_handler.submit_dumps(dumps)
+    # Checked again when committing, this only saves downloading images for recipes that are already stored
+    new_recipes: list = [recipe for recipe in recipes
+                         if not recipe_keys.has_recipe(recipe_handler.get_recipe_unique_id(recipe))]
+    recipe_handler.download_recipe_images(new_recipes)
+    result: tuple[int, int] | None = commit(url, worker_id, new_recipes)
+    if result is not None:
+        get_logger().info(f'Committed {result[0]} recipes from {url} ({len(recipes) - result[0]} duplicates)')
+
+
+def has_claimable_jobs() -> bool:
+    return get_connection().execute(
+        "SELECT 1 FROM recipe_jobs WHERE (status = 'queued' AND not_before <= ?) OR status = 'leased' LIMIT 1",
+        (time.time(),)
+    ).fetchone() is not None
+
+
+def run_worker(exit_when_idle: bool = False) -> int:
+    worker_id: str = get_worker_id()
+    processed: int = 0
+    get_logger().info(f'Recipe worker {worker_id} started')
+    while True:
+        url: str | None = claim(worker_id)
+        if url is None:
+            if exit_when_idle and not has_claimable_jobs():
+                break
+            time.sleep(get_poll_interval())
+            continue
+
+        try:
+            process_job(url, worker_id)
+        except Exception as e:
+            get_logger().error(f'Unexpected error processing job {url}: {e}')
+            fail(url, worker_id, str(e))
+        processed += 1
+    get_logger().info(f'Recipe worker {worker_id} finished after {processed} jobs')
+    return processed
+
+
+def worker_main(exit_when_idle: bool = False) -> None:
+    import web_requests
+    from recipes import page_dumps
+
+    load_dotenv()
+    init_logger()
+    try:
+        run_worker(exit_when_idle)
+    finally:
+        # multiprocessing exits its children without running atexit handlers
+        page_dumps.flush_dumps()
+        web_requests.close_driver()
+
+
+def start_workers(count: int, exit_when_idle: bool = False) -> list[multiprocessing.Process]:
+    # Spawned rather than forked, the coordinator has threads (and possibly a browser) running
+    context = multiprocessing.get_context('spawn')
+    processes: list[multiprocessing.Process] = [
+        context.Process(target=worker_main, args=(exit_when_idle,), name=f'recipe worker {index + 1}',
+                        daemon=True)
+        for index in range(count)
+    ]
+    for process in processes:
+        process.start()
+    return processes
+
+
+def publish() -> int:
+    # Moves committed recipes into OUTPUT_FILE and the other stores, returns how many were published
+    from recipes import recipe_handler, recipe_keys, recipe_record
+
+    connection: sqlite3.Connection = get_connection()
+    rows: list[sqlite3.Row] = connection.execute(
+        'SELECT id, unique_id, url, data FROM recipe_job_results ORDER BY id LIMIT ?', (get_publish_batch_size(),)
+    ).fetchall()
+    if not rows:
+        return 0
+
+    recipe_handler.get_loaded_recipes()
+    recipes_by_url: dict[str, list[dict]] = {}
+    # A publish that stopped after saving OUTPUT_FILE left these saved but not stored
+    saved_recipes: list[recipe_record.Recipe] = []
+    for row in rows:
+        saved_recipe: recipe_record.Recipe | None = recipe_handler.get_loaded_recipe(row['unique_id'])
+        if saved_recipe is None:
+            recipes_by_url.setdefault(row['url'], []).append(json.loads(row['data']))
+        elif not recipe_keys.has_recipe(row['unique_id']):
+            saved_recipes.append(saved_recipe)
+
+    unique_ids: list[str] = [recipe_handler.get_recipe_unique_id(recipe) for recipe in saved_recipes]
+    new_recipes: list[recipe_record.Recipe] = list(saved_recipes)
+    for url, recipes_data in recipes_by_url.items():
+        recipe_ids, recipes = recipe_handler.add_new_recipes(url, recipe_record.load_recipes(recipes_data),
+                                                             save=False)
+        unique_ids.extend(recipe_ids)
+        new_recipes.extend(recipes)
+    # OUTPUT_FILE first, then the keys and other stores, then the rows, so each step can be redone
+    recipe_handler.save_recipes(recipe_handler.get_loaded_recipes())
+    recipe_handler.store_new_recipes(list({row['url']: None for row in rows}), unique_ids, new_recipes)
+
+    # Only removed once their keys are stored, so a commit racing the publish always sees one or the other
+    with connection:
+        connection.execute('DELETE FROM recipe_job_results WHERE id <= ?', (rows[-1]['id'],))
+    get_logger().info(f'Published {len(rows)} recipes')
+    return len(rows)
+
+
+def _publish_loop() -> None:
+    from recipes import recipe_handler
+
+    loaded: bool = False
+    while True:
+        try:
+            if not loaded:
+                recipe_handler.prepare_recipe_stores()
+                loaded = True
+            while publish():
+                pass
+            if not has_claimable_jobs():
+                # Nothing more is coming for now, so don't hold the recipe list in memory
+                recipe_handler.release_loaded_recipes()
+                loaded = False
+        except Exception as e:
+            get_logger().error(f'Unexpected error publishing recipe jobs: {e}')
+        time.sleep(get_publish_interval())
+
+
+def start_coordinator() -> None:
+    global publisher_thread, worker_processes
+    if publisher_thread is None or not publisher_thread.is_alive():
+        publisher_thread = threading.Thread(target=_publish_loop, name='recipe job publisher', daemon=True)
+        publisher_thread.start()
+    worker_processes = [process for process in worker_processes if process.is_alive()]
+    if not worker_processes and get_worker_count():
+        worker_processes = start_workers(get_worker_count())
+        get_logger().info(f'Started {len(worker_processes)} recipe workers')
+
+
+def get_counts() -> dict[str, int]:
+    counts: dict[str, int] = {row['status']: row['count'] for row in get_connection().execute(
+        'SELECT status, COUNT(*) AS count FROM recipe_jobs GROUP BY status'
+    )}
+    counts['unpublished'] = get_connection().execute('SELECT COUNT(*) FROM recipe_job_results').fetchone()[0]
+    return counts
+
+
+if __name__ == '__main__':
+    load_dotenv()
+    init_logger()
+
+    arg_parser = argparse.ArgumentParser(description='Recipe url jobs shared by a coordinator and workers')
+    subparsers = arg_parser.add_subparsers(dest='command', required=True)
+    worker_parser = subparsers.add_parser('worker', help='claim and process jobs')
+    worker_parser.add_argument('--processes', type=int, default=1)
+    worker_parser.add_argument('--exit-when-idle', action='store_true', help='stop once no job can be claimed')
+    enqueue_parser = subparsers.add_parser('enqueue', help='queue urls as jobs')
+    enqueue_parser.add_argument('urls', nargs='+')
+    subparsers.add_parser('publish', help='publish committed recipes now')
+    subparsers.add_parser('status', help='job counts by status')
+    args = arg_parser.parse_args()
+
+    if args.command == 'worker':
+        if args.processes == 1:
+            worker_main(args.exit_when_idle)
+        else:
+            for worker_process in start_workers(args.processes, args.exit_when_idle):
+                worker_process.join()
+    elif args.command == 'enqueue':
+        get_logger().info(f'Queued {enqueue(args.urls)} jobs')
+    elif args.command == 'publish':
+        from recipes import recipe_handler
+        recipe_handler.prepare_recipe_stores()
+        while publish():
+            pass
+    else:
+        print(json.dumps(get_counts(), indent=4))
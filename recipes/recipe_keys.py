@@ -0,0 +1,158 @@
+import hashlib
+import math
+import mmap
+import os
+import sqlite3
+import struct
+import threading
+from pathlib import Path
+from typing import Callable
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+from logger import get_logger
+from recipes import recipe_db
+
+
+# Membership of canonical URLs and recipe unique ids, so duplicate checks don't need the recipe list in memory.
+# An mmapped Bloom filter answers most lookups (every new URL) without touching the database, and the exact
+# key table in RECIPES_DB confirms the rest.
+
+SCHEMA: str = '''
+    CREATE TABLE IF NOT EXISTS recipe_keys (
+        key_hash BLOB PRIMARY KEY,
+        kind TEXT NOT NULL
+    ) WITHOUT ROWID;
+'''
+
+BLOOM_HEADER: struct.Struct = struct.Struct('<4sQI')
+BLOOM_MAGIC: bytes = b'RKBF'
+TRACKING_PARAMS: tuple[str, ...] = ('utm_', 'fbclid', 'gclid', 'mc_', 'cmp', 'CMP')
+
+bloom_filter: 'BloomFilter | None' = None
+bloom_lock: threading.Lock = threading.Lock()
+
+
+class BloomFilter:
+    def __init__(self, path: Path, capacity: int, error_rate: float = 0.01):
+        self.path: Path = path
+        self.capacity: int = capacity
+        self.bits: int = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        self.hashes: int = max(1, round(self.bits / capacity * math.log(2)))
+
+        size: int = BLOOM_HEADER.size + math.ceil(self.bits / 8)
+        self.is_new: bool = not self._is_valid_file(size)
+        if self.is_new:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            with path.open('wb') as file:
+                file.write(BLOOM_HEADER.pack(BLOOM_MAGIC, self.bits, self.hashes))
+                file.truncate(size)
+
+        self.file = path.open('r+b')
+        self.data: mmap.mmap = mmap.mmap(self.file.fileno(), size)
+
+    def _is_valid_file(self, size: int) -> bool:
+        if not self.path.exists() or self.path.stat().st_size != size:
+            return False
+        with self.path.open('rb') as file:
+            return file.read(BLOOM_HEADER.size) == BLOOM_HEADER.pack(BLOOM_MAGIC, self.bits, self.hashes)
+
+    def _positions(self, key_hash: bytes) -> list[int]:
+        first: int = int.from_bytes(key_hash[:8], 'little')
+        second: int = int.from_bytes(key_hash[8:16], 'little') | 1
+        return [(first + i * second) % self.bits for i in range(self.hashes)]
+
+    def add(self, key_hash: bytes) -> None:
+        for position in self._positions(key_hash):
+            offset: int = BLOOM_HEADER.size + position // 8
+            self.data[offset] |= 1 << (position % 8)
+
+    def __contains__(self, key_hash: bytes) -> bool:
+        return all(self.data[BLOOM_HEADER.size + position // 8] & (1 << (position % 8))
+                   for position in self._positions(key_hash))
+
+    def close(self) -> None:
+        self.data.flush()
+        self.data.close()
+        self.file.close()
+
+
+def get_connection() -> sqlite3.Connection:
+    return recipe_db.get_connection(SCHEMA)
+
+
+def get_bloom_path() -> Path:
+    return Path(os.getenv('RECIPE_KEYS_BLOOM_FILE', 'recipes/output/recipe_keys.bloom'))
+
+
+def get_key_count() -> int:
+    return get_connection().execute('SELECT COUNT(*) FROM recipe_keys').fetchone()[0]
+
+
+def get_bloom_filter() -> BloomFilter:
+    global bloom_filter
+    with bloom_lock:
+        if bloom_filter is None:
+            capacity: int = int(os.getenv('RECIPE_KEYS_CAPACITY', '1000000'))
+            key_count: int = get_key_count()
+            while key_count > capacity:
+                capacity *= 2
+
+            bloom_filter = BloomFilter(get_bloom_path(), capacity)
+            if bloom_filter.is_new and key_count:
+                get_logger().info(f'Rebuilding recipe key filter from {key_count} keys')
+                for row in get_connection().execute('SELECT key_hash FROM recipe_keys'):
+                    bloom_filter.add(row['key_hash'])
+    return bloom_filter
+
+
+def canonicalize_url(url: str) -> str:
+    parts = urlsplit(url.strip() if '://' in url else f'https://{url.strip()}')
+    host: str = parts.netloc.lower().removeprefix('www.')
+    query: str = urlencode([(key, value) for key, value in parse_qsl(parts.query)
+                            if not key.startswith(TRACKING_PARAMS)])
+    path: str = parts.path.rstrip('/') or '/'
+    return urlunsplit(('https', host, path, query, ''))
+
+
+def hash_key(kind: str, key: str) -> bytes:
+    return hashlib.blake2b(f'{kind}:{key}'.encode('utf-8'), digest_size=16).digest()
+
+
+def _contains(key_hash: bytes) -> bool:
+    if key_hash not in get_bloom_filter():
+        return False
+    return get_connection().execute('SELECT 1 FROM recipe_keys WHERE key_hash = ?',
+                                    (key_hash,)).fetchone() is not None
+
+
+def has_url(url: str) -> bool:
+    return _contains(hash_key('url', canonicalize_url(url)))
+
+
+def has_recipe(unique_id: str) -> bool:
+    return _contains(hash_key('recipe', unique_id))
+
+
+def add_keys(urls: list[str], unique_ids: list[str]) -> None:
+    keys: list[tuple[bytes, str]] = ([(hash_key('url', canonicalize_url(url)), 'url') for url in urls if url]
+                                     + [(hash_key('recipe', unique_id), 'recipe') for unique_id in unique_ids])
+    bloom: BloomFilter = get_bloom_filter()
+    connection: sqlite3.Connection = get_connection()
+    with connection:
+        connection.executemany('INSERT OR IGNORE INTO recipe_keys (key_hash, kind) VALUES (?, ?)', keys)
+
+    for key_hash, _ in keys:
+        bloom.add(key_hash)
+
+
+def add_recipes(recipes: list[dict], get_unique_id: Callable[[dict], str]) -> None:
+    add_keys([recipe.get('url', '') for recipe in recipes], [get_unique_id(recipe) for recipe in recipes])
+
+
+def ensure_keys(load_recipes: Callable[[], list[dict]], get_unique_id: Callable[[dict], str]) -> None:
+    # Only the first run after upgrading needs the full recipe list
+    if get_key_count() == 0:
+        recipes: list[dict] = load_recipes()
+        if recipes:
+            add_recipes(recipes, get_unique_id)
+            get_logger().info(f'Indexed keys for {len(recipes)} existing recipes')
@@ -1,13 +1,15 @@
 import json
-import os
-from pathlib import Path
 import re
-import requests
-from bs4 import BeautifulSoup, Tag
+from typing import Callable, Iterator
+from bs4 import BeautifulSoup
 import web_requests
-from logger import get_logger
+from recipes import heuristic_extractor, page_dumps, recipe_images
+from recipes.recipe_record import PageData, Recipe
 from urllib.parse import urlparse, parse_qs
 
+JSON_LD_PATTERN: re.Pattern = re.compile(r'<script[^>]*application/ld\+json[^>]*>(.*?)</script>',
+                                         re.IGNORECASE | re.DOTALL)
+
 
 def get_best_image_url(urls: list[str]) -> str:
     def get_image_width(url):
@@ -51,78 +53,85 @@ def _get_second_level_jsons(nested_json: dict) -> list[dict]:
     ]
 
 
-def _combine_authors(author1: str, author2: str) -> str | None:
-    all_authors = [author.strip() for author in (author1 + ',' + author2).split(',') if author.strip()]
-    return ', '.join(set(all_authors)) if all_authors else None
-
-
-def download_image(url: str, recipe_name: str, source: str) -> str | None:
-    if not url:
-        return None
-
-    try:
-        response: requests.Response = requests.get(url, stream=True)
-        response.raise_for_status()
-
-        image_name: str
-        if recipe_name:
-            image_ext: str = Path(url).suffix.split('?')[0] or '.jpg'
-            image_name = f"{recipe_name}{image_ext}"
-        else:
-            image_name = url.split('/')[-1]
-            if '.' not in image_name:
-                image_name += '.jpg'
-
-        image_name = re.sub(r'[?:/\\*"<>|]', '', image_name)
-
-        images_dir: Path = Path(os.getenv('IMAGES_DIR', '.'))
-        path: Path = images_dir / source.replace(' ', '_') if source else images_dir
-        path.mkdir(parents=True, exist_ok=True)
-
-        image_path: Path = path / image_name
-
-        with image_path.open('wb') as file:
-            for chunk in response.iter_content(chunk_size=8192):
-                file.write(chunk)
-
-        return f'{source}/{image_name}'
-
-    except requests.RequestException as req_error:
-        get_logger().error(f'HTTP error occurred while downloading the image at {url}: {req_error}')
-    except OSError as os_error:
-        get_logger().error(f'File system error occurred downloading the image at {url}: {os_error}')
-    except Exception as unexpected_error:
-        get_logger().error(f'An unexpected error occurred downloading the image at {url}: {unexpected_error}')
-
-    return None
-
-
 class BaseParser:
-    def __init__(self, url: str, use_archive: bool = False):
+    # The rules below are set per site from sites.json, see site_registry
+    domain: str | None = None
+    # A fixed source name, otherwise the name of the first JSON-LD object of source_type
+    source_name: str | None = None
+    source_type: str = 'organization'
+    # The article JSON-LD key holding the page title
+    title_key: str = 'headline'
+    # A fixed author for every recipe, otherwise the recipe JSON-LD author
+    recipe_author: str | None = None
+    # Where a recipe's own image comes from: its JSON-LD ('json_ld'), none so the page image is used ('page'),
+    # or the page <img> whose alt text is the recipe name ('img_alt'), sized with image_size_param
+    recipe_image: str = 'json_ld'
+    image_size_param: str | None = None
+    # Read recipes from the article text when the page has no recipe JSON-LD. Only for sites known to publish
+    # recipes in their articles, elsewhere any article (news, shop pages) could be taken for a recipe
+    heuristic_fallback: bool = False
+    # The class of the element holding the article text, any <article> when not set
+    article_body_pattern: re.Pattern | None = None
+    # Pages are read from an archive snapshot rather than the site
+    needs_archive: bool = False
+    # Fetch in the browser when PAGE_FETCH_BACKEND is auto, None for sites we know nothing about. ready_selector
+    # is a CSS selector the browser waits for before reading the page
+    needs_browser: bool | None = None
+    ready_selector: str | None = None
+    # Parsers that dump every page keep its source until the recipes have been read
+    dumps_all_pages: bool = False
+
+    def __init__(self, url: str, use_archive: bool = False, page_source: str | None = None,
+                 download_images: bool = True):
         self.uses_archive: bool = use_archive
         self.url = url
-        self.request_url: str = web_requests.get_archive_url(url) if use_archive else url
-        self.soup: BeautifulSoup | None = web_requests.get_page(self.request_url)
-
-    def has_soup_content(self) -> bool:
-        return self.soup is not None and bool(self.soup.contents)
-
-    def _get_script_tags(self) -> list[BeautifulSoup]:
-        if not self.soup:
+        self.download_images: bool = download_images
+        if page_source is None:
+            self.request_url: str = web_requests.get_archive_url(url) if use_archive else url
+            page_source = web_requests.get_page_source(self.request_url, needs_browser=self.needs_browser,
+                                                       ready_selector=self.ready_selector)
+        else:
+            self.request_url: str = url
+        self.page_source: str | None = page_source
+        # The DOM is several times the size of the page, so it is only built for parsers that read more than the
+        # JSON-LD (see get_soup), and released as soon as they have
+        self.soup: BeautifulSoup | None = None
+        # The page's JSON-LD, kept once the page has been released for dump_unprocessed_data
+        self.json_objs: list[dict | list] | None = None
+        self.dump_handler: Callable[[str, str, dict], None] = page_dumps.submit_dump
+
+    def has_page_content(self) -> bool:
+        return bool(self.page_source and self.page_source.strip())
+
+    def get_soup(self) -> BeautifulSoup | None:
+        if self.soup is None and self.page_source:
+            self.soup = BeautifulSoup(self.page_source, 'html.parser')
+        return self.soup
+
+    def release_page(self, keep_source: bool = False) -> None:
+        # decompose breaks the tree's parent/child cycles so it is freed now rather than at the next gc
+        if self.soup is not None:
+            self.soup.decompose()
+            self.soup = None
+        if not keep_source:
+            self.page_source = None
+
+    def _get_script_texts(self) -> list[str]:
+        if not self.page_source:
             return []
-        return self.soup.find_all('script', type='application/ld+json')
+        return JSON_LD_PATTERN.findall(self.page_source)
 
     def _get_script_jsons(self) -> list[dict]:
-        script_tags: list[BeautifulSoup] = self._get_script_tags()
+        script_texts: list[str] = self._get_script_texts()
         result = []
-        for script_tag in script_tags:
-            if _is_valid_json(script_tag.string):
-                parsed = json.loads(script_tag.string)
+        for script_text in script_texts:
+            if _is_valid_json(script_text):
+                parsed = json.loads(script_text)
                 if isinstance(parsed, list):
                     result.extend(parsed)
                 else:
                     result.append(parsed)
-            elif _is_valid_json(emb_tag:= script_tag.string[4:-3]):
+            elif _is_valid_json(emb_tag:= script_text[4:-3]):
                 parsed = json.loads(emb_tag)
                 if isinstance(parsed, list):
                     result.extend(parsed)
@@ -131,6 +140,8 @@ class BaseParser:
         return [item for item in result if isinstance(item, dict)]
 
     def _get_first_second_level_jsons(self) -> list[dict]:
+        if self.json_objs is not None:
+            return self.json_objs
         script_jsons: list[dict] = self._get_script_jsons()
         jsons: list[dict] = []
 
@@ -155,15 +166,62 @@ class BaseParser:
     def _get_page_data(self, json_objs: list[dict | list]) -> dict:
         return self.get_first_json_as_match('@type', {'article', 'newsarticle'}, json_objs)
 
-    def get_recipes(self) -> list[dict] | None:
-        json_objs: list[dict | list] = self._get_first_second_level_jsons()
-        if not json_objs:
-            return None
+    def get_recipes(self) -> list[Recipe] | None:
+        return list(self.iter_recipes()) or None
 
-        base_data: dict = self._get_base_data(json_objs)
+    def iter_recipes(self) -> Iterator[Recipe]:
+        # Reads the JSON-LD and releases the page before any recipe is built, then builds (and downloads the image
+        # of) one recipe at a time as the caller asks for it, so nothing holds the page and all its results at once
+        json_objs: list[dict | list] = self._get_first_second_level_jsons()
+        self.json_objs = json_objs
+        self._read_page_elements(json_objs)
         recipes_data: list[dict] = self._get_recipes_jsons(json_objs)
+        # Without recipe JSON-LD the source is still needed by the heuristic fallback and the dump
+        self.release_page(keep_source=self.dumps_all_pages or not recipes_data)
+
+        base_data: dict | None = self._get_base_data(json_objs) if json_objs else None
+        if not recipes_data:
+            yield from self.iter_heuristic_recipes(base_data)
+            return
+
+        # The page's base data is shared by its recipes rather than copied into each
+        page: PageData = PageData.from_json(base_data)
+        for recipe_data in recipes_data:
+            yield self._get_single_recipe(recipe_data, page, json_objs)
+
+    def _read_page_elements(self, json_objs: list[dict | list]) -> None:
+        # For parsers that need more from the page than the JSON-LD, read here (with get_soup) before it is released
+        if self.recipe_image == 'img_alt':
+            self.image_sources: dict[str, str] = {}
+            soup: BeautifulSoup | None = self.get_soup()
+            for img in soup.find_all('img') if soup is not None else []:
+                self.image_sources.setdefault(img.get('alt', '').lower(), img.get('src', ''))
+
+    def iter_heuristic_recipes(self, base_data: dict | None = None) -> Iterator[Recipe]:
+        if not self.heuristic_fallback or not self.page_source:
+            return
 
-        return self._create_recipe_jsons(recipes_data, base_data, json_objs)
+        recipes_data, meta = heuristic_extractor.extract_recipes(self.page_source, self.article_body_pattern)
+        if recipes_data and not self.dumps_all_pages:
+            self.page_source = None
+        page: PageData = PageData.from_json(base_data or self._get_meta_base_data(meta))
+        for recipe_data in recipes_data:
+            recipe: Recipe = Recipe.merge(page, {**recipe_data, 'extraction': 'heuristic'})
+            if self.download_images and recipe.get('image'):
+                recipe_images.store_recipe_image(recipe)
+            yield recipe
+
+    def _get_meta_base_data(self, meta: dict[str, str]) -> dict:
+        author: str = meta.get('author', '')
+        return {
+            'source': meta.get('og:site_name', 'Unknown Source'),
+            'url': self.url,
+            # Some sites give a profile link rather than a name
+            'author': '' if author.startswith('http') else author,
+            'published_date': meta.get('article:published_time'),
+            'article_title': meta.get('og:title') or meta.get('title', ''),
+            'image': meta.get('og:image') or self._get_image_url({}, [])
+        }
 
     def _get_recipes_jsons(self, json_objs: list[dict | list]) -> list[dict]:
         return [
@@ -171,38 +229,14 @@ class BaseParser:
             if self.json_match_condition('@type', {'recipe'}, json_obj)
         ]
 
-    def _create_recipe_jsons(self, recipes_data: list[dict], base_data: dict, json_objs: list[dict | list]) -> list[dict]:
-        return [
-            self._get_single_recipe(recipe_data, base_data, json_objs)
-            for recipe_data in recipes_data
-        ]
-
-    def _get_single_recipe(self, recipe_data: dict, base_data: dict, json_objs: list[dict]) -> dict:
-        recipe: dict = self._merge_dicts_with_author_combine(
-            base_data,
-            self._get_recipe_details(recipe_data, json_objs)
-        )
+    def _get_single_recipe(self, recipe_data: dict, page: PageData, json_objs: list[dict]) -> Recipe:
+        recipe: Recipe = Recipe.merge(page, self._get_recipe_details(recipe_data, json_objs))
 
-        if recipe.get('image'):
-            recipe['image'] = download_image(
-                recipe.get('image'),
-                recipe.get('recipe_name', ''),
-                recipe.get('source')
-            )
+        if self.download_images and recipe.get('image'):
+            recipe_images.store_recipe_image(recipe)
 
         return recipe
 
-    def _merge_dicts_with_author_combine(self, dict1: dict, dict2: dict) -> dict:
-        merged = {**dict1, **{k: v for k, v in dict2.items() if v}}
-
-        if 'author' in dict1 or 'author' in dict2:
-            merged['author'] = _combine_authors(
-                dict1.get('author', ''),
-                dict2.get('author', '')
-            )
-
-        return merged
-
     def _get_base_data(self, script_jsons: list[dict]) -> dict:
         article_obj: dict = self.get_first_json_as_match('@type', {'article', 'newsarticle'}, script_jsons)
 
@@ -233,7 +267,9 @@ class BaseParser:
         }
 
     def _get_source(self, json_objs: list[dict]) -> str:
-        organisation = self.get_first_json_as_match('@type', {'organization'}, json_objs)
+        if self.source_name:
+            return self.source_name
+        organisation = self.get_first_json_as_match('@type', {self.source_type}, json_objs)
         return organisation.get('name', 'Unknown Source')
 
     def _get_page_author(self, json_objs: list[dict]) -> str:
@@ -248,7 +284,7 @@ class BaseParser:
         return article_obj.get('datePublished')
 
     def _get_title(self, article_obj: dict) -> str:
-        return article_obj.get('headline', '')
+        return article_obj.get(self.title_key, '')
 
     def _get_image_url(self, article_obj: dict, json_objs: list[dict]) -> str:
         image_obj = article_obj.get('image')
@@ -278,6 +314,9 @@ class BaseParser:
         return recipe_data.get('name')
 
     def _get_recipe_author(self, recipe_data: dict) -> str:
+        if self.recipe_author:
+            return self.recipe_author
+
         author_details: list[dict] | dict | None = recipe_data.get('author')
 
         if not author_details:
@@ -292,8 +331,21 @@ class BaseParser:
         return recipe_data.get('description', '')
 
     def _get_recipe_image_url(self, recipe_data: dict, script_jsons: list[dict]) -> str:
+        if self.recipe_image == 'page':
+            return ''
+        if self.recipe_image == 'img_alt':
+            image_address = self.image_sources.get(recipe_data.get('name', '').lower(), '')
+            if image_address:
+                return self._get_sized_image_address(image_address)
         return self._get_image_url(recipe_data, script_jsons)
 
+    def _get_sized_image_address(self, image_address: str) -> str:
+        if not self.image_size_param:
+            return image_address
+        if '.' in image_address.split('/')[-1]:
+            return f'{image_address.split('.')[0]}{self.image_size_param}.{image_address.split('.')[1]}'
+        return f'{image_address}{self.image_size_param}'
+
     def _get_recipe_ingredients(self, recipe_data: dict) -> list | dict | str | None:
         return recipe_data.get('recipeIngredient')
 
@@ -320,104 +372,27 @@ class BaseParser:
         return best_guess_name
 
     def dump_unprocessed_data(self, json_objs: list[dict | list] | None = None, base_data: dict | None = None,
-                              recipes_data: list[dict] | None = None) -> None:
+                              recipes_data: list[dict] | None = None, recipes: list[Recipe] | None = None) -> None:
         base_url: str = web_requests.get_base_url(self.url)
         best_guess_name = self.get_best_guess_name()
 
-        root_path = f'recipes/output/unprocessed/{base_url}'
-        os.makedirs(root_path, exist_ok=True)
-
         json_objs = json_objs or self._get_first_second_level_jsons()
-        if not json_objs:
-            with open(f'{root_path}/{best_guess_name}.html', 'w', encoding='utf-8') as file:
-                file.write(self.soup.prettify())
-            return
-
-        base_data = base_data or self._get_base_data(json_objs)
-        recipes_data = recipes_data or self._get_recipes_jsons(json_objs)
-
-        with open(f'{root_path}/{best_guess_name}_script_jsons.json', 'w', encoding='utf-8') as file:
-            json.dump(json_objs, file, indent=4)
-        with open(f'{root_path}/{best_guess_name}_base_data.json', 'w', encoding='utf-8') as file:
-            json.dump(base_data, file, indent=4)
-        with open(f'{root_path}/{best_guess_name}_recipes_data.json', 'w', encoding='utf-8') as file:
-            json.dump(recipes_data, file, indent=4)
-        with open(f'{root_path}/{best_guess_name}.html', 'w', encoding='utf-8') as file:
-            file.write(self.soup.prettify())
-
-
-class PinchOfYumParser(BaseParser):
-    def _get_recipe_image_url(self, recipe_data: dict, script_jsons: list[dict]) -> str:
-        return ''
-
-    def _get_source(self, json_objs: list[dict]) -> str:
-        website = self.get_first_json_as_match('@type', {'website'}, json_objs)
-        return website.get('name', 'Unknown Source')
-
-
-class JamieOliverParser(BaseParser):
-    def _get_source(self, json_objs: list[dict]) -> str:
-        return 'Jamie Oliver'
-
-    def _get_title(self, article_obj: dict) -> str:
-        return article_obj.get('name', '')
-
-
-class WaitroseParser(BaseParser):
-    def _get_source(self, json_objs: list[dict]) -> str:
-        return 'Waitrose'
-
-    def _get_title(self, article_obj: dict) -> str:
-        return article_obj.get('name', '')
-
-    def _get_recipe_author(self, recipe_data: dict) -> str:
-        return 'Waitrose'
-
-    def _get_recipe_image_url(self, recipe_data: dict, script_jsons: list[dict]) -> str:
-        page_images = self.soup.find_all('img')
-        image_element = next((img for img in page_images
-                              if img.get('alt', '').lower() == recipe_data.get('name', '').lower()),
-                             '')
-        image_address = image_element.get('src', '')
-        if '.' in image_address.split('/')[-1]:
-            image_address = f'{image_address.split('.')[0]}&wid=992.{image_address.split('.')[1]}'
-        else:
-            image_address = f'{image_address}&wid=992'
-        return image_address
-
-
-class KingArthurBakingParser(BaseParser):
-    def _get_source(self, json_objs: list[dict]) -> str:
-        return 'King Arthur Baking'
-
-    def _get_title(self, article_obj: dict) -> str:
-        return article_obj.get('name', '')
-
-
-class GuardianParser(BaseParser):
-    def get_recipes(self) -> list[dict] | None:
-        json_objs: list[dict | list] = self._get_first_second_level_jsons()
-        if not json_objs:
-            return None
-
-        base_data = self._get_base_data(json_objs)
-        recipes_data: list[dict] = self._get_recipes_jsons(json_objs)
-        recipes: list[dict] = self._create_recipe_jsons(recipes_data, base_data, json_objs)
-
-        if recipes:
-            return recipes
-
-        body: Tag | None = self.soup.find('div', {'class': re.compile('^article-body')})
-        p_and_h2_elements: list[Tag] = body.find_all(['h2', 'p'])
-        text_element: Tag
-        # for text_element in p_and_h2_elements:
-        #     print(f'{text_element=}')
+        if json_objs:
+            base_data = base_data or self._get_base_data(json_objs)
+            recipes_data = recipes_data or self._get_recipes_jsons(json_objs)
 
-        return recipes
+        dump: dict = page_dumps.build_dump(self.url, self.request_url, type(self).__name__, self.page_source or '',
+                                           json_objs, base_data, recipes_data,
+                                           [recipe.to_json() for recipe in recipes] if recipes else recipes)
+        self.dump_handler(base_url, best_guess_name, dump)
 
 
 class UnknownParser(BaseParser):
-    def get_recipes(self) -> list[dict] | None:
-        recipes: list[dict] = super().get_recipes()
-        self.dump_unprocessed_data()
-        return recipes
+    dumps_all_pages: bool = True
+
+    def iter_recipes(self) -> Iterator[Recipe]:
+        recipes: list[Recipe] = []
+        for recipe in super().iter_recipes():
+            recipes.append(recipe)
+            yield recipe
+        self.dump_unprocessed_data(recipes=recipes)
@@ -0,0 +1,80 @@
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Any, Callable, Iterable
+
+from dotenv import load_dotenv
+
+from logger import get_logger
+
+
+# Fetching (browser, network) and parsing (BeautifulSoup, dumps) are run as separate stages, connected by
+# bounded queues, so pages keep downloading while earlier pages are parsed on the other cores.
+
+def get_parser_processes() -> int:
+    return int(os.getenv('PARSER_PROCESSES', str(os.cpu_count() or 1)))
+
+
+def get_queue_size() -> int:
+    return int(os.getenv('PIPELINE_QUEUE_SIZE', '8'))
+
+
+def _fetch_stage(items: Iterable[str], fetch: Callable[[str], Any], pages: queue.Queue) -> None:
+    try:
+        for item in items:
+            start_time: float = time.monotonic()
+            try:
+                page: Any = fetch(item)
+            except Exception as e:
+                get_logger().error(f'Unexpected error fetching {item}: {e}')
+                continue
+
+            if page is not None:
+                pages.put((item, page, start_time))
+    finally:
+        pages.put(None)
+
+
+def _parse_stage(pages: queue.Queue, results: queue.Queue, executor: ProcessPoolExecutor,
+                 parse: Callable[[str, Any], Any]) -> None:
+    try:
+        while (page_item := pages.get()) is not None:
+            item, page, start_time = page_item
+            results.put((item, executor.submit(parse, item, page), start_time))
+    finally:
+        results.put(None)
+
+
+def _write_stage(results: queue.Queue, write: Callable[[str, Any], None]) -> list[float]:
+    future: Future
+    latencies: list[float] = []
+    while (result_item := results.get()) is not None:
+        item, future, start_time = result_item
+        try:
+            write(item, future.result())
+            latencies.append(time.monotonic() - start_time)
+        except Exception as e:
+            get_logger().error(f'Unexpected error processing {item}: {e}')
+    return latencies
+
+
+def run_pipeline(items: Iterable[str], fetch: Callable[[str], Any], parse: Callable[[str, Any], Any],
+                 write: Callable[[str, Any], None]) -> list[float]:
+    # Returns the time from fetch to write for every item written
+    # parse must be picklable (a module level function) as it runs in the worker processes
+    pages: queue.Queue = queue.Queue(maxsize=get_queue_size())
+    results: queue.Queue = queue.Queue(maxsize=get_queue_size())
+
+    with ProcessPoolExecutor(max_workers=get_parser_processes(), initializer=load_dotenv) as executor:
+        fetcher = threading.Thread(target=_fetch_stage, args=(items, fetch, pages), daemon=True)
+        parser = threading.Thread(target=_parse_stage, args=(pages, results, executor, parse), daemon=True)
+        fetcher.start()
+        parser.start()
+
+        latencies: list[float] = _write_stage(results, write)
+
+        fetcher.join()
+        parser.join()
+    return latencies
@@ -0,0 +1,196 @@
+import sys
+from typing import Any, Iterator
+
+
+# Compact in-memory recipes. A parsed page's base data (source, url, author, dates, title, image) is held once
+# in a PageData shared by all of its recipes, instead of being copied into each one, and a Recipe only stores
+# the fields it sets itself, in slots. Low-cardinality strings (sources, authors, dates, durations) are interned
+# so tens of thousands of recipes share them. Recipes read and write like the dicts they replace (get, [],
+# setdefault, update), and to_json / load_recipes convert to and from the existing OUTPUT_FILE shape.
+
+PAGE_FIELDS: tuple[str, ...] = ('source', 'url', 'author', 'published_date', 'article_title', 'image')
+OWN_FIELDS: tuple[str, ...] = ('recipe_name', 'description', 'ingredients', 'instructions', 'recipe_yield',
+                               'prep_time', 'cook_time', 'total_time', 'image_url', 'image_variants')
+RECIPE_FIELDS: tuple[str, ...] = (*PAGE_FIELDS, *OWN_FIELDS)
+FIELD_NAMES: frozenset[str] = frozenset(RECIPE_FIELDS)
+INTERNED_FIELDS: frozenset[str] = frozenset({'source', 'author', 'published_date', 'recipe_yield', 'prep_time',
+                                             'cook_time', 'total_time'})
+# HowToStep instructions and image variants repeat short values ("HowToStep", "webp") in every entry
+NESTED_FIELDS: frozenset[str] = frozenset({'instructions', 'image_variants'})
+MAX_NESTED_INTERN_LENGTH: int = 32
+
+MISSING: Any = object()
+
+
+def _intern_nested(value: Any) -> Any:
+    if type(value) is list:
+        for item in value:
+            if type(item) is dict:
+                for key, item_value in item.items():
+                    if type(item_value) is str and len(item_value) <= MAX_NESTED_INTERN_LENGTH:
+                        item[key] = sys.intern(item_value)
+    return value
+
+
+def _intern(name: str, value: Any) -> Any:
+    if name in INTERNED_FIELDS:
+        return sys.intern(value) if type(value) is str else value
+    if name in NESTED_FIELDS:
+        return _intern_nested(value)
+    return value
+
+
+class PageData:
+    __slots__ = PAGE_FIELDS
+
+    @classmethod
+    def from_json(cls, base_data: dict) -> 'PageData':
+        page: PageData = cls()
+        for name in PAGE_FIELDS:
+            if name in base_data:
+                setattr(page, name, _intern(name, base_data[name]))
+        return page
+
+    def get(self, name: str, default: Any = None) -> Any:
+        return getattr(self, name, default)
+
+
+class Recipe:
+    # An unset slot is a key the recipe doesn't have, anything not in RECIPE_FIELDS goes in extra
+    __slots__ = ('page', *RECIPE_FIELDS, 'extra')
+
+    def __init__(self, page: PageData | None = None):
+        self.page: PageData | None = page
+        self.extra: dict | None = None
+
+    @classmethod
+    def merge(cls, page: PageData, details: dict) -> 'Recipe':
+        # Fields from the recipe's own JSON-LD win when set, the authors of the page and recipe are combined
+        recipe: Recipe = cls(page)
+        for name, value in details.items():
+            if value:
+                recipe[name] = value
+        if hasattr(page, 'author') or 'author' in details:
+            recipe['author'] = combine_authors(page.get('author') or '', details.get('author') or '')
+        return recipe
+
+    @classmethod
+    def from_json(cls, data: dict, page: PageData | None = None) -> 'Recipe':
+        # Called for every stored recipe on load, so the field handling of __setitem__ is inlined
+        recipe: Recipe = cls(page)
+        for name, value in data.items():
+            if name not in FIELD_NAMES:
+                if recipe.extra is None:
+                    recipe.extra = {}
+                recipe.extra[name] = value
+            elif page is None or name not in PAGE_FIELDS or getattr(page, name, MISSING) != value:
+                setattr(recipe, name, _intern(name, value))
+        return recipe
+
+    def to_json(self) -> dict:
+        data: dict = {}
+        page: PageData | None = self.page
+        for name in PAGE_FIELDS:
+            value: Any = getattr(self, name, MISSING)
+            if value is MISSING and page is not None:
+                value = getattr(page, name, MISSING)
+            if value is not MISSING:
+                data[name] = value
+        for name in OWN_FIELDS:
+            value = getattr(self, name, MISSING)
+            if value is not MISSING:
+                data[name] = value
+        if self.extra:
+            data.update(self.extra)
+        return data
+
+    def _get(self, name: str) -> Any:
+        value: Any = getattr(self, name, MISSING)
+        if value is MISSING and name in PAGE_FIELDS and self.page is not None:
+            value = getattr(self.page, name, MISSING)
+        return value
+
+    def __getitem__(self, name: str) -> Any:
+        value: Any = self._get(name) if name in FIELD_NAMES else (self.extra or {}).get(name, MISSING)
+        if value is MISSING:
+            raise KeyError(name)
+        return value
+
+    def __setitem__(self, name: str, value: Any) -> None:
+        if name in FIELD_NAMES:
+            setattr(self, name, _intern(name, value))
+        else:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[name] = value
+
+    def __contains__(self, name: str) -> bool:
+        return self.get(name, MISSING) is not MISSING
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.keys())
+
+    def __len__(self) -> int:
+        return len(self.keys())
+
+    def __eq__(self, other: object) -> bool:
+        if isinstance(other, (Recipe, dict)):
+            return self.to_json() == (other.to_json() if isinstance(other, Recipe) else other)
+        return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self) -> str:
+        return f'Recipe({self.to_json()!r})'
+
+    def get(self, name: str, default: Any = None) -> Any:
+        try:
+            return self[name]
+        except KeyError:
+            return default
+
+    def setdefault(self, name: str, default: Any = None) -> Any:
+        if name not in self:
+            self[name] = default
+        return self[name]
+
+    def update(self, values: dict) -> None:
+        for name, value in values.items():
+            self[name] = value
+
+    def keys(self) -> list[str]:
+        return [name for name in RECIPE_FIELDS if self._get(name) is not MISSING] + list(self.extra or ())
+
+    def items(self) -> list[tuple[str, Any]]:
+        return [(name, self[name]) for name in self.keys()]
+
+
+def combine_authors(author1: str, author2: str) -> str | None:
+    all_authors = [author.strip() for author in (author1 + ',' + author2).split(',') if author.strip()]
+    return ', '.join(set(all_authors)) if all_authors else None
+
+
+def to_json(recipe: Recipe | dict) -> dict:
+    # For json.dump(..., default=to_json)
+    if isinstance(recipe, Recipe):
+        return recipe.to_json()
+    raise TypeError(f'Object of type {type(recipe).__name__} is not JSON serializable')
+
+
+def load_recipes(recipes_data: list[dict]) -> list[Recipe]:
+    # Recipes from the same page share one PageData again. A recipe without one of the page fields (an image,
+    # say) can't take it from the PageData, so only recipes with the same page fields share one
+    pages: dict[tuple, PageData] = {}
+    recipes: list[Recipe] = []
+    for data in recipes_data:
+        key: tuple = (*(data.get(name, MISSING) for name in ('source', 'url', 'published_date', 'article_title')),
+                      *(name in data for name in PAGE_FIELDS))
+        try:
+            page: PageData | None = pages.get(key)
+            if page is None:
+                page = pages[key] = PageData.from_json(data)
+        except TypeError:
+            # An unhashable value in an old record, keep it to itself
+            page = PageData.from_json(data)
+        recipes.append(Recipe.from_json(data, page))
+    return recipes
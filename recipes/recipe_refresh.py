@@ -0,0 +1,197 @@
+import argparse
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import time
+
+import requests
+from dotenv import load_dotenv
+
+import http_client
+import resilience
+from logger import get_logger, init_logger
+from recipes import (heuristic_extractor, page_cache, recipe_db, recipe_export, recipe_handler, recipe_index,
+                     recipe_parsers, reparse, site_registry)
+from recipes.recipe_record import Recipe
+
+
+# Stored recipes are revisited by url, oldest check first, with a conditional GET carrying the ETag and
+# Last-Modified from the last visit, so an unchanged page is a 304 without a body. Sites that don't support
+# validators send the page, which is only re-parsed when the hash of its JSON-LD (or, without JSON-LD, of the
+# recipes read from the article text) has changed. The run's requests are spread evenly over REFRESH_WINDOW.
+
+SCHEMA: str = '''
+    CREATE TABLE IF NOT EXISTS recipe_refresh (
+        url TEXT PRIMARY KEY,
+        etag TEXT,
+        last_modified TEXT,
+        content_hash TEXT,
+        checked_at REAL NOT NULL,
+        changed_at REAL
+    );
+    CREATE INDEX IF NOT EXISTS recipe_refresh_checked_at ON recipe_refresh (checked_at);
+'''
+
+
+def get_connection() -> sqlite3.Connection:
+    return recipe_db.get_connection(SCHEMA)
+
+
+def get_window() -> float:
+    return float(os.getenv('REFRESH_WINDOW', '3600'))
+
+
+def get_batch_size() -> int:
+    return int(os.getenv('REFRESH_BATCH_SIZE', '100'))
+
+
+def get_min_age() -> float:
+    return float(os.getenv('REFRESH_MIN_AGE_DAYS', '7')) * 86400
+
+
+def get_content_hash(url: str, page_source: str) -> str:
+    blocks: list[str] = [' '.join(block.split()) for block in recipe_parsers.JSON_LD_PATTERN.findall(page_source)]
+    if not blocks:
+        pattern: re.Pattern | None = site_registry.get_parser_class(url).article_body_pattern
+        blocks = [json.dumps(heuristic_extractor.extract_recipes(page_source, pattern)[0])]
+    return hashlib.blake2b('\n'.join(blocks).encode('utf-8'), digest_size=16).hexdigest()
+
+
+def get_due_urls(urls: list[str], min_age: float) -> list[str]:
+    checked_at: dict[str, float] = {row['url']: row['checked_at']
+                                    for row in get_connection().execute('SELECT url, checked_at FROM recipe_refresh')}
+    now: float = time.time()
+    due: list[str] = [url for url in urls if now - checked_at.get(url, 0.0) >= min_age]
+    return sorted(due, key=lambda url: checked_at.get(url, 0.0))
+
+
+def get_stored_hash(url: str, row: sqlite3.Row | None) -> str | None:
+    if row is not None and row['content_hash']:
+        return row['content_hash']
+    # First visit, compare with the page as it was when the recipe was stored
+    page_path = page_cache.get_page_path(url)
+    if page_path.exists():
+        try:
+            return get_content_hash(url, page_cache.load_page(page_path)['page_source'])
+        except (OSError, ValueError, KeyError):
+            return None
+    return None
+
+
+def record_check(url: str, response: requests.Response | None, content_hash: str | None, changed: bool) -> None:
+    connection: sqlite3.Connection = get_connection()
+    now: float = time.time()
+    with connection:
+        connection.execute(
+            '''INSERT INTO recipe_refresh (url, etag, last_modified, content_hash, checked_at, changed_at)
+               VALUES (?, ?, ?, ?, ?, ?)
+               ON CONFLICT (url) DO UPDATE SET etag = coalesce(excluded.etag, etag),
+                   last_modified = coalesce(excluded.last_modified, last_modified),
+                   content_hash = coalesce(excluded.content_hash, content_hash), checked_at = excluded.checked_at,
+                   changed_at = coalesce(excluded.changed_at, changed_at)''',
+            (url, response.headers.get('ETag') if response is not None else None,
+             response.headers.get('Last-Modified') if response is not None else None, content_hash, now,
+             now if changed else None)
+        )
+
+
+def fetch_if_changed(url: str) -> tuple[str, str | None]:
+    # Returns the outcome ('not_modified', 'unchanged', 'changed', 'error') and the page when it changed
+    row: sqlite3.Row | None = get_connection().execute('SELECT * FROM recipe_refresh WHERE url = ?',
+                                                       (url,)).fetchone()
+    headers: dict[str, str] = {}
+    if row is not None and row['etag']:
+        headers['If-None-Match'] = row['etag']
+    if row is not None and row['last_modified']:
+        headers['If-Modified-Since'] = row['last_modified']
+
+    def get(attempt: int) -> requests.Response:
+        response: requests.Response = http_client.get(url, headers=headers)
+        if response.status_code == 429 or response.status_code >= 500:
+            response.raise_for_status()
+        return response
+
+    try:
+        response: requests.Response = resilience.call_with_retries(url, get, retry_on=(requests.RequestException,))
+    except (resilience.CircuitOpenError, requests.RequestException) as e:
+        get_logger().warning(f'Could not refresh {url}: {e}')
+        return 'error', None
+
+    if response.status_code == 304:
+        record_check(url, response, None, False)
+        return 'not_modified', None
+    if not response.ok:
+        get_logger().warning(f'Got {response.status_code} refreshing {url}')
+        record_check(url, None, None, False)
+        return 'error', None
+
+    content_hash: str = get_content_hash(url, response.text)
+    changed: bool = content_hash != get_stored_hash(url, row)
+    record_check(url, response, content_hash, changed)
+    return ('changed', response.text) if changed else ('unchanged', None)
+
+
+def refresh_recipes(download_images: bool = True, limit: int | None = None) -> dict[str, int]:
+    all_recipes: list[Recipe] = recipe_handler.load_existing_recipes()
+    recipe_indexes: dict[str, int] = {recipe_handler.get_recipe_unique_id(recipe): index
+                                      for index, recipe in enumerate(all_recipes)}
+    # Archive snapshots don't change, so only recipes read from the publisher's own page are refreshed
+    urls: list[str] = list(dict.fromkeys(
+        recipe['url'] for recipe in all_recipes
+        if recipe.get('url') and not site_registry.needs_archive(recipe['url'])
+    ))
+    due_urls: list[str] = get_due_urls(urls, get_min_age())[:limit]
+    counts: dict[str, int] = {'not_modified': 0, 'unchanged': 0, 'changed': 0, 'error': 0, 'added': 0,
+                              'updated': 0}
+    if not due_urls:
+        get_logger().info('No recipes due for a refresh')
+        return counts
+
+    interval: float = get_window() / len(due_urls)
+    get_logger().info(f'Refreshing {len(due_urls)} recipe pages, one every {interval:.1f}s')
+    next_time: float = time.monotonic()
+    for start in range(0, len(due_urls), get_batch_size()):
+        changed_recipes: list[Recipe] = []
+        for url in due_urls[start:start + get_batch_size()]:
+            now: float = time.monotonic()
+            if next_time > now:
+                time.sleep(next_time - now)
+            next_time = max(next_time, now) + interval
+
+            outcome, page_source = fetch_if_changed(url)
+            counts[outcome] += 1
+            if page_source is None:
+                continue
+
+            page_cache.store_page(url, page_source)
+            recipes, _ = recipe_handler.parse_page(url, page_source)
+            added, updated = reparse.upsert_recipes(recipes, all_recipes, recipe_indexes, download_images)
+            if added or updated:
+                stored_recipes: list[Recipe] = [all_recipes[recipe_indexes[recipe_handler.get_recipe_unique_id(recipe)]]
+                                                for recipe in recipes]
+                recipe_index.index_recipes(stored_recipes)
+                changed_recipes.extend(stored_recipes)
+                get_logger().info(f'{url} changed: {added} recipes added, {updated} recipes updated')
+            counts['added'] += added
+            counts['updated'] += updated
+
+        # Saved per batch, so a long run that is stopped keeps what it has done
+        if changed_recipes:
+            recipe_handler.save_recipes(all_recipes)
+            recipe_export.update_recipes(changed_recipes, all_recipes)
+        get_logger().info(f'Refresh progress: {counts}')
+    return counts
+
+
+if __name__ == '__main__':
+    load_dotenv()
+    init_logger()
+
+    arg_parser = argparse.ArgumentParser(description='Re-check stored recipe pages and update the ones that changed')
+    arg_parser.add_argument('--limit', type=int, help='check at most this many pages')
+    arg_parser.add_argument('--no-images', action='store_true', help='do not download moved images')
+    args = arg_parser.parse_args()
+
+    refresh_recipes(download_images=not args.no_images, limit=args.limit)
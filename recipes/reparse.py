@@ -0,0 +1,104 @@
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from dotenv import load_dotenv
+
+from logger import get_logger, init_logger
+from recipes import page_cache, page_dumps, recipe_export, recipe_handler, recipe_index, recipe_keys, recipe_pipeline
+from recipes.recipe_record import Recipe
+
+
+def reparse_snapshot(snapshot_path: tuple[str, Path]) -> tuple[str, list[Recipe]]:
+    kind, path = snapshot_path
+    try:
+        snapshot: dict = page_cache.load_page(path) if kind == 'page' else page_dumps.load_dump(path)
+    except (OSError, ValueError) as e:
+        get_logger().error(f'Could not load page snapshot {path}: {e}')
+        return '', []
+
+    url: str = snapshot.get('url', '')
+    # Pages that still fail have already been dumped, so don't dump them again
+    recipes, _ = recipe_handler.parse_page(url, snapshot.get('page_source', ''))
+    return url, recipes
+
+
+def get_snapshot_paths() -> list[tuple[str, Path]]:
+    return ([('page', path) for path in page_cache.iter_page_paths()]
+            + [('dump', path) for path in page_dumps.iter_dump_paths()])
+
+
+def upsert_recipes(recipes: list[Recipe], all_recipes: list[Recipe], recipe_indexes: dict[str, int],
+                   download_images: bool = True) -> tuple[int, int]:
+    added: int = 0
+    updated: int = 0
+    recipe: Recipe
+    for recipe in recipes:
+        unique_id: str = recipe_handler.get_recipe_unique_id(recipe)
+        index: int | None = recipe_indexes.get(unique_id)
+        if index is None:
+            if download_images:
+                recipe_handler.download_recipe_images([recipe])
+            recipe_indexes[unique_id] = len(all_recipes)
+            all_recipes.append(recipe)
+            recipe_keys.add_keys([recipe.get('url', '')], [unique_id])
+            added += 1
+            continue
+
+        existing: Recipe = all_recipes[index]
+        if download_images and existing.get('image_url') and recipe.get('image') not in (None, existing['image_url']):
+            # The publisher moved the image, so fetch the new one
+            recipe_handler.download_recipe_images([recipe])
+        if not recipe.get('image_url'):
+            # Not downloaded, or the download failed: keep the already downloaded image rather than the freshly
+            # parsed remote one
+            recipe['image'] = existing.get('image') or recipe.get('image')
+            for image_field in ('image_url', 'image_variants'):
+                if image_field in existing:
+                    recipe[image_field] = existing[image_field]
+        if recipe != existing:
+            all_recipes[index] = recipe
+            updated += 1
+    return added, updated
+
+
+def reparse_all(download_images: bool = True) -> None:
+    all_recipes: list[Recipe] = recipe_handler.load_existing_recipes()
+    recipe_indexes: dict[str, int] = {recipe_handler.get_recipe_unique_id(recipe): index
+                                      for index, recipe in enumerate(all_recipes)}
+
+    snapshot_paths: list[tuple[str, Path]] = get_snapshot_paths()
+    get_logger().info(f'Re-parsing {len(snapshot_paths)} stored pages')
+
+    total_added: int = 0
+    total_updated: int = 0
+    changed_recipes: list[Recipe] = []
+    with ProcessPoolExecutor(max_workers=recipe_pipeline.get_parser_processes(),
+                             initializer=load_dotenv) as executor:
+        for url, recipes in executor.map(reparse_snapshot, snapshot_paths, chunksize=16):
+            if not recipes:
+                continue
+            added, updated = upsert_recipes(recipes, all_recipes, recipe_indexes, download_images)
+            if added or updated:
+                stored_recipes: list[Recipe] = [all_recipes[recipe_indexes[recipe_handler.get_recipe_unique_id(recipe)]]
+                                                for recipe in recipes]
+                recipe_index.index_recipes(stored_recipes)
+                changed_recipes.extend(stored_recipes)
+            total_added += added
+            total_updated += updated
+
+    if total_added or total_updated:
+        recipe_handler.save_recipes(all_recipes)
+        recipe_export.update_recipes(changed_recipes, all_recipes)
+    get_logger().info(f'Re-parse complete: {total_added} recipes added, {total_updated} recipes updated')
+
+
+if __name__ == '__main__':
+    load_dotenv()
+    init_logger()
+
+    arg_parser = argparse.ArgumentParser(description='Re-run the current parsers over all stored pages')
+    arg_parser.add_argument('--no-images', action='store_true', help='do not download images for new recipes')
+    args = arg_parser.parse_args()
+
+    reparse_all(download_images=not args.no_images)
@@ -0,0 +1,103 @@
+import json
+import os
+import re
+from functools import lru_cache
+from pathlib import Path
+
+from recipes import recipe_parsers as parsers
+
+
+# Supported sites and how to read them are data, in SITES_FILE (recipes/sites.json by default): a domain and its
+# rules (see the rule attributes of BaseParser). Each site is compiled once, on first use, into a BaseParser
+# subclass with its rules as class attributes, so parsing a page costs the same as for a hand-written parser.
+# Urls are routed by their host, trying the host and then each parent domain (www.bbcgoodfood.com, then
+# bbcgoodfood.com), with the answer cached per host. Sites that aren't listed get the UnknownParser.
+
+RULE_TYPES: dict[str, type] = {
+    'source_name': str,
+    'source_type': str,
+    'title_key': str,
+    'recipe_author': str,
+    'recipe_image': str,
+    'image_size_param': str,
+    'heuristic_fallback': bool,
+    'article_body_pattern': str,
+    'needs_archive': bool,
+    'needs_browser': bool,
+    'ready_selector': str
+}
+RECIPE_IMAGE_STRATEGIES: set[str] = {'json_ld', 'page', 'img_alt'}
+HOST_CACHE_SIZE: int = 4096
+
+sites: dict[str, type[parsers.BaseParser]] | None = None
+
+
+def get_sites_file() -> Path:
+    return Path(os.getenv('SITES_FILE', Path(__file__).with_name('sites.json')))
+
+
+def get_parser_name(domain: str) -> str:
+    return ''.join(part.capitalize() for part in re.split(r'[.-]', domain.removesuffix('.com'))) + 'Parser'
+
+
+def compile_site(domain: str, rules: dict) -> type[parsers.BaseParser]:
+    # Bad rules fail when the sites are loaded rather than on the first page of that site
+    attributes: dict = {'domain': domain, 'needs_browser': False}
+    for name, value in rules.items():
+        if name not in RULE_TYPES:
+            raise ValueError(f'Unknown rule {name} for {domain}')
+        if not isinstance(value, RULE_TYPES[name]):
+            raise ValueError(f'Rule {name} for {domain} should be a {RULE_TYPES[name].__name__}, got {value!r}')
+        attributes[name] = value
+
+    if attributes.get('recipe_image', 'json_ld') not in RECIPE_IMAGE_STRATEGIES:
+        raise ValueError(f'Unknown recipe_image {attributes['recipe_image']} for {domain}')
+    if 'source_type' in attributes:
+        attributes['source_type'] = attributes['source_type'].lower()
+    if 'article_body_pattern' in attributes:
+        attributes['article_body_pattern'] = re.compile(attributes['article_body_pattern'])
+    return type(get_parser_name(domain), (parsers.BaseParser,), attributes)
+
+
+def load_sites(path: Path | None = None) -> dict[str, type[parsers.BaseParser]]:
+    global sites
+    with open(path or get_sites_file(), 'r', encoding='utf-8') as file:
+        site_rules: dict[str, dict] = json.load(file)
+    sites = {domain.lower(): compile_site(domain.lower(), rules) for domain, rules in site_rules.items()}
+    get_host_parser_class.cache_clear()
+    return sites
+
+
+def get_sites() -> dict[str, type[parsers.BaseParser]]:
+    return sites if sites is not None else load_sites()
+
+
+def get_host(url: str) -> str:
+    # Called for every url handled, so plain string splits rather than a regex or urlsplit
+    host: str = url.split('://', 1)[-1].split('/', 1)[0].split('?', 1)[0].split('#', 1)[0]
+    return host.rsplit('@', 1)[-1].split(':', 1)[0].lower()
+
+
+@lru_cache(maxsize=HOST_CACHE_SIZE)
+def get_host_parser_class(host: str) -> type[parsers.BaseParser]:
+    site_parsers: dict[str, type[parsers.BaseParser]] = get_sites()
+    domain: str = host
+    while domain:
+        if domain in site_parsers:
+            return site_parsers[domain]
+        domain = domain.partition('.')[2]
+    return parsers.UnknownParser
+
+
+def get_parser_class(url: str) -> type[parsers.BaseParser]:
+    return get_host_parser_class(get_host(url))
+
+
+def needs_archive(url: str) -> bool:
+    return get_parser_class(url).needs_archive
+
+
+def get_domains(archived: bool | None = None) -> list[str]:
+    # All supported domains, or only those read from (archived=True) or not from (False) archive snapshots
+    return [domain for domain, parser_class in get_sites().items()
+            if archived is None or parser_class.needs_archive == archived]
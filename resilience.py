@@ -0,0 +1,202 @@
+import json
+import os
+import random
+import threading
+import time
+from pathlib import Path
+from typing import Callable, TypeVar
+from urllib.parse import urlsplit
+
+from logger import get_logger
+
+
+# Shared retry policy for everything that talks to other sites. Failures are tracked per domain: each attempt
+# against a failing domain waits an exponential, jittered backoff (shared by all urls on that domain), and once
+# a domain fails CIRCUIT_FAILURE_THRESHOLD times in a row its circuit opens for CIRCUIT_COOL_DOWN seconds.
+# While open, urls for it are deferred instead of each spending the full timeout, and handed back to their
+# queue once the cool-down is over. The first call after the cool-down is the trial: one more failure reopens.
+
+T = TypeVar('T')
+
+
+class CircuitOpenError(Exception):
+    def __init__(self, domain: str, retry_in: float):
+        super().__init__(f'Circuit open for {domain}, retrying in {retry_in:.0f}s')
+        self.domain: str = domain
+        self.retry_in: float = retry_in
+
+
+class DomainState:
+    def __init__(self):
+        self.consecutive_failures: int = 0
+        self.failures: int = 0
+        self.successes: int = 0
+        self.skipped: int = 0
+        self.circuit_opens: int = 0
+        self.retry_at: float = 0.0
+        self.open_until: float = 0.0
+        self.last_error: str = ''
+
+    def get_metrics(self) -> dict:
+        return {
+            'successes': self.successes,
+            'failures': self.failures,
+            'consecutive_failures': self.consecutive_failures,
+            'skipped': self.skipped,
+            'circuit_opens': self.circuit_opens,
+            'circuit_open': self.open_until > time.time(),
+            'last_error': self.last_error
+        }
+
+
+domains: dict[str, DomainState] = {}
+deferred_urls: dict[str, dict[str, str]] | None = None
+state_lock: threading.Lock = threading.Lock()
+
+
+def get_retry_attempts() -> int:
+    return int(os.getenv('RETRY_ATTEMPTS', '3'))
+
+
+def get_base_delay() -> float:
+    return float(os.getenv('RETRY_BASE_DELAY', '1'))
+
+
+def get_max_delay() -> float:
+    return float(os.getenv('RETRY_MAX_DELAY', '60'))
+
+
+def get_failure_threshold() -> int:
+    return int(os.getenv('CIRCUIT_FAILURE_THRESHOLD', '5'))
+
+
+def get_cool_down() -> float:
+    return float(os.getenv('CIRCUIT_COOL_DOWN', '600'))
+
+
+def get_state_path() -> Path:
+    return Path(os.getenv('RESILIENCE_STATE_FILE', 'resilience_state.json'))
+
+
+def get_domain(url: str) -> str:
+    return urlsplit(url if '://' in url else f'https://{url}').netloc.lower().removeprefix('www.')
+
+
+def _get_state(domain: str) -> DomainState:
+    if domain not in domains:
+        domains[domain] = DomainState()
+    return domains[domain]
+
+
+def get_backoff(failures: int) -> float:
+    # Full jitter, so urls that failed together don't all retry together
+    return random.uniform(0, min(get_max_delay(), get_base_delay() * 2 ** max(failures - 1, 0)))
+
+
+def is_open(url: str) -> bool:
+    with state_lock:
+        return _get_state(get_domain(url)).open_until > time.time()
+
+
+def record_success(url: str) -> None:
+    with state_lock:
+        state: DomainState = _get_state(get_domain(url))
+        state.successes += 1
+        state.consecutive_failures = 0
+        state.retry_at = 0.0
+        state.open_until = 0.0
+
+
+def record_failure(url: str, error: Exception | str) -> None:
+    domain: str = get_domain(url)
+    with state_lock:
+        now: float = time.time()
+        state: DomainState = _get_state(domain)
+        state.failures += 1
+        state.consecutive_failures += 1
+        state.last_error = str(error)[:200]
+        state.retry_at = now + get_backoff(state.consecutive_failures)
+        if state.consecutive_failures >= get_failure_threshold() and state.open_until <= now:
+            state.open_until = now + get_cool_down()
+            state.circuit_opens += 1
+            get_logger().warning(f'{domain} failed {state.consecutive_failures} times in a row, '
+                                 f'skipping it for {get_cool_down():.0f}s')
+
+
+def call_with_retries(url: str, function: Callable[[int], T], retries: int | None = None,
+                      retry_on: tuple[type[Exception], ...] = (Exception,)) -> T:
+    # function is given the attempt number. Raises CircuitOpenError, or the last error once out of attempts
+    domain: str = get_domain(url)
+    retries = retries or get_retry_attempts()
+    for attempt in range(retries):
+        with state_lock:
+            state: DomainState = _get_state(domain)
+            now: float = time.time()
+            if state.open_until > now:
+                state.skipped += 1
+                raise CircuitOpenError(domain, state.open_until - now)
+            wait: float = state.retry_at - now
+
+        if wait > 0:
+            time.sleep(wait)
+        try:
+            result: T = function(attempt)
+        except retry_on as e:
+            record_failure(url, e)
+            get_logger().warning(f'Attempt {attempt + 1} of {retries} failed for {url}: {e}')
+            if attempt + 1 == retries:
+                raise
+            continue
+        record_success(url)
+        return result
+    raise ValueError(f'No attempts made for {url}')
+
+
+def _load_deferred() -> dict[str, dict[str, str]]:
+    global deferred_urls
+    if deferred_urls is None:
+        deferred_urls = {}
+        if get_state_path().exists():
+            try:
+                with get_state_path().open('r', encoding='utf-8') as file:
+                    deferred_urls = json.load(file).get('deferred_urls', {})
+            except (OSError, ValueError) as e:
+                get_logger().warning(f'Could not load deferred urls from {get_state_path()}: {e}')
+    return deferred_urls
+
+
+def _save_deferred() -> None:
+    try:
+        with get_state_path().open('w', encoding='utf-8') as file:
+            json.dump({'deferred_urls': deferred_urls}, file)
+    except OSError as e:
+        get_logger().warning(f'Could not save deferred urls to {get_state_path()}: {e}')
+
+
+def defer(url: str, subject: str, domain_url: str | None = None) -> None:
+    # domain_url is the url whose domain is failing, when it isn't url itself (an archive or *arr service)
+    domain: str = get_domain(domain_url or url)
+    with state_lock:
+        _load_deferred()[url] = {'subject': subject, 'domain': domain}
+        _save_deferred()
+    get_logger().info(f'Deferred {url} until {domain} recovers')
+
+
+def take_ready_urls() -> dict[str, list[str]]:
+    # Urls whose domain has finished its cool-down, by the subject queue they came from
+    ready: dict[str, list[str]] = {}
+    with state_lock:
+        now: float = time.time()
+        urls: dict[str, dict[str, str]] = _load_deferred()
+        for url, details in list(urls.items()):
+            if _get_state(details['domain']).open_until <= now:
+                ready.setdefault(details['subject'], []).append(url)
+                del urls[url]
+        if ready:
+            _save_deferred()
+    return ready
+
+
+def get_metrics() -> dict[str, dict]:
+    with state_lock:
+        return {domain: state.get_metrics() for domain, state in domains.items()}
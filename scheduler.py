@@ -0,0 +1,118 @@
+import json
+import os
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+
+from logger import get_logger
+
+
+# Chooses the next email check from the estimated arrival rate rather than simply halving or doubling.
+# The rate is an EWMA of emails per second between checks, blended with a per hour-of-day rate learned over
+# time, and the wait is chosen so roughly TARGET_EMAILS_PER_CHECK emails are expected at the next check.
+# While a batch is still being processed the next check is held back by the typical processing time.
+
+class PollScheduler:
+    def __init__(self, min_wait: int, max_wait: int, initial_wait: int):
+        self.min_wait: int = min_wait
+        self.max_wait: int = max_wait
+        self.alpha: float = float(os.getenv('SCHEDULER_EWMA_ALPHA', '0.3'))
+        self.target_emails: float = float(os.getenv('TARGET_EMAILS_PER_CHECK', '1'))
+        self.state_path: Path = Path(os.getenv('SCHEDULER_STATE_FILE', 'scheduler_state.json'))
+        self.lock: threading.Lock = threading.Lock()
+
+        self.arrival_rate: float = 1 / max(initial_wait, 1)
+        self.processing_time: float = 0.0
+        self.hourly_emails: list[float] = [0.0] * 24
+        self.hourly_seconds: list[float] = [0.0] * 24
+        self.last_check: float | None = None
+        self.checks: int = 0
+        self.empty_checks: int = 0
+        self.last_wait: int = initial_wait
+        self.last_reason: str = 'initial'
+        self.load_state()
+
+    def load_state(self) -> None:
+        if not self.state_path.exists():
+            return
+        try:
+            with self.state_path.open('r', encoding='utf-8') as file:
+                state: dict = json.load(file)
+            self.arrival_rate = state.get('arrival_rate', self.arrival_rate)
+            self.processing_time = state.get('processing_time', self.processing_time)
+            self.hourly_emails = state.get('hourly_emails', self.hourly_emails)
+            self.hourly_seconds = state.get('hourly_seconds', self.hourly_seconds)
+        except (OSError, ValueError) as e:
+            get_logger().warning(f'Could not load scheduler state from {self.state_path}: {e}')
+
+    def save_state(self) -> None:
+        state: dict = {
+            'arrival_rate': self.arrival_rate,
+            'processing_time': self.processing_time,
+            'hourly_emails': self.hourly_emails,
+            'hourly_seconds': self.hourly_seconds
+        }
+        try:
+            with self.state_path.open('w', encoding='utf-8') as file:
+                json.dump(state, file)
+        except OSError as e:
+            get_logger().warning(f'Could not save scheduler state to {self.state_path}: {e}')
+
+    def record_check(self, emails_found: int) -> None:
+        now: float = time.time()
+        with self.lock:
+            self.checks += 1
+            self.empty_checks += 0 if emails_found else 1
+            if self.last_check is not None:
+                interval: float = max(now - self.last_check, 1.0)
+                self.arrival_rate = self.alpha * (emails_found / interval) + (1 - self.alpha) * self.arrival_rate
+                hour: int = datetime.fromtimestamp(now).hour
+                self.hourly_emails[hour] += emails_found
+                self.hourly_seconds[hour] += interval
+            self.last_check = now
+        self.save_state()
+
+    def record_processing(self, subject: str, emails: int, duration: float) -> None:
+        with self.lock:
+            if self.processing_time == 0:
+                self.processing_time = duration
+            else:
+                self.processing_time = self.alpha * duration + (1 - self.alpha) * self.processing_time
+
+    def get_expected_rate(self) -> float:
+        hour: int = datetime.now().hour
+        # Only trust an hour's history once it has been observed for a few hours in total
+        if self.hourly_seconds[hour] < 3 * 3600:
+            return self.arrival_rate
+        hourly_rate: float = self.hourly_emails[hour] / self.hourly_seconds[hour]
+        return (self.arrival_rate + hourly_rate) / 2
+
+    def next_wait(self, busy: bool = False) -> int:
+        with self.lock:
+            rate: float = self.get_expected_rate()
+            wait: float = self.target_emails / rate if rate > 0 else self.max_wait
+            reason: str = 'arrival rate'
+            if busy and self.processing_time > wait:
+                wait = self.processing_time
+                reason = 'processing'
+
+            self.last_wait = int(min(max(wait, self.min_wait), self.max_wait))
+            if self.last_wait == self.min_wait:
+                reason = f'{reason} (min)'
+            elif self.last_wait == self.max_wait:
+                reason = f'{reason} (max)'
+            self.last_reason = reason
+            return self.last_wait
+
+    def get_metrics(self) -> dict:
+        with self.lock:
+            return {
+                'arrival_rate_per_hour': round(self.arrival_rate * 3600, 3),
+                'expected_rate_per_hour': round(self.get_expected_rate() * 3600, 3),
+                'processing_time': round(self.processing_time, 1),
+                'checks': self.checks,
+                'empty_checks': self.empty_checks,
+                'next_wait': self.last_wait,
+                'reason': self.last_reason
+            }
@@ -1,8 +1,11 @@
+import os
 import time
-from datetime import datetime
+from abc import ABC, abstractmethod
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Callable
 
 import requests
-import waybackpy
 from selenium import webdriver
 from selenium.webdriver.chrome.options import Options
 from selenium.webdriver.support.ui import WebDriverWait
@@ -10,8 +13,9 @@ from selenium.webdriver.support import expected_conditions as EC
 from selenium.webdriver.common.by import By
 from selenium.common.exceptions import TimeoutException, WebDriverException, NoSuchElementException
 from bs4 import BeautifulSoup
-from waybackpy.exceptions import NoCDXRecordFound, TooManyRequestsError
 
+import http_client
+import resilience
 from logger import get_logger
 import atexit
 import re
@@ -58,27 +62,132 @@ def set_chrome_options() -> Options:
     return chrome_options
 
 
-user_agent: str = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/83.0.4103.53 Safari/537.36'
+user_agent: str = http_client.user_agent
+page_fetch_errors: tuple[type[Exception], ...] = (TimeoutException, WebDriverException,
+                                                  requests.exceptions.RequestException)
+archive_snapshot_pattern: re.Pattern = re.compile(r'^https:\/\/archive\.ph\/(?!wip\/)\w*\/?$')
 
 
-def get_archive_url(url: str):
-    if not url:
-        return None
-
+def get_driver() -> webdriver.Chrome:
     global driver
     if not driver:
         driver = webdriver.Chrome(options=set_chrome_options())
         driver.execute_cdp_cmd('Network.setUserAgentOverride', {
         'userAgent': user_agent})
+    return driver
 
-    # global user_agent
-    # cdx_api = waybackpy.WaybackMachineCDXServerAPI(url, user_agent)
-    # try:
-    #     newest = cdx_api.newest()
-    #     return newest.archive_url
-    # except NoCDXRecordFound:
-    #     return save_archive(url)
 
+def get_archive_url(url: str):
+    if not url:
+        return None
+    return find_archive_url(url) or save_archive(url)
+
+
+class ArchiveBackend(ABC):
+    name: str = ''
+
+    @abstractmethod
+    def find_snapshot(self, url: str) -> str | None:
+        pass
+
+
+class ArchiveTodayTimemapBackend(ArchiveBackend):
+    name = 'archive_today'
+    memento_pattern: re.Pattern = re.compile(r'<([^>]+)>;\s*rel="[^"]*memento[^"]*";\s*datetime="([^"]+)"')
+
+    def __init__(self, base_url: str | None = None):
+        self.base_url: str = (base_url or os.getenv('ARCHIVE_TODAY_URL', 'https://archive.ph')).rstrip('/')
+
+    def find_snapshot(self, url: str) -> str | None:
+        response: requests.Response = http_client.get(f'{self.base_url}/timemap/{url}')
+        if response.status_code == 404:
+            return None
+        response.raise_for_status()
+
+        current_date: datetime = datetime.now(timezone.utc)
+        mementos: list[tuple[datetime, str]] = []
+        for memento_url, date_text in self.memento_pattern.findall(response.text):
+            try:
+                memento_date: datetime = parsedate_to_datetime(date_text)
+            except (TypeError, ValueError):
+                get_logger().warning(f'Could not parse the memento date {date_text} for {memento_url}')
+                continue
+            if memento_date <= current_date:
+                mementos.append((memento_date, memento_url))
+        return max(mementos)[1] if mementos else None
+
+
+class WaybackCDXBackend(ArchiveBackend):
+    name = 'wayback'
+
+    def __init__(self, base_url: str | None = None):
+        self.base_url: str = (base_url or os.getenv('WAYBACK_URL', 'https://web.archive.org')).rstrip('/')
+
+    def find_snapshot(self, url: str) -> str | None:
+        params: dict[str, str] = {
+            'url': url,
+            'output': 'json',
+            'fl': 'timestamp,original',
+            'filter': 'statuscode:200',
+            'limit': '-25'
+        }
+        response: requests.Response = http_client.get(f'{self.base_url}/cdx/search/cdx', params=params)
+        response.raise_for_status()
+        rows: list[list[str]] = response.json() if response.text.strip() else []
+
+        current_timestamp: str = datetime.now(timezone.utc).strftime('%Y%m%d%H%M%S')
+        snapshots: list[tuple[str, str]] = [(row[0], row[1]) for row in rows[1:]
+                                            if len(row) >= 2 and row[0] <= current_timestamp]
+        if not snapshots:
+            return None
+        timestamp, original = max(snapshots)
+        return f'{self.base_url}/web/{timestamp}/{original}'
+
+
+class BrowserArchiveBackend(ArchiveBackend):
+    name = 'browser'
+
+    def find_snapshot(self, url: str) -> str | None:
+        return find_archive_url_in_browser(url)
+
+
+archive_backend_classes: dict[str, type[ArchiveBackend]] = {
+    backend.name: backend for backend in (ArchiveTodayTimemapBackend, WaybackCDXBackend, BrowserArchiveBackend)
+}
+archive_backends: list[ArchiveBackend] | None = None
+
+
+def get_archive_backends() -> list[ArchiveBackend]:
+    # The browser is the slowest and most brittle, so it is only tried last by default
+    global archive_backends
+    if archive_backends is None:
+        backend_names: list[str] = os.getenv('ARCHIVE_BACKENDS', 'archive_today,wayback,browser').split(',')
+        archive_backends = [archive_backend_classes[name.strip()]() for name in backend_names
+                            if name.strip() in archive_backend_classes]
+    return archive_backends
+
+
+def find_archive_url(url: str) -> str | None:
+    if not url:
+        return None
+
+    for backend in get_archive_backends():
+        try:
+            snapshot_url: str | None = backend.find_snapshot(url)
+        except (requests.exceptions.RequestException, ValueError) as e:
+            get_logger().warning(f'Error finding a {backend.name} snapshot for {url}: {e}')
+            continue
+        if snapshot_url:
+            get_logger().info(f'Found {backend.name} snapshot for {url}: {snapshot_url}')
+            return snapshot_url
+    return None
+
+
+def find_archive_url_in_browser(url: str) -> str | None:
+    if not url:
+        return None
+
+    driver = get_driver()
     driver.get('https://archive.ph')
 
     search_box = driver.find_element(By.ID, 'q')
@@ -93,7 +202,7 @@ def get_archive_url(url: str):
             EC.presence_of_element_located((By.ID, 'row0'))
         )
     except TimeoutException:
-        return save_archive(url)
+        return None
 
     # Find all the anchor tags within the first row
     links = first_row.find_elements(By.XPATH, './/a[@href]')
@@ -129,8 +238,26 @@ def get_archive_url(url: str):
     # Output the href of the most recent valid link
     if most_recent_valid_link:
         return most_recent_valid_link.get_attribute('href')
-    else:
-        return save_archive(url)
+    return None
+
+
+def is_archive_snapshot_url(url: str) -> bool:
+    return bool(archive_snapshot_pattern.match(url))
+
+
+def submit_archive(url: str) -> str:
+    # Returns the archive.ph work-in-progress url (or the snapshot url if it was saved straight away)
+    driver = get_driver()
+    driver.get('https://archive.ph')
+
+    save_box = driver.find_element(By.ID, 'url')
+    save_box.send_keys(url)
+    time.sleep(1)
+    search_button = driver.find_element(By.XPATH, '//input[@type="submit" and @value="save"]')
+    search_button.click()
+    time.sleep(1)
+    return driver.current_url
+
 
 def save_archive(url: str, tries: int = 0) -> str:
     # global user_agent
@@ -147,18 +274,11 @@ def save_archive(url: str, tries: int = 0) -> str:
     if tries >= 3:
         return ''
 
-    driver.get('https://archive.ph')
-
-    save_box = driver.find_element(By.ID, 'url')
-    save_box.send_keys(url)
-    time.sleep(1)
-    search_button = driver.find_element(By.XPATH, '//input[@type="submit" and @value="save"]')
-    search_button.click()
-    time.sleep(1)
+    submit_archive(url)
 
     try:
         WebDriverWait(driver, 360).until(
-            EC.url_matches(r'^https:\/\/archive\.ph\/(?!wip\/)\w*\/?$')  # Adjust the regex as needed
+            EC.url_matches(archive_snapshot_pattern.pattern)
         )
         return driver.current_url
     except TimeoutException as e:
@@ -166,43 +286,69 @@ def save_archive(url: str, tries: int = 0) -> str:
         return save_archive(url, tries + 1) if tries < 3 else ''
 
 
-def get_page(url: str, retries: int = 3) -> BeautifulSoup | None:
+def uses_browser(needs_browser: bool | None) -> bool:
+    # PAGE_FETCH_BACKEND is browser (every page), http (none, e.g. the offline load test) or auto (the sites whose
+    # rules say they need javascript, and sites without rules)
+    backend: str = os.getenv('PAGE_FETCH_BACKEND', 'browser')
+    return backend == 'browser' or (backend == 'auto' and needs_browser is not False)
+
+
+def get_page_source(url: str, retries: int | None = None, needs_browser: bool | None = None,
+                    ready_selector: str | None = None) -> str | None:
     if not url:
         return None
 
-    global driver
-    if not driver:
-        driver = webdriver.Chrome(options=set_chrome_options())
-        driver.execute_cdp_cmd('Network.setUserAgentOverride', {
-        'userAgent': user_agent})
+    fetch: Callable[[int], str | None] = (
+        (lambda attempt: get_page_source_in_browser(url, attempt, ready_selector)) if uses_browser(needs_browser)
+        else (lambda attempt: get_page_source_over_http(url))
+    )
+    try:
+        return resilience.call_with_retries(url, fetch, retries, page_fetch_errors)
+    except resilience.CircuitOpenError as e:
+        get_logger().warning(f'Skipping {url}: {e}')
+    except page_fetch_errors as e:
+        get_logger().error(f'Failed to fetch {url}: {e}')
+    except Exception as e:
+        get_logger().error(f'Unexpected error fetching {url}: {e}')
+    return None
 
-    for attempt in range(retries):
-        try:
-            # Navigate to Google first
-            driver.get('https://www.google.com')
-            time.sleep(0.4)  # Wait for a bit
-
-            # Now navigate to the actual URL
-            driver.get(url)
-            WebDriverWait(driver, 10).until(EC.presence_of_element_located((By.TAG_NAME, "body")))
-            time.sleep(0.2)
-
-            # Scroll down the page
-            driver.execute_script('window.scrollTo(0, document.body.scrollHeight);')
-            WebDriverWait(driver, 10).until(EC.presence_of_element_located((By.TAG_NAME, "body")))
-
-            page_source = driver.page_source
-            return BeautifulSoup(page_source, 'html.parser')
-
-        except TimeoutException:
-            get_logger().warning(f'Attempt {attempt + 1} timed out for {url}')
-        except WebDriverException as e:
-            get_logger().warning(f'WebDriver error on attempt {attempt + 1} for {url}: {str(e)}')
-        except Exception as e:
-            get_logger().warning(f'Unexpected error on attempt {attempt + 1} for {url}: {str(e)}')
-        finally:
-            if attempt + 1 == retries:
-                get_logger().error(f'Failed to fetch {url} after {retries} attempts')
-                return None
 
-    return None
+def get_page_source_in_browser(url: str, attempt: int = 0, ready_selector: str | None = None) -> str:
+    driver = get_driver()
+
+    # Navigate to Google first, only once as retries are already spaced out by the backoff
+    if attempt == 0:
+        driver.get('https://www.google.com')
+        time.sleep(0.4)  # Wait for a bit
+
+    # Now navigate to the actual URL
+    driver.get(url)
+    WebDriverWait(driver, 10).until(EC.presence_of_element_located((By.TAG_NAME, "body")))
+    if ready_selector:
+        # The recipe is rendered by javascript after the body, a timeout is retried like any other
+        WebDriverWait(driver, 10).until(EC.presence_of_element_located((By.CSS_SELECTOR, ready_selector)))
+    time.sleep(0.2)
+
+    # Scroll down the page
+    driver.execute_script('window.scrollTo(0, document.body.scrollHeight);')
+    WebDriverWait(driver, 10).until(EC.presence_of_element_located((By.TAG_NAME, "body")))
+
+    return driver.page_source
+
+
+def get_page_source_over_http(url: str) -> str | None:
+    response: requests.Response = http_client.get(url)
+    # Only count the site as failing when it is down or throttling us, not for a missing page
+    if response.status_code == 429 or response.status_code >= 500:
+        response.raise_for_status()
+    if not response.ok:
+        get_logger().warning(f'Got {response.status_code} fetching {url}')
+        return None
+    return response.text
+
+
+def get_page(url: str, retries: int | None = None) -> BeautifulSoup | None:
+    page_source: str | None = get_page_source(url, retries)
+    if page_source is None:
+        return None
+    return BeautifulSoup(page_source, 'html.parser')